@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+"""
+Batched acknowledgement of SQS messages.
+
+Rather than one `DeleteMessage` call per message, receipt handles are
+collected and sent with `DeleteMessageBatch` (at most 10 per call), either
+when a batch fills up or when the oldest pending ack has waited `max_delay`
+seconds.
+
+`DeleteMessageBatch` can partially fail, in which case only the failed
+entries are retried, with exponential backoff. Entries which failed through
+our own fault (eg. an expired receipt handle) are not retried, as they never
+will succeed.
+"""
+
+import logging
+import threading
+import time
+
+import metrics
+
+LOG = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = 10  # imposed by SQS
+
+
+class AckBatcher(object):
+    def __init__(self, sqs_queue, max_delay=1.0, max_attempts=3,
+                 retry_delay=0.2):
+        """
+        Failed deletes are retried after `retry_delay` seconds, doubling
+        each time, so throttling or a network blip has time to pass.
+        """
+        self.sqs_queue = sqs_queue
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+        self._pending = []
+        self._oldest_pending_at = None
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+
+        self._timer = threading.Thread(target=self._flush_periodically,
+                                       name='ack-batcher')
+        self._timer.daemon = True
+        self._timer.start()
+
+    def __len__(self):
+        """
+        Number of acks waiting to be sent.
+        """
+        return len(self._pending)
+
+    def add(self, sqs_message):
+        """
+        Queue the message for deletion. Sends a batch straight away if this
+        fills it up, or if the batcher has been closed.
+        """
+        with self._lock:
+            # Checked under the lock, which close() takes to set it, so that
+            # anything appended here is seen by close()'s final flush
+            if self._closed.is_set():  # eg. a worker finishing at shutdown
+                batch = [sqs_message.receipt_handle]
+
+            else:
+                if not self._pending:
+                    self._oldest_pending_at = time.monotonic()
+
+                self._pending.append(sqs_message.receipt_handle)
+
+                batch = (self._take_batch()
+                         if len(self._pending) >= MAX_BATCH_SIZE else None)
+
+        if batch:
+            self._delete(batch)
+
+    def flush(self):
+        """
+        Delete everything pending, regardless of batch size or age.
+        """
+        while True:
+            with self._lock:
+                batch = self._take_batch()
+
+            if not batch:
+                return
+
+            self._delete(batch)
+
+    def close(self):
+        with self._lock:
+            self._closed.set()
+
+        self._timer.join()
+        self.flush()
+
+    def _take_batch(self):
+        batch = self._pending[:MAX_BATCH_SIZE]
+        self._pending = self._pending[MAX_BATCH_SIZE:]
+        self._oldest_pending_at = time.monotonic() if self._pending else None
+        return batch
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.max_delay / 2):
+            with self._lock:
+                due = (self._oldest_pending_at is not None and
+                       time.monotonic() - self._oldest_pending_at >=
+                       self.max_delay)
+                batch = self._take_batch() if due else None
+
+            if batch:
+                self._delete(batch)
+
+    def _delete(self, receipt_handles):
+        entries = [{'Id': str(i), 'ReceiptHandle': receipt_handle}
+                   for i, receipt_handle in enumerate(receipt_handles)]
+
+        for attempt in range(1, self.max_attempts + 1):
+            if attempt > 1:
+                time.sleep(self.retry_delay * 2 ** (attempt - 2))
+
+            try:
+                with metrics.DELETE_SECONDS.time():
+                    response = self.sqs_queue.delete_messages(Entries=entries)
+            except Exception as e:
+                LOG.warning('DeleteMessageBatch attempt {} of {} '
+                            'failed: {}'.format(
+                                attempt, self.max_attempts, repr(e)))
+                continue
+
+            failed = response.get('Failed', [])
+            if not failed:
+                return
+
+            receipt_handles = {e['Id']: e['ReceiptHandle'] for e in entries}
+            retryable_ids = set()
+            for failure in failed:
+                if failure.get('SenderFault'):
+                    metrics.ACK_FAILURES.inc()
+                    LOG.error('Not retrying delete of {}: {} {}'.format(
+                        receipt_handles[failure['Id']], failure.get('Code'),
+                        failure.get('Message')))
+                else:
+                    retryable_ids.add(failure['Id'])
+
+            entries = [e for e in entries if e['Id'] in retryable_ids]
+            if not entries:
+                return
+
+            LOG.warning('{} of the deletes in a batch failed, retrying'.format(
+                len(entries)))
+
+        metrics.ACK_FAILURES.inc(len(entries))
+        LOG.error('Giving up deleting {} messages after {} attempts, they '
+                  'will be redelivered.'.format(
+                      len(entries), self.max_attempts))
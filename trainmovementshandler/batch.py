@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+"""
+Delay repay eligibility for a whole batch of messages at once, with NumPy.
+
+`process_message` decides one message at a time through `TrainMovementsMessage`
+attributes and reference data objects. That's fine for the live feed, but
+when replaying a backlog of millions of movements the per-object overhead is
+what limits us. Here a list of raw SQS message bodies is decoded into columns
+(NumPy arrays, one element per message) and eligibility is worked out with
+array operations against lookup arrays built from the reference data:
+
+```
+columns = decode_batch(bodies)
+eligible = eligible_mask(columns)
+for i in eligible.nonzero()[0]:
+    ...
+```
+
+The decision is the same as `process_message`'s with the default rules (see
+eligibility_rules.json): a late arrival, at a public station, for an
+operating company whose delay repay policy covers that many minutes late
+(rounded towards zero). Rules added to the file aren't applied here.
+
+NumPy is optional, it's only needed if this module is used. The lookup
+arrays are a reference table (see reference_data.py), registered the first
+time they're needed, so `reference_data.warm_up()` doesn't build them (and
+need NumPy) unless batch eligibility is being used.
+"""
+
+import json
+import threading
+
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import locations
+import operating_companies
+import reference_data
+from handle import EventType, VariationStatus
+
+MOVEMENT = '0003'
+
+# STANOX codes are 5 digits, so the public station lookup is indexed by the
+# code itself
+MAX_STANOX = 99999
+
+# TOC numeric codes are 2 digits
+MAX_TOC_ID = 99
+
+# Threshold for operating companies without a delay repay policy: no number
+# of minutes late is ever enough
+NEVER_ELIGIBLE = numpy.iinfo(numpy.int32).max if numpy is not None else None
+
+UNKNOWN = 0  # code for a missing or unrecognised value in any column
+
+EVENT_TYPE_CODES = {string: EventType.get(string).value
+                    for string in ('ARRIVAL', 'DEPARTURE', 'DESTINATION')}
+
+VARIATION_STATUS_CODES = {
+    string: VariationStatus.get(string).value
+    for string in ('ON TIME', 'EARLY', 'LATE', 'OFF ROUTE')}
+
+
+MovementColumns = namedtuple('MovementColumns', [
+    'is_movement',  # bool
+    'event_type',  # int8, EventType value or UNKNOWN
+    'variation_status',  # int8, VariationStatus value or UNKNOWN
+    'stanox',  # int32, -1 if missing
+    'toc_id',  # int16, -1 if missing
+    'planned_timestamp',  # int64 ms since the epoch, 0 if missing
+    'actual_timestamp',  # int64 ms since the epoch, 0 if missing
+])
+
+EligibilityLookups = namedtuple('EligibilityLookups', [
+    'is_public_station',  # bool, indexed by STANOX
+    'minimum_minutes_late',  # int32, indexed by TOC numeric code
+])
+
+
+def _require_numpy():
+    if numpy is None:
+        raise RuntimeError('Batch eligibility needs NumPy: pip install numpy')
+
+
+def decode_batch(bodies):
+    """
+    Decode raw SQS message bodies into `MovementColumns`. Messages other than
+    movements get a row too, with `is_movement` False.
+    """
+    _require_numpy()
+
+    rows = [_decode_row(body) for body in bodies]
+    (is_movement, event_type, variation_status, stanox, toc_id,
+     planned_timestamp, actual_timestamp) = (
+        zip(*rows) if rows else ([],) * len(MovementColumns._fields))
+
+    return MovementColumns(
+        is_movement=numpy.array(is_movement, dtype=numpy.bool_),
+        event_type=numpy.array(event_type, dtype=numpy.int8),
+        variation_status=numpy.array(variation_status, dtype=numpy.int8),
+        stanox=numpy.array(stanox, dtype=numpy.int32),
+        toc_id=numpy.array(toc_id, dtype=numpy.int16),
+        planned_timestamp=numpy.array(planned_timestamp, dtype=numpy.int64),
+        actual_timestamp=numpy.array(actual_timestamp, dtype=numpy.int64),
+    )
+
+
+def _decode_row(body):
+    message = json.loads(body)
+
+    if message['header']['msg_type'] != MOVEMENT:
+        return (False, UNKNOWN, UNKNOWN, -1, -1, 0, 0)
+
+    fields = message['body']
+
+    return (
+        True,
+        EVENT_TYPE_CODES.get(fields.get('event_type'), UNKNOWN),
+        VARIATION_STATUS_CODES.get(fields.get('variation_status'), UNKNOWN),
+        _int_or(fields.get('loc_stanox'), -1),
+        _int_or(fields.get('toc_id'), -1),
+        _int_or(fields.get('planned_timestamp'), 0),
+        _int_or(fields.get('actual_timestamp'), 0),
+    )
+
+
+def _int_or(string, default):
+    try:
+        return int(string)
+    except (TypeError, ValueError):
+        return default
+
+
+def eligible_mask(columns, lookups=None):
+    """
+    Returns a bool array, True for each message which is eligible for delay
+    repay.
+    """
+    _require_numpy()
+
+    if lookups is None:
+        lookups = eligibility_lookups().current()
+
+    known_stanox = (columns.stanox >= 0) & (columns.stanox <= MAX_STANOX)
+    known_toc = (columns.toc_id >= 0) & (columns.toc_id <= MAX_TOC_ID)
+    have_timestamps = ((columns.planned_timestamp != 0) &
+                       (columns.actual_timestamp != 0))
+
+    # Out of range codes are looked up as 0, and masked out by known_*
+    is_public_station = lookups.is_public_station[
+        numpy.where(known_stanox, columns.stanox, 0)]
+    minimum_minutes_late = lookups.minimum_minutes_late[
+        numpy.where(known_toc, columns.toc_id, 0)]
+
+    # Truncated towards zero, like int() of the timedelta in minutes
+    minutes_late = (
+        (columns.actual_timestamp - columns.planned_timestamp) / 60000.0
+    ).astype(numpy.int64)
+
+    return (
+        columns.is_movement &
+        (columns.event_type == EventType.arrival.value) &
+        (columns.variation_status == VariationStatus.late.value) &
+        known_stanox & is_public_station &
+        known_toc & (minutes_late >= minimum_minutes_late) &
+        have_timestamps
+    )
+
+
+def _load_eligibility_lookups():
+    _require_numpy()
+
+    is_public_station = numpy.zeros(MAX_STANOX + 1, dtype=numpy.bool_)
+
+    for stanox in locations.public_station_stanoxes():
+        code = _int_or(stanox, -1)
+        if 0 <= code <= MAX_STANOX:
+            is_public_station[code] = True
+
+    minimum_minutes_late = numpy.full(
+        MAX_TOC_ID + 1, NEVER_ELIGIBLE, dtype=numpy.int32)
+
+    for numeric_code in (
+            operating_companies.DELAY_REPAY_BY_NUMERIC_CODE.current()):
+        minimum = operating_companies.minimum_eligible_minutes(numeric_code)
+
+        if minimum is not None and 0 <= numeric_code <= MAX_TOC_ID:
+            minimum_minutes_late[numeric_code] = minimum
+
+    # "00" means no operating company
+    minimum_minutes_late[0] = NEVER_ELIGIBLE
+
+    return EligibilityLookups(is_public_station, minimum_minutes_late)
+
+
+_eligibility_lookups = None
+_eligibility_lookups_lock = threading.Lock()
+
+
+def eligibility_lookups():
+    """
+    The reference table of `EligibilityLookups`, registered on first use.
+    """
+    global _eligibility_lookups
+
+    with _eligibility_lookups_lock:
+        if _eligibility_lookups is None:
+            _require_numpy()
+
+            # Built from the other tables, so it's rebuilt whenever any of
+            # their sources change.
+            _eligibility_lookups = reference_data.register(
+                'eligibility_lookups', _load_eligibility_lookups,
+                source_filenames=(
+                    locations.STANOX_LOOKUP.source_filenames +
+                    operating_companies.DELAY_REPAY_BY_NUMERIC_CODE
+                    .source_filenames))
+
+    return _eligibility_lookups
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+"""
+Microbenchmarks for the hot parts of message handling. These need the
+`uk-train-data` submodule checked out. Run eg:
+
+```
+./bench.py decode
+./bench.py --number 100000 decode
+```
+
+To compare before and after a change, run the same benchmark on both
+commits.
+"""
+
+import argparse
+import datetime
+import timeit
+
+import handle
+import locations
+
+SAMPLE_BODY = {
+    "status": "LATE",
+    "variation_status": "LATE",
+    "planned_timestamp": "1455883470000",
+    "event_type": "ARRIVAL",
+    "train_terminated": "false",
+    "direction_ind": "UP",
+    "toc_id": "88",
+    "auto_expected": "true",
+    "event_source": "AUTOMATIC",
+    "reporting_stanox": "87701",
+    "gbtt_timestamp": "1455883440000",
+    "platform": " 1",
+    "correction_ind": "false",
+    "original_loc_stanox": "",
+    "planned_event_type": "ARRIVAL",
+    "timetable_variation": "32",
+    "delay_monitoring_point": "true",
+    "line_ind": "F",
+    "next_report_stanox": "87700",
+    "train_id": "892A39MI19",
+    "offroute_ind": "false",
+    "current_train_id": "",
+    "loc_stanox": "87701",
+    "next_report_run_time": "1",
+    "route": "2",
+    "train_file_address": None,
+    "division_code": "88",
+    "actual_timestamp": "1455885390000",
+    "original_loc_timestamp": "",
+    "train_service_code": "24745000"
+}
+
+
+def bench_decode():
+    """
+    Decode a message and read the fields that `process_message` and its log
+    line use for an eligible arrival, without the JSON dump or the logging.
+    """
+    def decode():
+        decoded = handle.TrainMovementsMessage(SAMPLE_BODY)
+        (decoded.event_type == handle.EventType.arrival and
+         decoded.status == handle.VariationStatus.late and
+         decoded.location.is_public_station and
+         decoded.operating_company and
+         decoded.operating_company.is_delay_repay_eligible(
+             decoded.minutes_late))
+        (decoded.actual_datetime, decoded.early_late_description,
+         decoded.location.name, decoded.location.three_alpha,
+         decoded.operating_company)
+        decoded.serialize()
+
+    return decode
+
+
+def bench_location():
+    """
+    Look up a location and serialize it, as done for every eligible message.
+    """
+    stanox = SAMPLE_BODY['loc_stanox']
+
+    def lookup_and_serialize():
+        locations.from_stanox(stanox).serialize()
+
+    return lookup_and_serialize
+
+
+class _DatetimeMinutesLate(handle.TrainMovementsMessage):
+    """
+    Works out minutes late the way it used to be done: both timestamps
+    converted to naive local datetimes (wrong across a DST change) and
+    subtracted.
+    """
+
+    __slots__ = ()
+
+    @handle.memoized_property
+    def minutes_late(self):
+        planned = datetime.datetime.fromtimestamp(
+            int(self.raw['planned_timestamp']) / 1000)
+        actual = datetime.datetime.fromtimestamp(
+            int(self.raw['actual_timestamp']) / 1000)
+        return int((actual - planned).total_seconds() / 60)
+
+
+def bench_minutes_late_datetime():
+    """
+    Decode a message and work out minutes late through datetimes, as before.
+    Compare with `minutes_late_ms`.
+    """
+    def minutes_late():
+        _DatetimeMinutesLate(SAMPLE_BODY).minutes_late
+
+    return minutes_late
+
+
+def bench_minutes_late_ms():
+    """
+    Decode a message and work out minutes late as `TrainMovementsMessage`
+    does now, from integer milliseconds with no datetimes.
+    """
+    def minutes_late():
+        handle.TrainMovementsMessage(SAMPLE_BODY).minutes_late
+
+    return minutes_late
+
+
+BENCHMARKS = {
+    'decode': bench_decode,
+    'location': bench_location,
+    'minutes_late_datetime': bench_minutes_late_datetime,
+    'minutes_late_ms': bench_minutes_late_ms,
+}
+
+
+def report(name, number, repeat):
+    timings = timeit.repeat(BENCHMARKS[name](), number=number, repeat=repeat)
+    best = min(timings)
+
+    print('{}: {:.2f} us per call, {:.0f} calls/sec (best of {} x {})'.format(
+        name, best / number * 1e6, number / best, repeat, number))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run microbenchmarks.')
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='one or more of: {}'.format(
+                            ', '.join(sorted(BENCHMARKS))))
+    parser.add_argument('--number', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmark(s): {}'.format(
+            ', '.join(sorted(unknown))))
+
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        report(name, args.number, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+
+"""
+Compile the CORPUS and NAPTAN reference data into the binary location index
+read by `locations.py`. Run this whenever the uk-train-data submodule is
+updated.
+"""
+
+import sys
+
+import locations
+from location_index import write_index
+
+
+def main():
+    filename = sys.argv[1] if len(sys.argv) > 1 else locations.INDEX_FILENAME
+    records = locations.read_json_records()
+
+    write_index(filename, records.values())
+    print('Wrote {} locations to {}'.format(len(records), filename))
+
+
+if __name__ == '__main__':
+    main()
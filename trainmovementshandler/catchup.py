@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+"""
+Catching up quickly after an outage, by shedding stale messages we don't
+need.
+
+Normally every message is handled in the order SQS hands them out. After an
+outage that means hours of yesterday's departures to get through before
+today's late arrivals are spotted. `CatchUp` looks at how far behind we are,
+from the `msg_queue_timestamp` header of each message (when TRUST queued it),
+and publishes that as the `lag_seconds` gauge.
+
+Once the lag goes over `enter_lag`, it's in catch-up mode until the lag is
+back under `exit_lag`. In catch-up mode only movements that might be
+eligible get decoded and processed: by default late arrivals, or those that
+`might_be_eligible(body)` returns True for, eg. a `HeaderPrefilter` following
+the eligibility rules. Any other movement whose
+`actual_timestamp` is more than `stale_after` seconds old is shed: acked
+without being processed, after being appended to `divert_file` if one's
+given. That file is in the dump format replay.py reads, so shed messages can
+still be looked at later.
+
+Like prefilter.py, the fields are picked out of the raw body with regular
+expressions, and a message where one can't be found is never shed.
+
+```
+catch_up = CatchUp(enter_lag=15 * 60, exit_lag=2 * 60, stale_after=30 * 60,
+                   might_be_eligible=HeaderPrefilter(
+                       msg_types=None, rules=ELIGIBILITY_RULES).accepts)
+
+if catch_up.sheds(body):
+    return True  # ack it
+```
+"""
+
+import logging
+import re
+import threading
+import time
+
+import metrics
+
+LOG = logging.getLogger(__name__)
+
+QUEUE_TIMESTAMP_PATTERN = re.compile(r'"msg_queue_timestamp"\s*:\s*"(\d+)"')
+ACTUAL_TIMESTAMP_PATTERN = re.compile(r'"actual_timestamp"\s*:\s*"(\d+)"')
+
+# The leading quote stops eg. "event_type" matching "planned_event_type"
+EVENT_TYPE_PATTERN = re.compile(r'"event_type"\s*:\s*"([^"]*)"')
+VARIATION_STATUS_PATTERN = re.compile(r'"variation_status"\s*:\s*"([^"]*)"')
+
+
+class CatchUp(object):
+    def __init__(self, enter_lag=15 * 60, exit_lag=2 * 60,
+                 stale_after=30 * 60, divert_file=None,
+                 might_be_eligible=None, clock=time.time):
+        self.enter_lag = enter_lag
+        self.exit_lag = exit_lag
+        self.stale_after = stale_after
+        self.divert_file = divert_file
+        self.might_be_eligible = might_be_eligible or _might_be_eligible
+        self.clock = clock
+
+        self.catching_up = False
+        self.lag = None
+        self.shed_count = 0
+
+        self._divert = None
+        self._lock = threading.Lock()
+
+        if divert_file is not None:
+            self._divert = open(divert_file, 'a', encoding='utf-8')
+
+    def close(self):
+        if self._divert is not None:
+            self._divert.close()
+
+    def sheds(self, body):
+        """
+        Returns True if the message should be acked without being processed.
+        """
+        now = self.clock()
+        self._observe_lag(body, now)
+
+        if not self.catching_up or self.might_be_eligible(body):
+            return False
+
+        actual_timestamp = _milliseconds(ACTUAL_TIMESTAMP_PATTERN, body)
+        if (actual_timestamp is None or
+                now - actual_timestamp / 1000.0 < self.stale_after):
+            return False
+
+        with self._lock:
+            if self._divert is not None:
+                self._divert.write(body + '\n')
+                self._divert.flush()
+
+            self.shed_count += 1
+
+        metrics.MESSAGES_SHED.inc()
+        return True
+
+    def _observe_lag(self, body, now):
+        queued_at = _milliseconds(QUEUE_TIMESTAMP_PATTERN, body)
+        if queued_at is None:
+            return
+
+        self.lag = lag = max(0.0, now - queued_at / 1000.0)
+        metrics.LAG_SECONDS.set(round(lag, 3))
+
+        if not self.catching_up and lag > self.enter_lag:
+            self.catching_up = True
+            LOG.warning('{:.0f}s behind, catching up: shedding movements '
+                        'over {}s old that aren\'t late arrivals'.format(
+                            lag, self.stale_after))
+
+        elif self.catching_up and lag < self.exit_lag:
+            self.catching_up = False
+            LOG.info('Caught up to {:.0f}s behind, {} messages shed so '
+                     'far'.format(lag, self.shed_count))
+
+
+def _might_be_eligible(body):
+    event_type = EVENT_TYPE_PATTERN.search(body)
+    variation_status = VARIATION_STATUS_PATTERN.search(body)
+
+    if event_type is None or variation_status is None:
+        return True  # can't tell, so it gets decoded
+
+    return (event_type.group(1) == 'ARRIVAL' and
+            variation_status.group(1) == 'LATE')
+
+
+def _milliseconds(pattern, body):
+    match = pattern.search(body)
+    return int(match.group(1)) if match is not None else None
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+"""
+Concurrent SQS consumer.
+
+A single long-poll loop spends most of its time waiting on SQS round trips.
+Here several poller threads call `receive_messages` in parallel and feed a
+bounded work queue which is drained by a pool of worker threads. Each worker
+hands one message at a time to the `handle_message` callback, so the unit of
+work (decode, `process_message`, ack) is exactly the same as the
+single-threaded loop.
+
+Backpressure: a poller reserves room for a full batch before it receives, so
+there are never more than `max_pending` messages received but not yet
+handled. This keeps messages from sitting in our own queue until their
+visibility timeout runs out.
+
+`drain()` stops receiving and waits for the workers to finish everything
+already received, eg. when shutting down.
+
+If a `heartbeat` (see visibility.py) is given, messages are tracked by it from
+when they're received until `handle_message` returns.
+
+If a `controller` (see polling.py) is given, it supplies the receive
+parameters and decides how many of the pollers receive at once.
+"""
+
+import functools
+import logging
+import queue
+import threading
+import time
+
+import metrics
+
+LOG = logging.getLogger(__name__)
+
+
+class ConcurrentConsumer(object):
+    def __init__(self, sqs_queue, handle_message, receive_params,
+                 num_pollers=4, num_workers=4, max_pending=100,
+                 log_every=None, heartbeat=None, controller=None):
+
+        batch_size = receive_params.get('MaxNumberOfMessages', 1)
+        if max_pending < batch_size:
+            raise ValueError(
+                'max_pending ({}) must be at least MaxNumberOfMessages '
+                '({})'.format(max_pending, batch_size))
+
+        self.sqs_queue = sqs_queue
+        self.handle_message = handle_message
+        self.receive_params = receive_params
+        self.num_pollers = num_pollers
+        self.num_workers = num_workers
+        self.max_pending = max_pending
+        self.log_every = log_every
+        self.heartbeat = heartbeat
+        self.controller = controller
+
+        self._batch_size = batch_size
+        self._work = queue.Queue(maxsize=max_pending)
+        self._free_slots = max_pending
+        self._slots_changed = threading.Condition()
+        self._stopping = threading.Event()
+        self._draining = threading.Event()
+        self._count = 0
+        self._count_lock = threading.Lock()
+        self._error = None
+        self._threads = []
+        self._worker_threads = []
+
+    def run(self, shutdown=None):
+        """
+        Start the pollers and workers and block until `stop()` is called or
+        one of the threads dies with an exception, which is then re-raised
+        here, just like it would be from the single-threaded loop.
+
+        If `shutdown` (see shutdown.py) is requested, drain within its
+        deadline and return.
+        """
+        self.start()
+
+        try:
+            while not self._stopping.wait(1):
+                if shutdown is not None and shutdown.requested.is_set():
+                    self.drain(shutdown.time_left())
+                    break
+        finally:
+            self.stop()
+
+        if self._error is not None:
+            raise self._error
+
+    def start(self):
+        for i in range(self.num_pollers):
+            self._start_thread(functools.partial(self._poll, i),
+                               'poller-{}'.format(i))
+
+        for i in range(self.num_workers):
+            self._worker_threads.append(
+                self._start_thread(self._work_loop, 'worker-{}'.format(i)))
+
+    def stop(self):
+        self._stopping.set()
+
+        with self._slots_changed:
+            self._slots_changed.notify_all()
+
+    def drain(self, timeout):
+        """
+        Stop receiving, and wait up to `timeout` seconds for everything
+        already received to be handled. Returns True if it all was.
+        """
+        self._draining.set()
+        deadline = time.monotonic() + timeout
+
+        with self._slots_changed:
+            self._slots_changed.notify_all()
+
+            # Every slot is free once nothing is being received or handled
+            while self._free_slots < self.max_pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._stopping.is_set():
+                    break
+                self._slots_changed.wait(remaining)
+
+            drained = self._free_slots == self.max_pending
+
+        self.stop()
+
+        # Workers finish the message they're on before they notice
+        for thread in self._worker_threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+        return drained
+
+    @property
+    def count(self):
+        return self._count
+
+    def _start_thread(self, target, name):
+        thread = threading.Thread(
+            target=self._run_guarded, args=(target,), name=name)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+        return thread
+
+    def _run_guarded(self, target):
+        try:
+            target()
+        except Exception as e:
+            LOG.exception('{} died'.format(threading.current_thread().name))
+            self._error = e
+            self.stop()
+
+    def _poll(self, index):
+        while not (self._stopping.is_set() or self._draining.is_set()):
+            if self.controller is None:
+                params = self.receive_params
+            elif index < self.controller.receives:
+                params = self.controller.receive_params()
+            else:
+                self._stopping.wait(1)  # not needed for now
+                continue
+
+            if not self._reserve_slots(self._batch_size):
+                return
+
+            with metrics.RECEIVE_SECONDS.time():
+                sqs_messages = self.sqs_queue.receive_messages(**params)
+
+            received_at = time.monotonic()
+            metrics.MESSAGES_RECEIVED.inc(len(sqs_messages))
+            self._release_slots(self._batch_size - len(sqs_messages))
+
+            if self.heartbeat is not None:
+                self.heartbeat.track(
+                    sqs_messages, timeout=params['VisibilityTimeout'])
+
+            if self.controller is not None:
+                self.controller.observe_receive(
+                    len(sqs_messages), params['MaxNumberOfMessages'])
+
+            for sqs_message in sqs_messages:
+                self._work.put((received_at, sqs_message))
+
+    def _work_loop(self):
+        while not self._stopping.is_set():
+            try:
+                received_at, sqs_message = self._work.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            try:
+                self.handle_message(sqs_message)
+            finally:
+                self._release_slots(1)
+                if self.heartbeat is not None:
+                    self.heartbeat.untrack(sqs_message)
+
+            if self.controller is not None:
+                self.controller.observe_handled(
+                    1, time.monotonic() - received_at)
+
+            self._increment_count()
+
+    def _reserve_slots(self, n):
+        with self._slots_changed:
+            while True:
+                if self._stopping.is_set() or self._draining.is_set():
+                    return False
+                if self._free_slots >= n:
+                    break
+                self._slots_changed.wait()
+
+            self._free_slots -= n
+            return True
+
+    def _release_slots(self, n):
+        if n == 0:
+            return
+
+        with self._slots_changed:
+            self._free_slots += n
+            self._slots_changed.notify_all()
+
+    def _increment_count(self):
+        with self._count_lock:
+            self._count += 1
+            count = self._count
+
+        if self.log_every and count % self.log_every == 0:
+            LOG.info('Processed {} messages, {} waiting in the work '
+                     'queue'.format(count, self._work.qsize()))
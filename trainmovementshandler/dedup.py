@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+"""
+Remembers which train movements have already been handled, so messages that
+SQS redelivers (it's at-least-once, and a slow batch can outlive its
+visibility timeout) are acked without being processed again.
+
+A movement is identified by its train, location, event type and actual time.
+Keys are only remembered once the message they came from has been fully
+handled, so a message that failed (and wasn't acked) is still processed when
+it comes back:
+
+```
+key = movement_key(message)
+if key is not None and cache.seen(key):
+    return True  # duplicate, just ack it
+
+process(message)
+cache.add_pending(key)
+...
+cache.commit()  # once this thread's messages are safely handled
+```
+
+The cache holds at most `max_entries` keys, each until `ttl` seconds after
+it was last seen, evicting the least recently seen first. If `filename` is
+given the keys are loaded from it on start up, and saved to it by `save()`,
+every `save_interval` seconds from a background thread (so no consumer waits
+for it) and by `close()`.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+import metrics
+
+LOG = logging.getLogger(__name__)
+
+
+def movement_key(message):
+    """
+    Returns the identity of a decoded movement message, or None for other
+    message types.
+    """
+    if message.get('header', {}).get('msg_type') != '0003':
+        return None
+
+    body = message.get('body') or {}
+
+    try:
+        return (body['train_id'], body['loc_stanox'], body['event_type'],
+                body['actual_timestamp'])
+    except KeyError:
+        return None
+
+
+class DedupCache(object):
+    def __init__(self, max_entries=100000, ttl=6 * 60 * 60, filename=None,
+                 save_interval=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.filename = filename
+        self.save_interval = save_interval
+
+        self._seen_at = OrderedDict()  # key -> time.time(), oldest first
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._closed = threading.Event()
+        self._saver = None
+
+        if filename is not None:
+            if os.path.exists(filename):
+                self.load()
+
+            self._saver = threading.Thread(target=self._save_periodically,
+                                           name='dedup-saver')
+            self._saver.daemon = True
+            self._saver.start()
+
+    def __len__(self):
+        return len(self._seen_at)
+
+    def seen(self, key):
+        """
+        Returns True if `key` was committed within the last `ttl` seconds.
+        """
+        now = time.time()
+
+        with self._lock:
+            seen_at = self._seen_at.get(key)
+
+            if seen_at is not None and now - seen_at < self.ttl:
+                self._seen_at[key] = now
+                self._seen_at.move_to_end(key)
+                metrics.DEDUP_HITS.inc()
+                return True
+
+        metrics.DEDUP_MISSES.inc()
+        return False
+
+    def add_pending(self, key):
+        """
+        Note that this thread has handled the message for `key`. It isn't
+        remembered until `commit()`.
+        """
+        try:
+            self._local.pending.append(key)
+        except AttributeError:
+            self._local.pending = [key]
+
+    def commit(self):
+        """
+        Remember every key this thread has added since the last commit or
+        discard.
+        """
+        pending = self._take_pending()
+        now = time.time()
+
+        with self._lock:
+            for key in pending:
+                self._seen_at[key] = now
+                self._seen_at.move_to_end(key)
+
+            self._evict(now)
+
+    def discard(self):
+        """
+        Forget the keys this thread has added since the last commit, because
+        their messages won't be acked.
+        """
+        self._take_pending()
+
+    def close(self):
+        """
+        Stop saving periodically, and save one last time.
+        """
+        if self._saver is not None:
+            self._closed.set()
+            self._saver.join()
+            self.save()
+
+    def save(self):
+        with self._lock:
+            self._evict(time.time())
+            snapshot = list(self._seen_at.items())
+
+        entries = [[list(key), seen_at] for key, seen_at in snapshot]
+        temporary_filename = '{}.tmp'.format(self.filename)
+
+        try:
+            with open(temporary_filename, 'w') as f:
+                json.dump(entries, f)
+            os.replace(temporary_filename, self.filename)
+        except OSError:
+            LOG.exception('Failed to save dedup cache to {}'.format(
+                self.filename))
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            LOG.exception('Failed to load dedup cache from {}, starting '
+                          'empty'.format(self.filename))
+            return
+
+        with self._lock:
+            for key, seen_at in sorted(entries, key=lambda entry: entry[1]):
+                self._seen_at[tuple(key)] = seen_at
+            self._evict(time.time())
+
+        LOG.info('Loaded {} dedup keys from {}'.format(
+            len(self._seen_at), self.filename))
+
+    def _save_periodically(self):
+        while not self._closed.wait(self.save_interval):
+            self.save()
+
+    def _take_pending(self):
+        pending = getattr(self._local, 'pending', [])
+        self._local.pending = []
+        return pending
+
+    def _evict(self, now):
+        while len(self._seen_at) > self.max_entries:
+            self._seen_at.popitem(last=False)
+
+        # Keys are in the order they were last seen, so stop at the first one
+        # that's still in date.
+        while self._seen_at:
+            key, seen_at = next(iter(self._seen_at.items()))
+            if now - seen_at < self.ttl:
+                break
+            del self._seen_at[key]
@@ -1,93 +1,575 @@
 #!/usr/bin/env python3
 
 import datetime
+import functools
 import json
+import multiprocessing
 import os
-
-import boto3
+import signal
+import threading
+import time
 
 from collections import OrderedDict
 from enum import Enum
 
 import operating_companies
 import locations
-from logger import LOG
+import metrics
+import reference_data
+import rules
+import transport
+from acks import AckBatcher
+from catchup import CatchUp
+from consumer import ConcurrentConsumer
+from dedup import DedupCache, movement_key
+from journeys import CANCELLATION, MOVEMENT, JourneyTracker
+from logger import LOG, DropLogger, lazy
+from polling import PollingController
+from prefilter import HeaderPrefilter
+from sharded import ShardedProcessPool
+from shutdown import GracefulShutdown
+from sink import EligibleArrival, EligibleArrivalSink, SinkError
+from sources import FileSource, StompSource
+from visibility import VisibilityHeartbeat
 
 LOG_EVERY_N_MESSAGES = 10000
 
+# MESSAGE_SOURCE is one of "sqs" (from AWS_SQS_QUEUE_URL), "stomp" (straight
+# from the feed at STOMP_HOST) or "file" (from MESSAGE_FILE, by default
+# stdin). See sources.py
+DEFAULT_STOMP_PORT = 61618
+DEFAULT_STOMP_TOPIC = '/topic/TRAIN_MVT_ALL_TOC'
+
+# Received messages are kept invisible for as long as we're working on them
+# by a VisibilityHeartbeat, so VISIBILITY_TIMEOUT_SECONDS can be short: it's
+# how soon messages come back if we die. See visibility.py
+DEFAULT_VISIBILITY_TIMEOUT_SECONDS = 10
+DEFAULT_MAX_IN_FLIGHT_SECONDS = 15 * 60
+
+RECEIVE_PARAMS = {
+    'MaxNumberOfMessages': 10,
+    'VisibilityTimeout': int(os.environ.get(
+        'VISIBILITY_TIMEOUT_SECONDS', DEFAULT_VISIBILITY_TIMEOUT_SECONDS)),
+    'WaitTimeSeconds': 10,
+}
+
+# With ADAPTIVE_POLLING set, the wait time, visibility timeout and number of
+# receives in flight are tuned to the backlog, and how many consumers we'd
+# need to clear it in TARGET_DRAIN_SECONDS is published for the autoscaler.
+# See polling.py
+DEFAULT_TARGET_DRAIN_SECONDS = 10 * 60
+DEFAULT_MAX_CONSUMERS = 10
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+MILLISECONDS_PER_MINUTE = 60 * 1000
+
+# Setting WORKER_PROCESSES switches to the process pool, see sharded.py
+# Setting POLLER_THREADS switches to the concurrent consumer, see consumer.py
+DEFAULT_WORKER_THREADS = 4
+DEFAULT_MAX_PENDING_MESSAGES = 100
+
+# How often to check the reference data files for changes. They're also
+# reloaded on SIGHUP.
+REFERENCE_DATA_CHECK_SECONDS = 60
+
+# Metrics are logged every METRICS_DUMP_SECONDS, and served over HTTP on
+# localhost if METRICS_PORT is set. See metrics.py
+DEFAULT_METRICS_DUMP_SECONDS = 300
+
+# On SIGTERM or SIGINT, stop receiving and give in-flight messages this long
+# to finish. See shutdown.py
+DEFAULT_DRAIN_SECONDS = 20
+
+# If ELIGIBLE_ARRIVALS_DB is set, eligible arrivals are stored in that SQLite
+# database, and messages are only acked once that's done. See sink.py
+ELIGIBLE_ARRIVALS = None
+
+# Movements already handled, so SQS redeliveries can be acked straight away.
+# Turned off by DEDUP_MAX_ENTRIES=0, and kept across restarts in
+# DEDUP_CACHE_FILE if that's set. See dedup.py
+DEDUP = None
+DEFAULT_DEDUP_MAX_ENTRIES = 100000
+DEFAULT_DEDUP_TTL_SECONDS = 6 * 60 * 60
+
+# With CATCH_UP_MODE set, once we're more than CATCH_UP_AFTER_SECONDS behind
+# the feed, movements over STALE_AFTER_SECONDS old that can't be eligible are
+# acked without being processed (and appended to DIVERT_STALE_TO if that's
+# set) until we're back within CAUGHT_UP_SECONDS. Journeys tracked meanwhile
+# miss those movements. See catchup.py
+CATCH_UP = None
+DEFAULT_CATCH_UP_AFTER_SECONDS = 15 * 60
+DEFAULT_CAUGHT_UP_SECONDS = 2 * 60
+DEFAULT_STALE_AFTER_SECONDS = 30 * 60
+
+# With TRACK_JOURNEYS set, every movement and cancellation also updates the
+# state of its train's journey. With POLLER_THREADS, one train's movements can
+# be applied out of order, so its missed report count isn't reliable: use
+# WORKER_PROCESSES instead, which keeps them in order. See journeys.py
+DEFAULT_MAX_TRACKED_JOURNEYS = 100000
+
+if os.environ.get('TRACK_JOURNEYS'):
+    JOURNEYS = JourneyTracker(max_journeys=int(os.environ.get(
+        'MAX_TRACKED_JOURNEYS', DEFAULT_MAX_TRACKED_JOURNEYS)))
+else:
+    JOURNEYS = None
+
+# One of "all", "sample", "aggregate" or "none", see logger.DropLogger
+DROPS = DropLogger(LOG, mode=os.environ.get('LOG_DROPPED_MESSAGES', 'all'))
+
+# Only movements are processed, so reject everything else before decoding.
+# With PREFILTER_ARRIVALS_ONLY set, also reject anything the eligibility
+# rules' field rules rule out (by default, anything which isn't a late
+# arrival), as process_message would drop those too. That's ignored when
+# tracking journeys, which needs every movement (and cancellations).
+if JOURNEYS is not None:
+    PREFILTER = HeaderPrefilter(msg_types={MOVEMENT, CANCELLATION})
+elif os.environ.get('PREFILTER_ARRIVALS_ONLY'):
+    PREFILTER = HeaderPrefilter(
+        msg_types={MOVEMENT}, rules=rules.ELIGIBILITY_RULES)
+else:
+    PREFILTER = HeaderPrefilter(msg_types={MOVEMENT})
+
 
 def main():
-    queue = get_aws_queue(os.environ['AWS_SQS_QUEUE_URL'])
+    queue = open_message_source()
+    acks = AckBatcher(queue)
+    heartbeat = VisibilityHeartbeat(
+        queue,
+        timeout=RECEIVE_PARAMS['VisibilityTimeout'],
+        max_age=int(os.environ.get(
+            'MAX_IN_FLIGHT_SECONDS', DEFAULT_MAX_IN_FLIGHT_SECONDS)))
+    heartbeat.start()
+
+    if os.environ.get('ADAPTIVE_POLLING'):
+        controller = PollingController(
+            queue,
+            RECEIVE_PARAMS,
+            max_receives=int(os.environ.get('POLLER_THREADS', 1)),
+            target_drain_seconds=int(os.environ.get(
+                'TARGET_DRAIN_SECONDS', DEFAULT_TARGET_DRAIN_SECONDS)),
+            max_consumers=int(os.environ.get(
+                'MAX_CONSUMERS', DEFAULT_MAX_CONSUMERS)))
+    else:
+        controller = None
+
+    start_metrics()
+    if 'METRICS_PORT' in os.environ:
+        metrics.serve_http(int(os.environ['METRICS_PORT']))
+
+    if 'WORKER_PROCESSES' in os.environ:
+        # Workers load their own, and reload it on the SIGHUP we forward to
+        # them. Until they're started, don't let SIGHUP kill us.
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    else:
+        prepare_reference_data()
+        open_eligible_arrivals_sink()
+        open_dedup_cache()
+        open_catch_up()
+
+    shutdown = GracefulShutdown(
+        deadline=float(os.environ.get('DRAIN_SECONDS', DEFAULT_DRAIN_SECONDS)),
+        count_in_flight=lambda: len(heartbeat))
+    shutdown.install()
+
+    if isinstance(queue, FileSource):
+        # Finish once everything in the file has been handled
+        watcher = threading.Thread(target=lambda: (queue.exhausted.wait(),
+                                                   shutdown.request()))
+        watcher.daemon = True
+        watcher.start()
 
     try:
-        handle_queue(queue)
+        if 'WORKER_PROCESSES' in os.environ:
+            handle_queue_sharded(
+                queue,
+                acks,
+                heartbeat,
+                shutdown,
+                controller,
+                num_workers=int(os.environ['WORKER_PROCESSES']),
+                max_pending_per_worker=int(os.environ.get(
+                    'MAX_PENDING_MESSAGES', DEFAULT_MAX_PENDING_MESSAGES)))
+        elif 'POLLER_THREADS' in os.environ:
+            handle_queue_concurrently(
+                queue,
+                acks,
+                heartbeat,
+                shutdown,
+                controller,
+                num_pollers=int(os.environ['POLLER_THREADS']),
+                num_workers=int(os.environ.get(
+                    'WORKER_THREADS', DEFAULT_WORKER_THREADS)),
+                max_pending=int(os.environ.get(
+                    'MAX_PENDING_MESSAGES', DEFAULT_MAX_PENDING_MESSAGES)))
+        else:
+            handle_queue(queue, acks, heartbeat, shutdown, controller)
     except KeyboardInterrupt:
         LOG.info("Quitting.")
+    finally:
+        close_outputs()
+        pending_acks = len(acks)
+        acks.close()
+        heartbeat.stop()
+        released = heartbeat.release_all()
+        queue.close()
+
+        if shutdown.requested.is_set():
+            LOG.info('Drained in {:.1f}s: {} messages were in flight when '
+                     'asked to stop, {} pending acks flushed, {} messages '
+                     'released back to the queue'.format(
+                         shutdown.elapsed(), shutdown.in_flight_when_requested,
+                         pending_acks, released))
+
+
+def open_message_source():
+    source = os.environ.get('MESSAGE_SOURCE', 'sqs')
+
+    if source == 'sqs':
+        return get_aws_queue(os.environ['AWS_SQS_QUEUE_URL'])
+
+    elif source == 'stomp':
+        return StompSource(
+            os.environ['STOMP_HOST'],
+            int(os.environ.get('STOMP_PORT', DEFAULT_STOMP_PORT)),
+            os.environ.get('STOMP_TOPIC', DEFAULT_STOMP_TOPIC),
+            username=os.environ.get('STOMP_USERNAME'),
+            password=os.environ.get('STOMP_PASSWORD'),
+            client_id=os.environ.get('STOMP_CLIENT_ID'),
+        ).connect()
+
+    elif source == 'file':
+        return FileSource.open(os.environ.get('MESSAGE_FILE', '-'))
+
+    raise ValueError('Unknown MESSAGE_SOURCE `{}`'.format(source))
 
 
 def get_aws_queue(queue_url):
-    sqs = boto3.resource('sqs', 'eu-west-1')
-    return sqs.Queue(queue_url)
+    # One connection each for the pollers, the ack batcher and the visibility
+    # heartbeat, unless SQS_MAX_CONNECTIONS says otherwise
+    max_connections = int(os.environ.get(
+        'SQS_MAX_CONNECTIONS', int(os.environ.get('POLLER_THREADS', 1)) + 2))
+
+    client = transport.make_client(
+        'eu-west-1', max_pool_connections=max_connections)
+    return transport.SqsQueue(client, queue_url)
 
 
-def handle_queue(queue):
+def handle_queue(queue, acks, heartbeat=None, shutdown=None, controller=None):
     LOG.info("There are ~{} messages in the queue. Let's go!".format(
         queue.attributes['ApproximateNumberOfMessages']))
 
-    params = {
-         'MaxNumberOfMessages': 10,
-         'VisibilityTimeout': 10,
-         'WaitTimeSeconds': 10,
-     }
-
     count = 0
 
-    while True:
-        for sqs_message in queue.receive_messages(**params):
-            message = decode_sqs_message(sqs_message)
-            if process_message(message):
-                sqs_message.delete()
-            else:
-                LOG.info("Not sending ACK for this one")
+    while shutdown is None or not shutdown.requested.is_set():
+        params = (RECEIVE_PARAMS if controller is None
+                  else controller.receive_params())
+
+        with metrics.RECEIVE_SECONDS.time():
+            sqs_messages = queue.receive_messages(**params)
+
+        received_at = time.monotonic()
+        metrics.MESSAGES_RECEIVED.inc(len(sqs_messages))
+        if heartbeat is not None:
+            heartbeat.track(sqs_messages, timeout=params['VisibilityTimeout'])
+
+        if controller is not None:
+            controller.observe_receive(
+                len(sqs_messages), params['MaxNumberOfMessages'])
+
+        should_ack = []
+
+        for sqs_message in sqs_messages:
+            should_ack.append(handle_message_body(sqs_message.body))
 
             count += 1
             if count % LOG_EVERY_N_MESSAGES == 0:
-                LOG.info('Processed {} messages, ~{} messages in queue'.format(
-                    count, queue.attributes['ApproximateNumberOfMessages']))
+                LOG.info('Processed {} messages, {} eligible'.format(
+                    count, metrics.MESSAGES_ELIGIBLE.value))
+                LOG.info(str(PREFILTER.stats))
+                LOG.info('Rules: {}'.format(
+                    rules.ELIGIBILITY_RULES.current().summary()))
+                LOG.info('Dedup: {} hits, {} misses'.format(
+                    metrics.DEDUP_HITS.value, metrics.DEDUP_MISSES.value))
+                if JOURNEYS is not None:
+                    LOG.info('Tracking {} journeys'.format(len(JOURNEYS)))
+                if CATCH_UP is not None:
+                    LOG.info('{:.0f}s behind, {} messages shed'.format(
+                        CATCH_UP.lag or 0, CATCH_UP.shed_count))
+
+        # One commit for the whole batch's eligible arrivals
+        if not finish_handling():
+            should_ack = [False] * len(sqs_messages)
+
+        for sqs_message, ack in zip(sqs_messages, should_ack):
+            acknowledge(sqs_message, ack, acks)
+            if heartbeat is not None:
+                heartbeat.untrack(sqs_message)
+
+        if controller is not None:
+            controller.observe_handled(
+                len(sqs_messages), time.monotonic() - received_at)
+
+
+def handle_queue_concurrently(queue, acks, heartbeat, shutdown, controller,
+                              num_pollers, num_workers, max_pending):
+    LOG.info("There are ~{} messages in the queue. Starting {} pollers and "
+             "{} workers.".format(
+                 queue.attributes['ApproximateNumberOfMessages'],
+                 num_pollers, num_workers))
+
+    ConcurrentConsumer(
+        queue,
+        functools.partial(handle_sqs_message, acks=acks),
+        RECEIVE_PARAMS,
+        num_pollers=num_pollers,
+        num_workers=num_workers,
+        max_pending=max_pending,
+        log_every=LOG_EVERY_N_MESSAGES,
+        heartbeat=heartbeat,
+        controller=controller,
+    ).run(shutdown)
+
+
+def handle_queue_sharded(queue, acks, heartbeat, shutdown, controller,
+                         num_workers, max_pending_per_worker):
+    LOG.info("There are ~{} messages in the queue. Starting {} worker "
+             "processes.".format(
+                 queue.attributes['ApproximateNumberOfMessages'],
+                 num_workers))
+
+    pool = ShardedProcessPool(
+        queue,
+        acks,
+        handle_message_body,
+        RECEIVE_PARAMS,
+        num_shards=num_workers,
+        max_pending_per_shard=max_pending_per_worker,
+        initializer=prepare_worker_process,
+        sync=finish_handling,
+        finalizer=close_outputs,
+        heartbeat=heartbeat,
+        controller=controller,
+    )
+
+    signal.signal(signal.SIGHUP,
+                  lambda signum, frame: pool.send_signal(signum))
+
+    pool.run(shutdown)
+
+
+def prepare_worker_process():
+    # No MetricsDumper: our metrics are sent back to the receiving process
+    prepare_reference_data()
+    open_eligible_arrivals_sink()
+    open_dedup_cache(suffix=multiprocessing.current_process().name)
+    open_catch_up(suffix=multiprocessing.current_process().name)
+
+
+def open_eligible_arrivals_sink():
+    global ELIGIBLE_ARRIVALS
+
+    if 'ELIGIBLE_ARRIVALS_DB' in os.environ:
+        ELIGIBLE_ARRIVALS = EligibleArrivalSink(
+            os.environ['ELIGIBLE_ARRIVALS_DB'])
+
+
+def open_dedup_cache(suffix=None):
+    """
+    Sharded workers each keep their own cache (a train's movements always go
+    to the same worker), so they pass a `suffix` for their own file.
+    """
+    global DEDUP
+
+    max_entries = int(os.environ.get(
+        'DEDUP_MAX_ENTRIES', DEFAULT_DEDUP_MAX_ENTRIES))
+    if max_entries <= 0:
+        return
+
+    filename = os.environ.get('DEDUP_CACHE_FILE')
+    if filename and suffix:
+        filename = '{}.{}'.format(filename, suffix)
+
+    DEDUP = DedupCache(
+        max_entries=max_entries,
+        ttl=int(os.environ.get('DEDUP_TTL_SECONDS',
+                               DEFAULT_DEDUP_TTL_SECONDS)),
+        filename=filename or None)
+
+
+def open_catch_up(suffix=None):
+    global CATCH_UP
+
+    if not os.environ.get('CATCH_UP_MODE'):
+        return
+
+    divert_file = os.environ.get('DIVERT_STALE_TO')
+    if divert_file and suffix:
+        divert_file = '{}.{}'.format(divert_file, suffix)
+
+    CATCH_UP = CatchUp(
+        enter_lag=int(os.environ.get(
+            'CATCH_UP_AFTER_SECONDS', DEFAULT_CATCH_UP_AFTER_SECONDS)),
+        exit_lag=int(os.environ.get(
+            'CAUGHT_UP_SECONDS', DEFAULT_CAUGHT_UP_SECONDS)),
+        stale_after=int(os.environ.get(
+            'STALE_AFTER_SECONDS', DEFAULT_STALE_AFTER_SECONDS)),
+        divert_file=divert_file or None,
+        might_be_eligible=HeaderPrefilter(
+            msg_types=None, rules=rules.ELIGIBILITY_RULES).accepts)
+
+
+def close_outputs():
+    if ELIGIBLE_ARRIVALS is not None:
+        ELIGIBLE_ARRIVALS.close()
+
+    if DEDUP is not None:
+        DEDUP.close()
+
+    if CATCH_UP is not None:
+        CATCH_UP.close()
+
+
+def finish_handling():
+    """
+    Wait for the eligible arrivals this thread has found to be stored, then
+    remember the movements it handled as done. Returns False if storing
+    failed, in which case none of the messages handled since the last call
+    should be acked.
+    """
+    ok = True
+
+    if ELIGIBLE_ARRIVALS is not None:
+        try:
+            ELIGIBLE_ARRIVALS.sync()
+        except SinkError:
+            ok = False
+
+    if DEDUP is not None:
+        if ok:
+            DEDUP.commit()
+        else:
+            DEDUP.discard()
+
+    return ok
+
+
+def prepare_reference_data():
+    """
+    Load the reference data now rather than on the first message, then keep
+    it up to date as the files change or when we get a SIGHUP.
+    """
+    timings = reference_data.warm_up()
+
+    LOG.info('Reference data ready: {}'.format(', '.join(
+        '{} {:.3f}s'.format(name, seconds)
+        for name, seconds in timings.items())))
+
+    watcher = reference_data.ReloadWatcher(
+        interval=REFERENCE_DATA_CHECK_SECONDS).start()
+
+    signal.signal(signal.SIGHUP,
+                  lambda signum, frame: watcher.request_reload())
+
+
+def start_metrics():
+    metrics.MetricsDumper(interval=int(os.environ.get(
+        'METRICS_DUMP_SECONDS', DEFAULT_METRICS_DUMP_SECONDS))).start()
+
+
+def handle_message_body(body):
+    """
+    Returns True if the message should be acked.
+    """
+    if not PREFILTER.accepts(body):
+        metrics.MESSAGES_DROPPED_BY_HEADER.inc()
+        return True  # Effectively drop the message
+
+    if CATCH_UP is not None and CATCH_UP.sheds(body):
+        return True  # Stale, and we're behind
+
+    with metrics.DECODE_SECONDS.time():
+        message = decode_message_body(body)
+
+    key = movement_key(message) if DEDUP is not None else None
+
+    if key is not None and DEDUP.seen(key):
+        return True  # Already handled, SQS delivered it again
+
+    should_ack = process_message(message)
+
+    if should_ack and key is not None:
+        DEDUP.add_pending(key)
+
+    return should_ack
+
+
+def handle_sqs_message(sqs_message, acks):
+    should_ack = handle_message_body(sqs_message.body)
+
+    acknowledge(sqs_message, should_ack and finish_handling(), acks)
+
+
+def acknowledge(sqs_message, should_ack, acks):
+    if should_ack:
+        acks.add(sqs_message)
+    else:
+        LOG.info("Not sending ACK for this one")
 
 
 def decode_sqs_message(sqs_message):
-    return json.loads(sqs_message.body)  # TODO: something with ID?
+    return decode_message_body(sqs_message.body)  # TODO: something with ID?
+
+
+def decode_message_body(body):
+    return json.loads(body)
 
 
 def process_message(raw_message):
     header = raw_message['header']
 
+    if JOURNEYS is not None:
+        JOURNEYS.observe(header['msg_type'], raw_message['body'])
+
     if not validate_header(header):
+        metrics.MESSAGES_DROPPED_BY_HEADER.inc()
         return True  # Effectively drop the message
 
-    decoded = TrainMovementsMessage(raw_message['body'])
-
-    if (decoded.event_type == EventType.arrival and
-            decoded.status == VariationStatus.late and
-            decoded.location.is_public_station and
-            decoded.operating_company and
-            decoded.operating_company.is_delay_repay_eligible(
-                decoded.minutes_late)):
-
-        LOG.info('{} {} arrival at {} ({}) - eligible for '
-                 'compensation from {}: {}'.format(
-                     decoded.actual_datetime,
-                     decoded.early_late_description,
-                     decoded.location.name,
-                     decoded.location.three_alpha,
-                     decoded.operating_company,
-                     str(decoded)))
+    with metrics.DECIDE_SECONDS.time():
+        decoded = TrainMovementsMessage(raw_message['body'])
+
+        # See rules.py and eligibility_rules.json
+        eligible = rules.ELIGIBILITY_RULES.current().accepts(decoded)
+
+    if eligible:
+        metrics.MESSAGES_ELIGIBLE.inc()
+
+        if ELIGIBLE_ARRIVALS is not None:
+            ELIGIBLE_ARRIVALS.write(EligibleArrival(
+                train_id=decoded.train_id,
+                loc_stanox=decoded.location_stanox,
+                actual_timestamp=decoded.actual_timestamp,
+                planned_timestamp=decoded.planned_timestamp,
+                toc_id=decoded.operating_company.numeric_code,
+                minutes_late=decoded.minutes_late))
+
+        # str(decoded) and the datetime are left to the background log writer
+        LOG.info('%s %s arrival at %s (%s) - eligible for '
+                 'compensation from %s: %s',
+                 lazy(lambda: decoded.actual_datetime),
+                 decoded.early_late_description,
+                 decoded.location.name,
+                 decoded.location.three_alpha,
+                 decoded.operating_company,
+                 decoded)
 
     else:
-        LOG.debug('Dropping {} {} {} message'.format(
+        metrics.MESSAGES_DROPPED_INELIGIBLE.inc()
+
+        DROPS.dropped(
+            (decoded.status.name, decoded.event_type.name),
+            'Dropping %s %s %s message',
             decoded.status, decoded.event_type,
-            decoded.early_late_description))
+            lazy(lambda: decoded.early_late_description))
 
     return True
 
@@ -107,8 +589,9 @@ def validate_header(header):
     """
 
     if header['msg_type'] != '0003':
-        LOG.debug('Dropping unsupported message type `{}`'.format(
-            header['msg_type']))
+        DROPS.dropped(('msg_type', header['msg_type']),
+                      'Dropping unsupported message type `%s`',
+                      header['msg_type'])
         return False
 
     return True
@@ -141,12 +624,15 @@ class VariationStatus(Enum):
 
     @classmethod
     def get(cls, string):
-        return {
-            'ON TIME': VariationStatus.on_time,
-            'EARLY': VariationStatus.early,
-            'LATE': VariationStatus.late,
-            'OFF ROUTE': VariationStatus.off_route,
-        }[string]
+        return _VARIATION_STATUSES[string]
+
+
+_VARIATION_STATUSES = {
+    'ON TIME': VariationStatus.on_time,
+    'EARLY': VariationStatus.early,
+    'LATE': VariationStatus.late,
+    'OFF ROUTE': VariationStatus.off_route,
+}
 
 
 class EventType(Enum):
@@ -159,11 +645,38 @@ class EventType(Enum):
 
     @classmethod
     def get(cls, string):
-        return {
-            'ARRIVAL': EventType.arrival,
-            'DEPARTURE': EventType.departure,
-            'DESTINATION': EventType.destination,
-        }[string]
+        return _EVENT_TYPES[string]
+
+
+_EVENT_TYPES = {
+    'ARRIVAL': EventType.arrival,
+    'DEPARTURE': EventType.departure,
+    'DESTINATION': EventType.destination,
+}
+
+
+class memoized_property(object):
+    """
+    Like @property, but the getter only runs once per instance. The result
+    is stored in the slot of the same name with a leading underscore, which
+    the class must declare in `__slots__`.
+    """
+
+    def __init__(self, getter):
+        self.getter = getter
+        self.slot_name = '_' + getter.__name__
+        self.__doc__ = getter.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        try:
+            return getattr(instance, self.slot_name)
+        except AttributeError:  # slot not filled yet
+            value = self.getter(instance)
+            setattr(instance, self.slot_name, value)
+            return value
 
 
 class TrainMovementsMessage(object):
@@ -203,43 +716,76 @@ class TrainMovementsMessage(object):
         "train_service_code": "24745000"
     },
     ```
+
+    The fields needed to decide whether a message is interesting are decoded
+    up front; everything else is decoded the first time it's used and then
+    remembered. Timestamps are kept as integer milliseconds, and only turned
+    into (UTC) datetimes for display.
     """
 
+    __slots__ = (
+        'raw',
+        'event_type',
+        'status',
+        'operating_company',
+        '_planned_event_type',
+        '_planned_timestamp',
+        '_actual_timestamp',
+        '_planned_datetime',
+        '_actual_datetime',
+        '_planned_timetable_datetime',
+        '_location',
+        '_minutes_late',
+        '_early_late_description',
+    )
+
     def __init__(self, raw):
         self.raw = raw
+        self.event_type = EventType.get(raw['event_type'])
+        self.status = VariationStatus.get(raw['variation_status'])
+        self.operating_company = self._decode_operating_company(
+            raw['toc_id'])
+
         self._validate_assumptions()
 
     def _validate_assumptions(self):
-        assert self.division_code == self.operating_company
+        assert (self.raw['division_code'] == self.raw['toc_id'] or
+                self.division_code == self.operating_company)
 
     def __str__(self):
         return json.dumps(self.serialize(), indent=4, default=JsonSerializer)
 
-    @property
+    @memoized_property
     def planned_event_type(self):
         return EventType.get(self.raw['planned_event_type'])
 
-    @property
-    def event_type(self):
-        return EventType.get(self.raw['event_type'])
+    @memoized_property
+    def planned_timestamp(self):
+        """
+        Milliseconds since the epoch, or None
+        """
+        return self._decode_milliseconds(self.raw['planned_timestamp'])
 
-    @property
-    def status(self):
-        return VariationStatus.get(self.raw['variation_status'])
+    @memoized_property
+    def actual_timestamp(self):
+        """
+        Milliseconds since the epoch, or None
+        """
+        return self._decode_milliseconds(self.raw['actual_timestamp'])
 
-    @property
+    @memoized_property
     def planned_datetime(self):
-        return self._decode_timestamp(self.raw['planned_timestamp'])
+        return self._to_datetime(self.planned_timestamp)
 
-    @property
+    @memoized_property
     def actual_datetime(self):
-        return self._decode_timestamp(self.raw['actual_timestamp'])
+        return self._to_datetime(self.actual_timestamp)
 
-    @property
+    @memoized_property
     def planned_timetable_datetime(self):
         return self._decode_timestamp(self.raw['gbtt_timestamp'])
 
-    @property
+    @memoized_property
     def location(self):
         """
         The location on the rail network at which this event happened.
@@ -262,12 +808,6 @@ class TrainMovementsMessage(object):
         """
         return self._decode_boolean(self.raw['train_terminated'])
 
-    @property
-    def operating_company(self):
-        """
-        """
-        return self._decode_operating_company(self.raw['toc_id'])
-
     @property
     def division_code(self):
         """
@@ -427,15 +967,27 @@ class TrainMovementsMessage(object):
         raise NotImplementedError()
         # return self._decode_???(self.raw['train_file_address'])
 
-    @property
+    @memoized_property
     def minutes_late(self):
-        return int(
-            (self.actual_datetime - self.planned_datetime).total_seconds() / 60
-        )
+        """
+        Whole minutes, rounded towards zero (negative if early), or None if
+        it wasn't planned.
+        """
+        # Straight from the raw fields, as this is needed for every arrival
+        actual = self._decode_milliseconds(self.raw['actual_timestamp'])
+        planned = self._decode_milliseconds(self.raw['planned_timestamp'])
+        if actual is None or planned is None:
+            return None
 
-    @property
+        milliseconds = actual - planned
+
+        if milliseconds >= 0:
+            return milliseconds // MILLISECONDS_PER_MINUTE
+        return -(-milliseconds // MILLISECONDS_PER_MINUTE)
+
+    @memoized_property
     def early_late_description(self):
-        if not self.actual_datetime or not self.planned_datetime:
+        if self.actual_timestamp is None or self.planned_timestamp is None:
             return '[unknown]'
 
         if self.status is VariationStatus.late:
@@ -474,8 +1026,10 @@ class TrainMovementsMessage(object):
     @staticmethod
     def _decode_stanox(stanox):
         try:
-            return locations.from_stanox(stanox)
-        except locations.LookupFailure:
+            with metrics.LOOKUP_SECONDS.time():
+                return locations.from_stanox(stanox)
+        except locations.LookupError:
+            metrics.LOOKUP_FAILURES.inc()
             LOG.error('Failed to look up STANOX {}.'.format(stanox))
 
     @staticmethod
@@ -486,10 +1040,15 @@ class TrainMovementsMessage(object):
         if numeric_code == '00':
             return None
 
-        return operating_companies.from_numeric_code(int(numeric_code))
+        with metrics.LOOKUP_SECONDS.time():
+            return operating_companies.from_numeric_code(int(numeric_code))
+
+    @classmethod
+    def _decode_timestamp(cls, string):
+        return cls._to_datetime(cls._decode_milliseconds(string))
 
     @staticmethod
-    def _decode_timestamp(string):
+    def _decode_milliseconds(string):
         """
         Timestamp appears to be in milliseconds:
         `1455887700000` : Tue, 31 Mar in the year 48105.
@@ -500,10 +1059,21 @@ class TrainMovementsMessage(object):
             return None
 
         try:
-            return datetime.datetime.fromtimestamp(int(string) / 1000)
+            return int(string)
         except ValueError as e:
             raise ValueError('Choked on `{}`: {}'.format(string, repr(e)))
 
+    @staticmethod
+    def _to_datetime(milliseconds):
+        """
+        Timezone-aware UTC datetime, for display. Don't use these for
+        arithmetic, work with the milliseconds instead.
+        """
+        if milliseconds is None:
+            return None
+
+        return EPOCH + datetime.timedelta(milliseconds=milliseconds)
+
 
 if __name__ == '__main__':
     main()
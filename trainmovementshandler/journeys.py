@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+"""
+In-memory state of every train we've seen recently, built up from TRUST
+movement (0003) and cancellation (0002) messages.
+
+Each message is looked at on its own elsewhere, but whether a train missed a
+stop, terminated short of its destination or was cancelled only shows up
+across its journey. `JourneyTracker` keeps a small `Journey` record per
+train ID with its last few movements, updated in O(1) per message:
+
+```
+tracker = JourneyTracker()
+journey = tracker.observe(header['msg_type'], body)
+if journey is not None and journey.terminated_early:
+    ...
+```
+
+Memory is bounded: at most `max_journeys` are kept (the least recently
+updated go first), journeys are dropped `idle_seconds` after their last
+message, and finished (terminated or cancelled) ones `finished_seconds` after
+they finished.
+
+Journeys are keyed on the `train_id` from activation. When a train's identity
+changes (`current_train_id`), later messages under the new ID update the same
+journey.
+
+A tracker can be shared between threads. Each message is applied under a
+lock, but the missed report count relies on a train's movements arriving in
+order: with several threads receiving at once (POLLER_THREADS), two of them
+can be applied in the opposite order to the one they were reported in, so
+`missed_report_count` is only a rough guide there. The sharded pool
+(WORKER_PROCESSES) keeps each train's movements on one worker, in order.
+"""
+
+import threading
+import time
+
+from collections import OrderedDict, deque
+
+MOVEMENT = '0003'
+CANCELLATION = '0002'
+
+
+class Movement(object):
+    __slots__ = ('stanox', 'event_type', 'planned_timestamp',
+                 'actual_timestamp', 'variation_status', 'timetable_variation')
+
+    def __init__(self, stanox, event_type, planned_timestamp,
+                 actual_timestamp, variation_status, timetable_variation):
+        self.stanox = stanox
+        self.event_type = event_type
+        self.planned_timestamp = planned_timestamp  # ms since epoch, or None
+        self.actual_timestamp = actual_timestamp
+        self.variation_status = variation_status
+        self.timetable_variation = timetable_variation  # minutes
+
+    def __repr__(self):
+        return '<Movement {} {} {} {}>'.format(
+            self.event_type, self.stanox, self.variation_status,
+            self.timetable_variation)
+
+
+class Journey(object):
+    __slots__ = (
+        'train_id', 'current_train_id', 'toc_id', 'movements',
+        'movement_count', 'correction_count', 'missed_report_count',
+        'expected_next_stanox', 'terminated', 'terminated_early',
+        'cancelled', 'cancellation_type', 'cancellation_reason',
+        'updated_at', 'finished_at',
+    )
+
+    def __init__(self, train_id, recent_movements):
+        self.train_id = train_id
+        self.current_train_id = None
+        self.toc_id = None
+        self.movements = deque(maxlen=recent_movements)  # most recent last
+        self.movement_count = 0
+        self.correction_count = 0
+
+        # Times a movement came from somewhere other than the previous one's
+        # `next_report_stanox`, ie. a reporting point was skipped.
+        self.missed_report_count = 0
+        self.expected_next_stanox = None
+
+        self.terminated = False
+
+        # Terminated somewhere that wasn't planned as its destination
+        self.terminated_early = False
+
+        self.cancelled = False
+        self.cancellation_type = None  # eg. "AT ORIGIN", "EN ROUTE"
+        self.cancellation_reason = None
+
+        self.updated_at = None
+        self.finished_at = None
+
+    def __repr__(self):
+        return '<Journey {} {} movements{}{}>'.format(
+            self.train_id, self.movement_count,
+            ', terminated' if self.terminated else '',
+            ', cancelled' if self.cancelled else '')
+
+    @property
+    def last_movement(self):
+        return self.movements[-1] if self.movements else None
+
+    @property
+    def is_finished(self):
+        return self.finished_at is not None
+
+
+class JourneyTracker(object):
+    def __init__(self, max_journeys=100000, idle_seconds=6 * 60 * 60,
+                 finished_seconds=30 * 60, recent_movements=8,
+                 clock=time.monotonic):
+        self.max_journeys = max_journeys
+        self.idle_seconds = idle_seconds
+        self.finished_seconds = finished_seconds
+        self.recent_movements = recent_movements
+        self.clock = clock
+
+        # train_id -> Journey, least recently updated first
+        self._journeys = OrderedDict()
+
+        # train_id -> Journey, in the order they finished
+        self._finished = OrderedDict()
+
+        # current_train_id -> train_id
+        self._aliases = {}
+
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._journeys)
+
+    def __contains__(self, train_id):
+        return self.get(train_id) is not None
+
+    def get(self, train_id):
+        with self._lock:
+            train_id = self._aliases.get(train_id, train_id)
+            return self._journeys.get(train_id)
+
+    def observe(self, msg_type, body):
+        """
+        Update from a decoded TRUST message body. Returns the updated
+        `Journey`, or None for message types that aren't tracked.
+        """
+        if msg_type == MOVEMENT:
+            return self.movement(body)
+        elif msg_type == CANCELLATION:
+            return self.cancellation(body)
+        return None
+
+    def movement(self, body):
+        with self._lock:
+            return self._movement(body)
+
+    def cancellation(self, body):
+        with self._lock:
+            return self._cancellation(body)
+
+    def _movement(self, body):
+        now = self.clock()
+        journey = self._journey_for(body['train_id'], now)
+
+        current_train_id = body.get('current_train_id')
+        if current_train_id and current_train_id != journey.train_id:
+            self._set_alias(journey, current_train_id)
+
+        if body.get('toc_id'):
+            journey.toc_id = body['toc_id']
+
+        movement = Movement(
+            stanox=body['loc_stanox'],
+            event_type=body['event_type'],
+            planned_timestamp=_timestamp(body.get('planned_timestamp')),
+            actual_timestamp=_timestamp(body['actual_timestamp']),
+            variation_status=body.get('variation_status'),
+            timetable_variation=int(body.get('timetable_variation') or 0))
+
+        if body.get('correction_ind') == 'true':
+            journey.correction_count += 1
+            self._amend(journey, movement)
+        else:
+            if (journey.expected_next_stanox and
+                    movement.stanox != journey.expected_next_stanox):
+                journey.missed_report_count += 1
+
+            journey.movements.append(movement)
+            journey.movement_count += 1
+
+        journey.expected_next_stanox = body.get('next_report_stanox') or None
+
+        if body.get('train_terminated') == 'true' and not journey.terminated:
+            journey.terminated = True
+            journey.terminated_early = (
+                body.get('planned_event_type') != 'DESTINATION')
+            self._finish(journey, now)
+
+        self._evict(now)
+        return journey
+
+    def _cancellation(self, body):
+        now = self.clock()
+        journey = self._journey_for(body['train_id'], now)
+
+        journey.cancelled = True
+        journey.cancellation_type = body.get('canx_type')
+        journey.cancellation_reason = body.get('canx_reason_code')
+
+        if body.get('toc_id'):
+            journey.toc_id = body['toc_id']
+
+        self._finish(journey, now)
+        self._evict(now)
+        return journey
+
+    def _journey_for(self, train_id, now):
+        train_id = self._aliases.get(train_id, train_id)
+        journey = self._journeys.get(train_id)
+
+        if journey is None:
+            journey = Journey(train_id, self.recent_movements)
+            self._journeys[train_id] = journey
+        else:
+            self._journeys.move_to_end(train_id)
+
+        journey.updated_at = now
+        return journey
+
+    def _set_alias(self, journey, current_train_id):
+        if journey.current_train_id is not None:
+            self._aliases.pop(journey.current_train_id, None)
+
+        journey.current_train_id = current_train_id
+        self._aliases[current_train_id] = journey.train_id
+
+    @staticmethod
+    def _amend(journey, movement):
+        """
+        A correction replaces the most recent movement of the same type at the
+        same location, if it's one we still have.
+        """
+        for i in range(len(journey.movements) - 1, -1, -1):
+            previous = journey.movements[i]
+            if (previous.stanox == movement.stanox and
+                    previous.event_type == movement.event_type):
+                journey.movements[i] = movement
+                return
+
+        journey.movements.append(movement)
+        journey.movement_count += 1
+
+    def _finish(self, journey, now):
+        # A cancelled train can still report movements (and then terminate),
+        # so this can happen more than once. It counts from the latest.
+        journey.finished_at = now
+        self._finished[journey.train_id] = journey
+        self._finished.move_to_end(journey.train_id)
+
+    def _evict(self, now):
+        while len(self._journeys) > self.max_journeys:
+            self._remove(next(iter(self._journeys.values())))
+
+        while self._journeys:
+            journey = next(iter(self._journeys.values()))
+            if now - journey.updated_at < self.idle_seconds:
+                break
+            self._remove(journey)
+
+        while self._finished:
+            journey = next(iter(self._finished.values()))
+            if now - journey.finished_at < self.finished_seconds:
+                break
+            self._remove(journey)
+
+    def _remove(self, journey):
+        self._journeys.pop(journey.train_id, None)
+        self._finished.pop(journey.train_id, None)
+
+        if journey.current_train_id is not None:
+            self._aliases.pop(journey.current_train_id, None)
+
+
+def _timestamp(string):
+    return int(string) if string else None
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+"""
+A compact binary index of locations, read through mmap.
+
+Loading the CORPUS and NAPTAN JSON takes seconds and tens of megabytes in
+every process. The index is built from them offline (see
+`build_location_index.py`) and mapped read-only, so start up is just an
+`open` and processes share the same pages through the page cache.
+
+Layout, all little-endian:
+
+```
+header:   magic (8 bytes), record count (uint32), string table offset (uint32)
+records:  one fixed-width RECORD_FORMAT per location, sorted by STANOX
+strings:  UTF-8 descriptions and station names, referenced by offset/length
+```
+
+A station name length of 0xFFFF means there's no NAPTAN record, ie. it isn't
+a public station.
+"""
+
+import mmap
+import os
+import struct
+
+MAGIC = b'TMHLOC01'
+
+HEADER_FORMAT = struct.Struct('<8sII')
+
+# STANOX, TIPLOC, UIC, NLC, 3ALPHA, NLCDESC (offset, length),
+# NAPTAN StationName (offset, length)
+RECORD_FORMAT = struct.Struct('<5s7s5s6s3sIHIH')
+
+STANOX_WIDTH = 5
+NO_STATION_NAME = 0xFFFF
+
+
+class IndexFormatError(ValueError):
+    pass
+
+
+def write_index(filename, records):
+    """
+    Write an index of `(corpus_record, naptan_record)` pairs, where
+    `naptan_record` may be None. The pairs must have unique STANOX codes.
+    """
+    records = sorted(records, key=lambda pair: pair[0]['STANOX'].strip())
+    strings = bytearray()
+
+    def add_string(string):
+        encoded = string.encode('utf-8')
+        offset = len(strings)
+        strings.extend(encoded)
+        return offset, len(encoded)
+
+    packed = []
+    for corpus_record, naptan_record in records:
+        description_offset, description_length = add_string(
+            corpus_record['NLCDESC'])
+
+        if naptan_record is None:
+            name_offset, name_length = 0, NO_STATION_NAME
+        else:
+            name_offset, name_length = add_string(naptan_record['StationName'])
+
+        packed.append(RECORD_FORMAT.pack(
+            _fixed(corpus_record, 'STANOX', 5),
+            _fixed(corpus_record, 'TIPLOC', 7),
+            _fixed(corpus_record, 'UIC', 5),
+            _fixed(corpus_record, 'NLC', 6),
+            _fixed(corpus_record, '3ALPHA', 3),
+            description_offset, description_length,
+            name_offset, name_length))
+
+    strings_offset = HEADER_FORMAT.size + RECORD_FORMAT.size * len(packed)
+
+    # Running processes have the index mapped, and rewriting it in place
+    # would change (or, if it got shorter, remove) the pages under them. A
+    # new file replacing it leaves them with the old one until they reload.
+    temporary_filename = '{}.tmp'.format(filename)
+
+    with open(temporary_filename, 'wb') as f:
+        f.write(HEADER_FORMAT.pack(MAGIC, len(packed), strings_offset))
+        f.write(b''.join(packed))
+        f.write(bytes(strings))
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(temporary_filename, filename)
+
+
+def _fixed(record, field, width):
+    encoded = record[field].strip().encode('ascii')
+    if len(encoded) > width:
+        raise IndexFormatError('{} `{}` is longer than {} characters'.format(
+            field, record[field], width))
+    return encoded
+
+
+class LocationIndex(object):
+    """
+    Read-only mapping of STANOX code to location, backed by an index file.
+
+    `factory(corpus_record, naptan_record)` builds the value returned for a
+    STANOX code, from records containing the fields in the index. Values are
+    built on first lookup and then cached.
+    """
+
+    def __init__(self, filename, factory):
+        self.factory = factory
+        self._cache = {}
+
+        with open(filename, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self._count, self._strings_offset = HEADER_FORMAT.unpack_from(
+            self._mmap, 0)
+
+        if magic != MAGIC:
+            raise IndexFormatError('{} is not a location index'.format(
+                filename))
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for i in range(self._count):
+            offset = HEADER_FORMAT.size + i * RECORD_FORMAT.size
+            yield _unpad(self._mmap[offset:offset + STANOX_WIDTH])
+
+    def __contains__(self, stanox):
+        try:
+            self[stanox]
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, stanox):
+        try:
+            return self._cache[stanox]
+        except KeyError:
+            pass
+
+        value = self.factory(*self._read_records(self._find(stanox)))
+        self._cache[stanox] = value
+        return value
+
+    def get(self, stanox, default=None):
+        try:
+            return self[stanox]
+        except KeyError:
+            return default
+
+    def public_stations(self):
+        """
+        The STANOX codes of the public stations, straight from the records
+        rather than building (and caching) a value for every one.
+        """
+        for i in range(self._count):
+            offset = HEADER_FORMAT.size + i * RECORD_FORMAT.size
+            name_length = RECORD_FORMAT.unpack_from(self._mmap, offset)[-1]
+
+            if name_length != NO_STATION_NAME:
+                yield _unpad(self._mmap[offset:offset + STANOX_WIDTH])
+
+    def _find(self, stanox):
+        key = stanox.encode('ascii', 'replace').ljust(STANOX_WIDTH, b'\0')
+        lo, hi = 0, self._count
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = HEADER_FORMAT.size + mid * RECORD_FORMAT.size
+            found = self._mmap[offset:offset + STANOX_WIDTH]
+
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                return offset
+
+        raise KeyError(stanox)
+
+    def _read_records(self, offset):
+        (stanox, tiploc, uic, nlc, three_alpha,
+         description_offset, description_length,
+         name_offset, name_length) = RECORD_FORMAT.unpack_from(
+             self._mmap, offset)
+
+        corpus_record = {
+            'STANOX': _unpad(stanox),
+            'TIPLOC': _unpad(tiploc),
+            'UIC': _unpad(uic),
+            'NLC': _unpad(nlc),
+            '3ALPHA': _unpad(three_alpha),
+            'NLCDESC': self._string(description_offset, description_length),
+        }
+
+        if name_length == NO_STATION_NAME:
+            naptan_record = None
+        else:
+            naptan_record = {
+                'CrsCode': corpus_record['3ALPHA'],
+                'StationName': self._string(name_offset, name_length),
+            }
+
+        return corpus_record, naptan_record
+
+    def _string(self, offset, length):
+        start = self._strings_offset + offset
+        return self._mmap[start:start + length].decode('utf-8')
+
+
+def _unpad(field):
+    return field.rstrip(b'\0').decode('ascii')
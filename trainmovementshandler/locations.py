@@ -40,11 +40,18 @@ by joining on the "three alpha" code. It looks like this:
 """
 
 import json
-import re
+import logging
+import os
 
 from collections import OrderedDict
 from os.path import dirname, join as pjoin
 
+import reference_data
+
+from location_index import LocationIndex
+
+LOG = logging.getLogger(__name__)
+
 CORPUS_FILENAME = pjoin(
     dirname(__file__), 'uk-train-data', 'db', 'network_rail_corpus.json'
 )
@@ -53,6 +60,11 @@ NAPTAN_FILENAME = pjoin(
     dirname(__file__), 'uk-train-data', 'db', 'naptan_rail_locations.json'
 )
 
+# Built from the two files above by build_location_index.py
+INDEX_FILENAME = pjoin(dirname(__file__), 'locations.idx')
+
+RAIL_STATION_SUFFIX = ' Rail Station'
+
 
 class LookupError(KeyError):
     pass
@@ -62,8 +74,29 @@ class Location(object):
     """
     Reference data:
     http://nrodwiki.rockshore.net/index.php/Reference_Data
+
+    The reference data doesn't change while we're running, so everything is
+    worked out once when the location is loaded. Locations are immutable.
+
+    - `name`: http://nrodwiki.rockshore.net/index.php/NLC
+    - `tiploc_code`: http://nrodwiki.rockshore.net/index.php/TIPLOC
+    - `national_location_code`: http://nrodwiki.rockshore.net/index.php/NLC
+    - `three_alpha`: A 3-character code used for stations. Previously referred
+      to as CRS (Computer Reservation System) or NRS (National Reservation
+      System) codes. eg: 'KET' (Kettering)
     """
 
+    __slots__ = (
+        'name',
+        'tiploc_code',
+        'uic_code',
+        'national_location_code',
+        'stanox_code',
+        'three_alpha',
+        'is_public_station',
+        '_serialized',
+    )
+
     def __init__(self, corpus_record, naptan_record):
         """
         ```
@@ -79,65 +112,40 @@ class Location(object):
 
         ```
         """
-
-        self.corpus_record = corpus_record
-        self.naptan_record = naptan_record
-
-    @property
-    def name(self):
-        """
-        http://nrodwiki.rockshore.net/index.php/NLC
-        """
-        if self.naptan_record is not None:
-            return self.strip_trailing_rail_station(
-                self.naptan_record['StationName'])
+        if naptan_record is not None:
+            name = self.strip_trailing_rail_station(
+                naptan_record['StationName'])
         else:
-            return self.corpus_record['NLCDESC']
-
-    @property
-    def tiploc_code(self):
-        """
-        http://nrodwiki.rockshore.net/index.php/TIPLOC
-        """
-        return self._strip(self.corpus_record['TIPLOC'])
+            name = corpus_record['NLCDESC']
 
-    @property
-    def timing_point_location(self):
-        return self._strip(self.tiploc)
+        fields = [
+            ('name', name),
+            ('tiploc_code', self._strip(corpus_record['TIPLOC'])),
+            ('uic_code', self._strip(corpus_record['UIC'])),
+            ('national_location_code', self._strip(corpus_record['NLC'])),
+            ('stanox_code', self._strip(corpus_record['STANOX'])),
+            ('three_alpha', self._strip(corpus_record['3ALPHA'])),
+            ('is_public_station', naptan_record is not None),
+        ]
 
-    @property
-    def uic_code(self):
-        return self._strip(self.corpus_record['UIC'])
+        for field_name, value in fields:
+            object.__setattr__(self, field_name, value)
 
-    @property
-    def national_location_code(self):
-        """
-        http://nrodwiki.rockshore.net/index.php/NLC
-        """
-        return self._strip(self.corpus_record['NLC'])
+        object.__setattr__(self, '_serialized', tuple(
+            (field_name, getattr(self, field_name)) for field_name in [
+                'name', 'stanox_code', 'three_alpha', 'is_public_station']))
 
-    @property
-    def stanox_code(self):
-        return self._strip(self.corpus_record['STANOX'])
+    def __setattr__(self, name, value):
+        raise AttributeError('Location is immutable')
 
     @property
-    def three_alpha(self):
-        """
-        A 3-character code used for stations. Previously referred to as CRS
-        (Computer Reservation System) or NRS (National Reservation System)
-        codes.
-        eg: 'KET' (Kettering)
-        """
-        return self._strip(self.corpus_record['3ALPHA'])
+    def timing_point_location(self):
+        return self.tiploc_code
 
     @property
     def crs_code(self):
         return self.three_alpha
 
-    @property
-    def is_public_station(self):
-        return self.naptan_record is not None
-
     def __str__(self):
         return self.name
 
@@ -145,12 +153,7 @@ class Location(object):
         return 'Location("{}")'.format(self.name)
 
     def serialize(self):
-        return OrderedDict([
-            ('name', self.name),
-            ("stanox_code", self.stanox_code),
-            ("three_alpha", self.three_alpha),
-            ('is_public_station', self.is_public_station),
-        ])
+        return OrderedDict(self._serialized)
 
     @staticmethod
     def _strip(string):
@@ -159,26 +162,83 @@ class Location(object):
 
     @staticmethod
     def strip_trailing_rail_station(string):
-        return re.sub('(.*) Rail Station$', r'\1', string)
+        """
+        eg. "Liverpool Lime Street Rail Station" -> "Liverpool Lime Street"
+        """
+        if string.endswith(RAIL_STATION_SUFFIX):
+            return string[:-len(RAIL_STATION_SUFFIX)]
+        return string
+
+
+def read_json_records():
+    """
+    Join the CORPUS and NAPTAN data, returning a dictionary of STANOX code to
+    `(corpus_record, naptan_record)`. `naptan_record` is None for locations
+    which aren't public stations.
+    """
+    with open(NAPTAN_FILENAME, 'r') as f:
+        naptan_lookup = {record['CrsCode']: record for record in json.load(f)}
+
+    with open(CORPUS_FILENAME, 'r') as f:
+        def filter_empty_stanox(record):
+            return record['STANOX'].strip() != ''
 
+        return {
+            record['STANOX'].strip(): (
+                record, naptan_lookup.get(record['3ALPHA']))
+            for record in filter(
+                filter_empty_stanox, json.load(f)['TIPLOCDATA'])
+        }
 
-with open(NAPTAN_FILENAME, 'r') as f:
-    NAPTAN_LOOKUP = {record['CrsCode']: record for record in json.load(f)}
 
+def _index_is_fresh():
+    if not os.path.exists(INDEX_FILENAME):
+        return False
 
-with open(CORPUS_FILENAME, 'r') as f:
-    def filter_empty_stanox(record):
-        return record['STANOX'].strip() != ''
+    index_mtime = os.path.getmtime(INDEX_FILENAME)
+
+    if any(os.path.getmtime(fn) > index_mtime
+           for fn in (CORPUS_FILENAME, NAPTAN_FILENAME)
+           if os.path.exists(fn)):
+        LOG.warning('{} is older than the reference data, ignoring it. '
+                    'Rebuild it with build_location_index.py'.format(
+                        INDEX_FILENAME))
+        return False
+
+    return True
+
+
+def _load_stanox_lookup():
+    if _index_is_fresh():
+        return LocationIndex(INDEX_FILENAME, Location)
+
+    return {
+        stanox: Location(corpus_record, naptan_record)
+        for stanox, (corpus_record, naptan_record)
+        in read_json_records().items()
+    }
+
+
+STANOX_LOOKUP = reference_data.register(
+    'locations', _load_stanox_lookup,
+    source_filenames=[CORPUS_FILENAME, NAPTAN_FILENAME, INDEX_FILENAME])
+
+
+def public_station_stanoxes():
+    """
+    The STANOX codes of every public station.
+    """
+    stanox_lookup = STANOX_LOOKUP.current()
 
-    LOCATIONS = [Location(record, NAPTAN_LOOKUP.get(record['3ALPHA']))
-                 for record in filter(
-                     filter_empty_stanox, json.load(f)['TIPLOCDATA'])]
+    if isinstance(stanox_lookup, LocationIndex):
+        return list(stanox_lookup.public_stations())
 
-    STANOX_LOOKUP = {loc.stanox_code: loc for loc in LOCATIONS}
+    return [stanox for stanox, location in stanox_lookup.items()
+            if location.is_public_station]
 
 
 def from_stanox(stanox):
     try:
-        return STANOX_LOOKUP[stanox]
+        return STANOX_LOOKUP.current()[stanox]
     except KeyError:
         raise LookupError('No location found for STANOX {}'.format(stanox))
@@ -1,8 +1,14 @@
 import logging
 import logging.handlers
+import os
+import queue
 import sys
+import threading
+import time
 
-__all__ = ['LOG']
+from collections import Counter
+
+__all__ = ['LOG', 'DropLogger', 'lazy']
 
 DEBUG_LOG_FILENAME = '/var/log/train-movements-handler/debug.log'
 INFO_LOG_FILENAME = '/var/log/train-movements-handler/info.log'
@@ -20,13 +26,7 @@ sh = logging.StreamHandler(sys.stdout)
 sh.setLevel(logging.INFO)
 sh.setFormatter(formatter)
 
-# set up logging to a file for all levels DEBUG and higher
-fh = logging.handlers.RotatingFileHandler(
-    DEBUG_LOG_FILENAME, maxBytes=TEN_MEGABYTES, backupCount=10)
-fh.setLevel(logging.DEBUG)
-fh.setFormatter(formatter)
-
-# set up logging to a file for all levels DEBUG and higher
+# set up logging to a file for all levels INFO and higher
 fh = logging.handlers.RotatingFileHandler(
     INFO_LOG_FILENAME, maxBytes=TEN_MEGABYTES, backupCount=10)
 fh.setLevel(logging.INFO)
@@ -38,12 +38,163 @@ fh2 = logging.handlers.RotatingFileHandler(
 fh2.setLevel(logging.WARN)
 fh2.setFormatter(formatter)
 
+HANDLERS = [sh, fh, fh2]
+
+# set up logging to a file for all levels DEBUG and higher, if asked for
+if os.environ.get('LOG_DEBUG_FILE'):
+    dfh = logging.handlers.RotatingFileHandler(
+        DEBUG_LOG_FILENAME, maxBytes=TEN_MEGABYTES, backupCount=10)
+    dfh.setLevel(logging.DEBUG)
+    dfh.setFormatter(formatter)
+    HANDLERS.append(dfh)
+
 logging.getLogger("boto3").setLevel(logging.WARNING)
 logging.getLogger("botocore").setLevel(logging.WARNING)
 
-# create Logger object
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on a queue for `BACKGROUND_WRITER` to format and write, so
+    the thread that logged doesn't wait for any I/O.
+
+    Unlike the stock QueueHandler, the record isn't formatted before it's
+    queued: the queue never leaves this process, so formatting (including any
+    `lazy` arguments) can be left to the background thread too.
+
+    Closing the handler, which `logging.shutdown()` does, writes out anything
+    still queued.
+    """
+
+    def __init__(self, queue, writer):
+        super(BackgroundQueueHandler, self).__init__(queue)
+        self.writer = writer
+
+    def prepare(self, record):
+        return record
+
+    def close(self):
+        self.writer.stop()
+        super(BackgroundQueueHandler, self).close()
+
+
+class BackgroundWriter(object):
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.queue_handler = BackgroundQueueHandler(queue.SimpleQueue(), self)
+        self._listener = None
+
+    def start(self):
+        self._listener = logging.handlers.QueueListener(
+            self.queue_handler.queue, *self.handlers,
+            respect_handler_level=True)
+        self._listener.start()
+
+    def stop(self):
+        """
+        Write out everything logged so far and stop the background thread.
+        """
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+    def _restart_after_fork(self):
+        # The writer thread doesn't survive a fork, so the child needs its
+        # own (with a fresh queue, in case the fork caught the old one
+        # mid-operation).
+        self.queue_handler.queue = queue.SimpleQueue()
+        self.start()
+
+
+BACKGROUND_WRITER = BackgroundWriter(HANDLERS)
+BACKGROUND_WRITER.start()
+os.register_at_fork(after_in_child=BACKGROUND_WRITER._restart_after_fork)
+
+# create Logger object. Its level is the lowest any handler will write, so
+# that disabled `LOG.debug` calls return straight away.
 LOG = logging.getLogger('')
-LOG.setLevel(logging.DEBUG)
-LOG.addHandler(sh)
-LOG.addHandler(fh)
-LOG.addHandler(fh2)
+LOG.setLevel(min(handler.level for handler in HANDLERS))
+LOG.addHandler(BACKGROUND_WRITER.queue_handler)
+
+
+class lazy(object):
+    """
+    Log argument which isn't worked out unless the message is written, eg:
+
+    ```
+    LOG.debug('Dropping %s message', lazy(lambda: expensive(message)))
+    ```
+    """
+
+    __slots__ = ('func',)
+
+    def __init__(self, func):
+        self.func = func
+
+    def __str__(self):
+        return str(self.func())
+
+
+class DropLogger(object):
+    """
+    Logs that a message was dropped, according to `mode`:
+
+    - "all": one DEBUG line per dropped message
+    - "sample": one INFO line for every `sample_every` dropped messages
+    - "aggregate": count drops by reason and log the counts at INFO every
+      `interval` seconds
+    - "none": nothing
+
+    The reduced modes log at INFO, as they're meant to be read without turning
+    on DEBUG logging.
+    """
+
+    MODES = ('all', 'sample', 'aggregate', 'none')
+
+    def __init__(self, logger, mode='all', sample_every=1000, interval=60):
+        if mode not in self.MODES:
+            raise ValueError('Unknown drop logging mode `{}`, expected one '
+                             'of {}'.format(mode, ', '.join(self.MODES)))
+
+        self.logger = logger
+        self.mode = mode
+        self.sample_every = sample_every
+        self.interval = interval
+
+        self._count = 0
+        self._counts = Counter()
+        self._last_summary = time.monotonic()
+        self._lock = threading.Lock()
+
+    def dropped(self, reason, msg, *args):
+        """
+        `reason` is a short hashable key for aggregating, `msg` and `args`
+        are as for `logger.debug`.
+        """
+        if self.mode == 'all':
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(msg, *args)
+
+        elif self.mode == 'sample':
+            with self._lock:
+                self._count += 1
+                due = self._count % self.sample_every == 0
+
+            if due:
+                self.logger.info(msg + ' (1 in %d drops logged)',
+                                 *(args + (self.sample_every,)))
+
+        elif self.mode == 'aggregate':
+            with self._lock:
+                self._counts[reason] += 1
+
+                now = time.monotonic()
+                if now - self._last_summary < self.interval:
+                    return
+
+                counts, self._counts = self._counts, Counter()
+                self._last_summary = now
+
+            self.logger.info('Dropped in the last %ds: %s', self.interval,
+                             lazy(lambda: ', '.join(
+                                 '{} x{}'.format(key, count)
+                                 for key, count in counts.most_common())))
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+"""
+Counters, gauges and latency histograms for the message pipeline.
+
+Recording is cheap (a lock and an integer increment, plus a bisect for
+histograms) so it can stay on the hot path. The metrics can be logged
+periodically with `MetricsDumper` and/or served as plain text over HTTP with
+`serve_http`, eg:
+
+```
+$ curl localhost:9100/metrics
+messages_received 1840
+...
+receive_seconds_count 184
+receive_seconds_sum 312.518
+receive_seconds{quantile="0.5"} 1.31072
+```
+
+Metrics are per process. With WORKER_PROCESSES, each worker sends what's
+changed since last time (see `ChangeTracker`) back to the receiving process
+with its results, which adds it to its own, so that process's metrics cover
+the workers too.
+"""
+
+import bisect
+import http.server
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+LOG = logging.getLogger(__name__)
+
+# 10us doubling up to ~84 seconds
+LATENCY_BUCKETS = [0.00001 * 2 ** i for i in range(24)]
+
+REPORTED_QUANTILES = (0.5, 0.9, 0.99)
+
+INFINITY = float('inf')
+
+
+class Counter(object):
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def lines(self):
+        yield '{} {}'.format(self.name, self.value)
+
+    def state(self):
+        return self.value
+
+    def change(self, state, previous):
+        return state - previous
+
+    def merge(self, change):
+        self.inc(change)
+
+
+class Gauge(object):
+    """
+    A value that can go up and down, eg. a queue depth.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def lines(self):
+        yield '{} {}'.format(self.name, self.value)
+
+    def state(self):
+        return self.value
+
+    def change(self, state, previous):
+        return state  # the latest value wins
+
+    def merge(self, change):
+        self.set(change)
+
+
+class Histogram(object):
+    """
+    Counts observations into fixed buckets, so quantiles are approximate: the
+    upper bound of the bucket the quantile falls in.
+    """
+
+    def __init__(self, name, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def state(self):
+        with self._lock:
+            return list(self.counts), self.count, self.sum
+
+    def change(self, state, previous):
+        counts, count, total = state
+        previous_counts, previous_count, previous_total = previous
+
+        return ([n - p for n, p in zip(counts, previous_counts)],
+                count - previous_count, total - previous_total)
+
+    def merge(self, change):
+        counts, count, total = change
+
+        with self._lock:
+            for i, n in enumerate(counts):
+                self.counts[i] += n
+            self.count += count
+            self.sum += total
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+
+        target = q * self.count
+        seen = 0
+
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.buckets[i] if i < len(self.buckets) else INFINITY
+
+    def lines(self):
+        yield '{}_count {}'.format(self.name, self.count)
+        yield '{}_sum {:.6f}'.format(self.name, self.sum)
+
+        for q in REPORTED_QUANTILES:
+            value = self.quantile(q)
+            yield '{}{{quantile="{}"}} {}'.format(
+                self.name, q, 'NaN' if value is None else value)
+
+
+class _Timer(object):
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+REGISTRY = OrderedDict()
+
+
+def counter(name):
+    return _register(Counter(name))
+
+
+def gauge(name):
+    return _register(Gauge(name))
+
+
+def histogram(name, buckets=LATENCY_BUCKETS):
+    return _register(Histogram(name, buckets))
+
+
+def _register(metric):
+    if metric.name in REGISTRY:
+        raise ValueError('Metric `{}` already registered'.format(metric.name))
+
+    REGISTRY[metric.name] = metric
+    return metric
+
+
+def render():
+    """
+    All metrics, one per line.
+    """
+    return '\n'.join(
+        line for metric in REGISTRY.values() for line in metric.lines()) + '\n'
+
+
+# The pipeline's metrics
+MESSAGES_RECEIVED = counter('messages_received')
+MESSAGES_DROPPED_BY_HEADER = counter('messages_dropped_by_header')
+MESSAGES_DROPPED_INELIGIBLE = counter('messages_dropped_ineligible')
+MESSAGES_ELIGIBLE = counter('messages_eligible')
+LOOKUP_FAILURES = counter('lookup_failures')
+ACK_FAILURES = counter('ack_failures')
+MESSAGES_SHED = counter('messages_shed')
+DEDUP_HITS = counter('dedup_hits')
+DEDUP_MISSES = counter('dedup_misses')
+VISIBILITY_EXTENSIONS = counter('visibility_extensions')
+VISIBILITY_EXTENSION_FAILURES = counter('visibility_extension_failures')
+
+RECEIVE_SECONDS = histogram('receive_seconds')
+DECODE_SECONDS = histogram('decode_seconds')
+LOOKUP_SECONDS = histogram('lookup_seconds')
+DECIDE_SECONDS = histogram('decide_seconds')
+DELETE_SECONDS = histogram('delete_seconds')
+
+# Published by polling.PollingController
+QUEUE_BACKLOG = gauge('queue_backlog')
+DESIRED_CONSUMERS = gauge('desired_consumers')
+
+# Published by catchup.CatchUp
+LAG_SECONDS = gauge('lag_seconds')
+
+
+class ChangeTracker(object):
+    """
+    Tracks what's changed in this process's metrics since the last call to
+    `changes()`, for `merge()` in another process.
+    """
+
+    def __init__(self):
+        self._states = {name: metric.state()
+                        for name, metric in REGISTRY.items()}
+
+    def changes(self):
+        """
+        Returns {metric name: change} for those that have changed.
+        """
+        changes = {}
+
+        for name, metric in REGISTRY.items():
+            state = metric.state()
+            if state != self._states[name]:
+                changes[name] = metric.change(state, self._states[name])
+                self._states[name] = state
+
+        return changes
+
+
+def merge(changes):
+    """
+    Add the `changes()` from a `ChangeTracker` elsewhere to our metrics.
+    """
+    for name, change in changes.items():
+        REGISTRY[name].merge(change)
+
+
+class MetricsDumper(object):
+    """
+    Logs all metrics every `interval` seconds from a background thread.
+    """
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self._stopping = threading.Event()
+
+        self._thread = threading.Thread(target=self._run, name='metrics')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            LOG.info('Metrics:\n{}'.format(render()))
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOG.debug(format % args)
+
+
+def serve_http(port, host='127.0.0.1'):
+    """
+    Serve the metrics on every path at http://host:port/ from a background
+    thread. Returns the server.
+    """
+    server = http.server.ThreadingHTTPServer((host, port), _MetricsHandler)
+
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http')
+    thread.daemon = True
+    thread.start()
+
+    return server
@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 
+import bisect
 import json
 import logging
+import threading
+import time
 
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 from os.path import dirname, join as pjoin
 
+import reference_data
+
 LOG = logging.getLogger(__name__)
 
 OPERATING_COMPANIES_FN = pjoin(
@@ -16,6 +21,10 @@ DELAY_REPAY_FN = pjoin(
     dirname(__file__), 'uk-train-data', 'db', 'delay_repay.json'
 )
 
+# An operating company without a delay repay policy is warned about at most
+# once in this many seconds
+NO_POLICY_WARNING_INTERVAL = 60 * 60
+
 
 class OperatingCompany(object):
     """
@@ -50,47 +59,183 @@ class OperatingCompany(object):
 
     @property
     def delay_repay_policy(self):
-        return DELAY_REPAY.get(self.atoc_code, None)
+        return DELAY_REPAY_BY_NUMERIC_CODE.current().get(self.numeric_code)
 
     def is_delay_repay_eligible(self, late_minutes):
-        policy = self.delay_repay_policy
-
-        if policy is None:
-            LOG.warning('No delay repay policy for {}'.format(self))
-            return False
-        else:
-            return policy.is_eligible(late_minutes)
+        return is_delay_repay_eligible(self.numeric_code, late_minutes)
 
 
 class DelayRepayPolicy(object):
     """
     Calculates the amount of compensation due for a given lateness of a train.
+
+    Compensation comes in bands, eg. 50% of the ticket price from 30 minutes
+    late and 100% from 60, given in the record as:
+
+    ```
+    "compensation_bands": [
+        {"minimum_minutes": 30, "percent_of_ticket": 50},
+        {"minimum_minutes": 60, "percent_of_ticket": 100}
+    ]
+    ```
     """
 
     def __init__(self, record):
         self.minimum_eligible_minutes = record['minimum_minutes']
 
+        bands = sorted(
+            (band['minimum_minutes'], band['percent_of_ticket'])
+            for band in record.get('compensation_bands', []))
+
+        self._band_minutes = [minutes for minutes, _ in bands]
+        self._band_percents = [percent for _, percent in bands]
+
     def is_eligible(self, late_minutes):
         if self.minimum_eligible_minutes is None:
             return False
 
         return late_minutes >= self.minimum_eligible_minutes
 
+    def compensation_percent(self, late_minutes):
+        """
+        Percentage of the ticket price due, or 0 if none (or the policy
+        doesn't have compensation bands).
+        """
+        if not self.is_eligible(late_minutes):
+            return 0
+
+        band = bisect.bisect_right(self._band_minutes, late_minutes) - 1
+        return self._band_percents[band] if band >= 0 else 0
+
+    def compensation_pence(self, late_minutes, ticket_price_pence):
+        return (ticket_price_pence *
+                self.compensation_percent(late_minutes)) // 100
+
+
+OperatingCompanyLookups = namedtuple('OperatingCompanyLookups', [
+    'operating_companies',
+    'by_business_code',
+    'by_numeric_code',
+    'by_atoc_code',
+])
+
+
+def _load_operating_companies():
+    with open(OPERATING_COMPANIES_FN, 'r') as f:
+        companies = [OperatingCompany(record) for record in json.load(f)]
+
+    return OperatingCompanyLookups(
+        companies,
+        {oc.business_code: oc for oc in companies},
+        {oc.numeric_code: oc for oc in companies},
+        {oc.atoc_code: oc for oc in companies},
+    )
+
+
+def _load_delay_repay():
+    with open(DELAY_REPAY_FN, 'r') as f:
+        return {record['atoc_code']: DelayRepayPolicy(record)
+                for record in json.load(f)}
+
+
+OPERATING_COMPANIES = reference_data.register(
+    'operating_companies', _load_operating_companies,
+    source_filenames=[OPERATING_COMPANIES_FN])
+
+DELAY_REPAY = reference_data.register(
+    'delay_repay', _load_delay_repay, source_filenames=[DELAY_REPAY_FN])
+
+
+def _load_delay_repay_by_numeric_code():
+    """
+    TOC numeric code -> DelayRepayPolicy, or None for an operating company
+    with no policy.
+    """
+    delay_repay = DELAY_REPAY.current()
+
+    return {
+        oc.numeric_code: delay_repay.get(oc.atoc_code)
+        for oc in OPERATING_COMPANIES.current().operating_companies
+    }
+
+
+# Saves going numeric code -> operating company -> ATOC code -> policy for
+# every message. It's built from both tables above, so it's rebuilt whenever
+# either changes.
+DELAY_REPAY_BY_NUMERIC_CODE = reference_data.register(
+    'delay_repay_by_numeric_code', _load_delay_repay_by_numeric_code,
+    source_filenames=[OPERATING_COMPANIES_FN, DELAY_REPAY_FN])
+
+
+def is_delay_repay_eligible(numeric_code, late_minutes):
+    policy = DELAY_REPAY_BY_NUMERIC_CODE.current().get(numeric_code)
+
+    if policy is None:
+        _NO_POLICY_WARNINGS.warn(numeric_code)
+        return False
+
+    return policy.is_eligible(late_minutes)
+
+
+def minimum_eligible_minutes(numeric_code):
+    """
+    Minutes late a train must be for delay repay, or None if it can't be.
+    """
+    policy = DELAY_REPAY_BY_NUMERIC_CODE.current().get(numeric_code)
+    return None if policy is None else policy.minimum_eligible_minutes
+
+
+def compensation_percent(numeric_code, late_minutes):
+    policy = DELAY_REPAY_BY_NUMERIC_CODE.current().get(numeric_code)
+    return 0 if policy is None else policy.compensation_percent(late_minutes)
+
+
+class _NoPolicyWarnings(object):
+    """
+    Warns that an operating company has no delay repay policy, at most once
+    per company per `interval` seconds, with a count of the times it wasn't
+    warned about in between.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._last_warned = {}
+        self._suppressed = {}
+        self._lock = threading.Lock()
+
+    def warn(self, numeric_code):
+        now = time.monotonic()
+
+        with self._lock:
+            last_warned = self._last_warned.get(numeric_code)
+
+            if last_warned is not None and now - last_warned < self.interval:
+                self._suppressed[numeric_code] = (
+                    self._suppressed.get(numeric_code, 0) + 1)
+                return
+
+            self._last_warned[numeric_code] = now
+            suppressed = self._suppressed.pop(numeric_code, 0)
+
+        if suppressed:
+            LOG.warning('No delay repay policy for %s (%d more times since '
+                        'the last warning)', _describe(numeric_code),
+                        suppressed)
+        else:
+            LOG.warning('No delay repay policy for %s',
+                        _describe(numeric_code))
+
 
-with open(OPERATING_COMPANIES_FN, 'r') as f:
-    OPERATING_COMPANIES = [OperatingCompany(record) for record in json.load(f)]
-    BUSINESS_CODE_LOOKUP = {oc.business_code: oc for oc in OPERATING_COMPANIES}
-    NUMERIC_CODE_LOOKUP = {oc.numeric_code: oc for oc in OPERATING_COMPANIES}
-    ATOC_CODE_LOOKUP = {oc.atoc_code: oc for oc in OPERATING_COMPANIES}
+def _describe(numeric_code):
+    company = OPERATING_COMPANIES.current().by_numeric_code.get(numeric_code)
+    return company if company is not None else numeric_code
 
 
-with open(DELAY_REPAY_FN, 'r') as f:
-    DELAY_REPAY = {record['atoc_code']: DelayRepayPolicy(record)
-                   for record in json.load(f)}
+_NO_POLICY_WARNINGS = _NoPolicyWarnings(NO_POLICY_WARNING_INTERVAL)
 
 
 def from_business_code(business_code):
-    return BUSINESS_CODE_LOOKUP[business_code]
+    return OPERATING_COMPANIES.current().by_business_code[business_code]
 
 
 def from_numeric_code(numeric_code):
@@ -98,8 +243,8 @@ def from_numeric_code(numeric_code):
         raise TypeError('Numeric code should be int, got {} `{}`'.format(
             type(numeric_code), numeric_code))
 
-    return NUMERIC_CODE_LOOKUP[numeric_code]
+    return OPERATING_COMPANIES.current().by_numeric_code[numeric_code]
 
 
 def from_atoc_code(atoc_code):
-    return ATOC_CODE_LOOKUP[atoc_code]
+    return OPERATING_COMPANIES.current().by_atoc_code[atoc_code]
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""
+Tunes how we receive from SQS to the backlog and to how fast we're getting
+through it.
+
+Fixed receive parameters are a compromise: a long poll wait saves empty
+receives on a quiet night but isn't needed during a 200k message backlog,
+when more receives in flight at once (with POLLER_THREADS) are. A
+`PollingController` watches
+
+- how full received batches are (`observe_receive`),
+- how long messages are held from being received until they're handled, and
+  how many are handled per second (`observe_handled`),
+- the queue's `ApproximateNumberOfMessages` (cached, see transport.py),
+
+and every `interval` seconds adjusts:
+
+- `WaitTimeSeconds`: doubled (up to `max_wait`) while batches come back
+  mostly empty and there's no backlog, halved (down to `min_wait`) otherwise.
+- `VisibilityTimeout`: enough to cover `VISIBILITY_SAFETY_FACTOR` times the
+  typical hold time, between the base timeout and `max_visibility`. Messages
+  held for longer than their visibility timeout are kept invisible by the
+  VisibilityHeartbeat, but that's an extra request per 10 messages each time.
+- `receives`: how many receives to have in flight at once, from 1 up to
+  `max_receives`. Up by one while batches come back full and there's a
+  backlog, down by one while they come back mostly empty.
+
+It also works out how many consumers like this one it would take to clear
+the backlog within `target_drain_seconds`, at the rate this one is handling
+messages, and publishes that as the `desired_consumers` gauge for the
+autoscaler to read from /metrics (see metrics.py).
+
+```
+controller = PollingController(queue, RECEIVE_PARAMS, max_receives=4)
+
+params = controller.receive_params()
+sqs_messages = queue.receive_messages(**params)
+controller.observe_receive(len(sqs_messages), params['MaxNumberOfMessages'])
+...
+controller.observe_handled(len(sqs_messages), held_seconds)
+```
+"""
+
+import logging
+import math
+import threading
+import time
+
+import metrics
+
+LOG = logging.getLogger(__name__)
+
+# Batches are "mostly empty" below LOW_FILL full, and "full" above HIGH_FILL
+LOW_FILL = 0.3
+HIGH_FILL = 0.9
+
+VISIBILITY_SAFETY_FACTOR = 3
+
+# Weight given to each new observation in the moving averages
+SMOOTHING = 0.2
+
+MAX_WAIT_SECONDS = 20  # imposed by SQS
+
+
+class PollingController(object):
+    def __init__(self, sqs_queue, base_params, min_wait=1,
+                 max_wait=MAX_WAIT_SECONDS, max_visibility=60,
+                 max_receives=1, target_drain_seconds=10 * 60,
+                 max_consumers=10, interval=30, clock=time.monotonic):
+        """
+        `base_params` are the receive parameters to start from. Their
+        `VisibilityTimeout` is also the lowest it's ever set to, so it can be
+        the one the VisibilityHeartbeat extends by.
+        """
+        self.sqs_queue = sqs_queue
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self.min_visibility = base_params['VisibilityTimeout']
+        self.max_visibility = max(max_visibility, self.min_visibility)
+        self.max_receives = max_receives
+        self.target_drain_seconds = target_drain_seconds
+        self.max_consumers = max_consumers
+        self.interval = interval
+        self.clock = clock
+
+        self.receives = max_receives
+        self.desired_consumers = 1
+
+        self._params = dict(base_params)
+        self._fill = None
+        self._held_seconds = None
+        self._handled = 0
+        self._lock = threading.Lock()
+        self._adjusted_at = clock()
+        self._adjusting = False
+
+    def receive_params(self):
+        """
+        The parameters for the next `receive_messages` call. Don't modify
+        them: they're shared until the next adjustment replaces them.
+        """
+        return self._params
+
+    def observe_receive(self, received, requested):
+        with self._lock:
+            self._fill = _average(self._fill, received / float(requested))
+
+            if (self._adjusting or
+                    self.clock() - self._adjusted_at < self.interval):
+                return
+
+            self._adjusting = True
+
+        # Getting the queue depth can be a request to SQS, so don't hold up
+        # everyone else meanwhile
+        backlog = self._backlog()
+
+        with self._lock:
+            self._adjusting = False
+            self._adjust(self.clock(), backlog)
+
+    def _backlog(self):
+        try:
+            return int(
+                self.sqs_queue.attributes['ApproximateNumberOfMessages'])
+        except Exception as e:
+            LOG.warning("Couldn't get the queue depth, not adjusting: "
+                        "{}".format(repr(e)))
+            return None
+
+    def observe_handled(self, count, held_seconds):
+        """
+        `count` messages have been handled, the longest held of them for
+        `held_seconds` since being received.
+        """
+        with self._lock:
+            self._handled += count
+            self._held_seconds = _average(self._held_seconds, held_seconds)
+
+    def _adjust(self, now, backlog):
+        elapsed = now - self._adjusted_at
+        handled_per_second = self._handled / elapsed
+
+        self._adjusted_at = now
+        self._handled = 0
+
+        if backlog is None:
+            return
+
+        metrics.QUEUE_BACKLOG.set(backlog)
+
+        params = dict(self._params)
+        wait = params['WaitTimeSeconds']
+        receives = self.receives
+
+        if self._fill < LOW_FILL and backlog == 0:
+            wait = min(self.max_wait, wait * 2)
+            receives = max(1, receives - 1)
+        else:
+            wait = max(self.min_wait, wait // 2)
+
+            if self._fill >= HIGH_FILL and backlog > 0:
+                receives = min(self.max_receives, receives + 1)
+
+        params['WaitTimeSeconds'] = wait
+
+        if self._held_seconds is not None:
+            params['VisibilityTimeout'] = min(self.max_visibility, max(
+                self.min_visibility,
+                int(math.ceil(VISIBILITY_SAFETY_FACTOR * self._held_seconds))))
+
+        self._set_desired_consumers(backlog, handled_per_second)
+
+        if params != self._params or receives != self.receives:
+            LOG.info('Backlog ~{}, batches {:.0%} full: receiving {} at a '
+                     'time with WaitTimeSeconds={} and '
+                     'VisibilityTimeout={}'.format(
+                         backlog, self._fill, receives,
+                         params['WaitTimeSeconds'],
+                         params['VisibilityTimeout']))
+
+        self._params = params
+        self.receives = receives
+
+    def _set_desired_consumers(self, backlog, handled_per_second):
+        if backlog == 0:
+            desired = 1
+        elif handled_per_second == 0:
+            return  # nothing to go on yet
+        else:
+            desired = int(math.ceil(
+                backlog / (handled_per_second * self.target_drain_seconds)))
+
+        self.desired_consumers = min(self.max_consumers, max(1, desired))
+        metrics.DESIRED_CONSUMERS.set(self.desired_consumers)
+
+
+def _average(average, value):
+    if average is None:
+        return value
+
+    return average + SMOOTHING * (value - average)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""
+Cheap rejection of messages we'd drop anyway, before decoding them.
+
+Most of the TRUST feed isn't train movements (`msg_type` "0003"), and
+`process_message` throws everything else away straight after `json.loads`
+has built the whole object graph. Here we pick the few fields we filter on
+straight out of the raw body with regular expressions and reject the message
+if any of them rule it out.
+
+A field that can't be found never causes a rejection: the message is passed
+on for full decoding, and `process_message` has the final say.
+
+The accepted values can come from the eligibility rules (see rules.py), so
+that messages they might accept are never rejected here:
+
+```
+prefilter = HeaderPrefilter(msg_types={'0003'}, rules=ELIGIBILITY_RULES)
+```
+"""
+
+import re
+import threading
+
+from collections import Counter, OrderedDict
+
+
+def _field_pattern(name):
+    # The leading quote stops eg. "event_type" matching "planned_event_type"
+    return re.compile(r'"{}"\s*:\s*"([^"]*)"'.format(name))
+
+
+class HeaderPrefilter(object):
+    FIELD_PATTERNS = OrderedDict([
+        ('msg_type', _field_pattern('msg_type')),
+        ('event_type', _field_pattern('event_type')),
+        ('variation_status', _field_pattern('variation_status')),
+        ('toc_id', _field_pattern('toc_id')),
+    ])
+
+    def __init__(self, msg_types=('0003',), event_types=None,
+                 variation_statuses=None, toc_ids=None, rules=None):
+        """
+        Each argument is a collection of the accepted values for that field,
+        or None to not filter on it.
+
+        `rules`, if given, is a reference table of a `rules.RulePipeline`.
+        Fields not given here are filtered on the values its field rules
+        allow, following it when it's reloaded.
+        """
+        self.allowed = OrderedDict([
+            ('msg_type', msg_types),
+            ('event_type', event_types),
+            ('variation_status', variation_statuses),
+            ('toc_id', toc_ids),
+        ])
+        self.rules = rules
+
+        self._pipeline = None
+        self._checks = self._compile(self.allowed)
+
+        self.stats = PrefilterStats()
+
+    def accepts(self, body):
+        if self.rules is not None:
+            pipeline = self.rules.current()
+            if pipeline is not self._pipeline:
+                self._follow(pipeline)
+
+        for field, pattern, allowed_values in self._checks:
+            match = pattern.search(body)
+
+            if match is not None and match.group(1) not in allowed_values:
+                self.stats.record_rejection(field, len(body))
+                return False
+
+        self.stats.record_acceptance(len(body))
+        return True
+
+    def _follow(self, pipeline):
+        allowed = OrderedDict(
+            (field, pipeline.allowed_values(field) if values is None
+             else values)
+            for field, values in self.allowed.items())
+
+        # Replaced in one go, so other threads see the old or the new checks
+        self._checks = self._compile(allowed)
+        self._pipeline = pipeline
+
+    def _compile(self, allowed):
+        return [
+            (field, pattern, frozenset(allowed[field]))
+            for field, pattern in self.FIELD_PATTERNS.items()
+            if allowed[field] is not None
+        ]
+
+
+class PrefilterStats(object):
+    """
+    Counts how many messages (and bytes) were rejected without being decoded.
+    """
+
+    def __init__(self):
+        self.accepted = 0
+        self.accepted_bytes = 0
+        self.rejected = Counter()
+        self.rejected_bytes = 0
+        self._lock = threading.Lock()
+
+    def record_acceptance(self, num_bytes):
+        with self._lock:
+            self.accepted += 1
+            self.accepted_bytes += num_bytes
+
+    def record_rejection(self, field, num_bytes):
+        with self._lock:
+            self.rejected[field] += 1
+            self.rejected_bytes += num_bytes
+
+    @property
+    def total(self):
+        return self.accepted + sum(self.rejected.values())
+
+    def __str__(self):
+        total = self.total
+        rejected = sum(self.rejected.values())
+        total_bytes = self.accepted_bytes + self.rejected_bytes
+
+        return ('prefilter skipped decoding {}/{} messages ({:.1f}%), '
+                '{}/{} bytes ({:.1f}%), by field: {}'.format(
+                    rejected, total, _percent(rejected, total),
+                    self.rejected_bytes, total_bytes,
+                    _percent(self.rejected_bytes, total_bytes),
+                    dict(self.rejected)))
+
+
+def _percent(part, whole):
+    return 100.0 * part / whole if whole else 0.0
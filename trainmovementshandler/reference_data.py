@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+"""
+Lazily loaded reference data tables.
+
+The CORPUS, NAPTAN, operating company and delay repay data are slow to load,
+so rather than loading them at import time each module registers a loader
+here and the table is loaded the first time it's used. Call `warm_up()` to
+pay that cost at a time of your choosing, eg. before starting to consume
+messages.
+
+Tables can be reloaded while we're running, when their source files change
+(see `ReloadWatcher`). The new data is built completely in the background
+and then swapped in with a single assignment, so a lookup always sees either
+the old table or the new one, never a partly built one.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+LOG = logging.getLogger(__name__)
+
+TABLES = OrderedDict()
+
+
+class ReferenceTable(object):
+    def __init__(self, name, loader, source_filenames=()):
+        self.name = name
+        self.loader = loader
+        self.source_filenames = list(source_filenames)
+        self.load_seconds = None
+
+        self._value = None
+        self._loaded = False
+        self._source_mtimes = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'ReferenceTable("{}")'.format(self.name)
+
+    @property
+    def is_loaded(self):
+        return self._loaded
+
+    def current(self):
+        """
+        Return the table's data, loading it first if necessary.
+        """
+        if not self._loaded:
+            self._load_once()
+
+        return self._value
+
+    def _load_once(self):
+        with self._lock:
+            if self._loaded:  # another thread got here first
+                return
+
+            self._load()
+
+        LOG.info('Loaded reference table `{}` in {:.3f}s'.format(
+            self.name, self.load_seconds))
+
+    def reload(self):
+        """
+        Build the table again from its source and swap it in. Lookups carry
+        on using the old data until the new data is completely built.
+        """
+        with self._lock:
+            self._load()
+
+        LOG.info('Reloaded reference table `{}` in {:.3f}s'.format(
+            self.name, self.load_seconds))
+
+    def sources_changed(self):
+        return (self._loaded and
+                self._read_source_mtimes() != self._source_mtimes)
+
+    def _load(self):
+        # Read the mtimes first, so changes made while loading get picked up
+        # next time round.
+        source_mtimes = self._read_source_mtimes()
+        started = time.monotonic()
+
+        value = self.loader()
+
+        self._value = value
+        self._source_mtimes = source_mtimes
+        self.load_seconds = time.monotonic() - started
+        self._loaded = True
+
+    def _read_source_mtimes(self):
+        return tuple(_mtime_or_none(fn) for fn in self.source_filenames)
+
+
+def _mtime_or_none(filename):
+    try:
+        return os.path.getmtime(filename)
+    except OSError:
+        return None
+
+
+def register(name, loader, source_filenames=()):
+    """
+    Register `loader`, a function which takes no arguments and returns the
+    table's data, and return the (not yet loaded) table. The table is
+    reloaded when any of `source_filenames` change.
+    """
+    if name in TABLES:
+        raise ValueError('Reference table `{}` already registered'.format(
+            name))
+
+    table = ReferenceTable(name, loader, source_filenames)
+    TABLES[name] = table
+    return table
+
+
+def warm_up():
+    """
+    Load every registered table that isn't already loaded. Returns a
+    dictionary of table name to load time in seconds.
+    """
+    for table in TABLES.values():
+        table.current()
+
+    return load_timings()
+
+
+def load_timings():
+    return OrderedDict(
+        (name, table.load_seconds) for name, table in TABLES.items())
+
+
+def reload_changed(force=False):
+    """
+    Reload every loaded table whose source files have changed, or every
+    loaded table if `force` is set. Returns the names of the reloaded tables.
+    """
+    reloaded = []
+
+    for name, table in TABLES.items():
+        if not table.is_loaded:
+            continue  # it'll get the latest data when it's first used
+
+        if force or table.sources_changed():
+            try:
+                table.reload()
+            except Exception:
+                LOG.exception('Failed to reload reference table `{}`, '
+                              'keeping the old data'.format(name))
+            else:
+                reloaded.append(name)
+
+    return reloaded
+
+
+class ReloadWatcher(object):
+    """
+    Background thread which checks the source files of the reference tables
+    every `interval` seconds and reloads the ones which changed.
+    `request_reload()` makes it reload everything straight away, and is safe
+    to call from a signal handler.
+    """
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self._reload_requested = False
+        self._wake = threading.Event()
+        self._stopping = False
+
+        self._thread = threading.Thread(
+            target=self._run, name='reference-data-reloader')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping = True
+        self._wake.set()
+        self._thread.join()
+
+    def request_reload(self):
+        self._reload_requested = True
+        self._wake.set()
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+            if self._stopping:
+                return
+
+            force, self._reload_requested = self._reload_requested, False
+            reload_changed(force=force)
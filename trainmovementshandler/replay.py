@@ -0,0 +1,495 @@
+#!/usr/bin/env python3
+
+"""
+Offline replay of recorded (or generated) SQS message bodies, for measuring
+throughput without a live queue.
+
+A dump is a file of SQS message bodies, one per line, optionally gzipped
+(a `.gz` filename). To generate a synthetic dump and replay it:
+
+```
+./replay.py generate 100000 /tmp/movements.ndjson.gz
+./replay.py run /tmp/movements.ndjson.gz
+./replay.py run --through-queue /tmp/movements.ndjson.gz
+./replay.py run --batch 10000 /tmp/movements.ndjson.gz
+./replay.py run --stub-sqs /tmp/movements.ndjson.gz
+./replay.py run --stub-sqs --resource /tmp/movements.ndjson.gz
+./replay.py run --stub-stomp --rate 2000 /tmp/movements.ndjson.gz
+```
+
+`run` pushes each body through `handle_message_body`, the same prefilter /
+decode / process path as the live consumer, and reports messages per second,
+p50/p99 latency per message and peak RSS. With `--through-queue` the bodies
+are served by a `FakeQueue` to `handle_queue` instead, so receiving and
+batched acks are included too. With `--batch` eligibility is decided for
+that many messages at a time by `batch.eligible_mask` (this needs NumPy).
+
+`--stub-sqs` serves the bodies over HTTP from a local stub SQS endpoint (see
+stub_sqs.py) to `handle_queue`, so the cost of the SQS requests themselves is
+included: through `transport.SqsQueue`, or with `--resource` the boto3
+resource `Queue` it replaced, for comparison.
+
+`--stub-stomp` publishes the bodies from a local stub STOMP broker (see
+stub_stomp.py) to a `StompSource`, at `--rate` messages per second if given,
+and reports p50/p99 latency from being published to being ACKed.
+"""
+
+import argparse
+import gzip
+import itertools
+import json
+import logging
+import random
+import resource
+import threading
+import time
+
+from collections import OrderedDict
+
+import boto3
+
+import handle
+import locations
+import operating_companies
+import transport
+from acks import AckBatcher
+from shutdown import GracefulShutdown
+from sources import StompSource
+from stub_sqs import StubSqsServer
+from stub_stomp import StubStompBroker
+
+# Rough proportions of TRUST message types
+MESSAGE_TYPE_WEIGHTS = OrderedDict([
+    ('0001', 8),  # activation
+    ('0002', 1),  # cancellation
+    ('0003', 85),  # movement
+    ('0005', 1),  # reinstatement
+    ('0006', 1),  # change of origin
+    ('0007', 2),  # change of identity
+    ('0008', 2),  # change of location
+])
+
+VARIATION_STATUS_WEIGHTS = OrderedDict([
+    ('ON TIME', 45),
+    ('LATE', 35),
+    ('EARLY', 18),
+    ('OFF ROUTE', 2),
+])
+
+EVENT_TYPE_WEIGHTS = OrderedDict([
+    ('ARRIVAL', 48),
+    ('DEPARTURE', 48),
+    ('DESTINATION', 4),
+])
+
+MEAN_MINUTES_LATE = 8
+
+
+class QueueExhausted(Exception):
+    """
+    Raised by `FakeQueue.receive_messages` once every message has been
+    received, to get out of `handle_queue`'s endless loop.
+    """
+
+
+def open_dump(filename, mode='rt'):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode, encoding='utf-8')
+    return open(filename, mode, encoding='utf-8')
+
+
+def read_dump(filename):
+    with open_dump(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def write_dump(filename, bodies):
+    count = 0
+
+    with open_dump(filename, 'wt') as f:
+        for body in bodies:
+            f.write(body)
+            f.write('\n')
+            count += 1
+
+    return count
+
+
+def generate_bodies(count, seed=None, start_ms=1455883470000):
+    """
+    Generate `count` SQS message bodies with a realistic mix of TRUST message
+    types, and movements at known locations and operating companies.
+    """
+    rng = random.Random(seed)
+    stanox_codes = list(locations.STANOX_LOOKUP.current())
+    toc_ids = [
+        '{:02d}'.format(code) for code
+        in operating_companies.OPERATING_COMPANIES.current().by_numeric_code]
+
+    def weighted(weights):
+        return rng.choices(list(weights), weights=list(weights.values()))[0]
+
+    for i in range(count):
+        msg_type = weighted(MESSAGE_TYPE_WEIGHTS)
+        planned_ms = start_ms + i * 1000
+
+        header = OrderedDict([
+            ('user_id', ''),
+            ('msg_type', msg_type),
+            ('msg_queue_timestamp', str(planned_ms)),
+            ('source_dev_id', ''),
+            ('original_data_source', 'SMART'),
+            ('source_system_id', 'TRUST'),
+        ])
+
+        train_id = '{:02d}{}{:02d}MI{:02d}'.format(
+            rng.randrange(100), rng.choice('12459'), rng.randrange(100),
+            rng.randrange(1, 29))
+
+        if msg_type == '0003':
+            body = _generate_movement(
+                rng, planned_ms, train_id, rng.choice(stanox_codes),
+                rng.choice(toc_ids), weighted(EVENT_TYPE_WEIGHTS),
+                weighted(VARIATION_STATUS_WEIGHTS))
+        else:
+            body = OrderedDict([
+                ('train_id', train_id),
+                ('toc_id', rng.choice(toc_ids)),
+                ('loc_stanox', rng.choice(stanox_codes)),
+            ])
+
+        yield json.dumps(OrderedDict([('header', header), ('body', body)]))
+
+
+def _generate_movement(rng, planned_ms, train_id, stanox, toc_id, event_type,
+                       status):
+    if status == 'LATE':
+        variation = max(1, int(rng.expovariate(1.0 / MEAN_MINUTES_LATE)))
+    elif status == 'EARLY':
+        variation = -rng.randint(1, 5)
+    else:
+        variation = 0
+
+    actual_ms = planned_ms + variation * 60 * 1000
+
+    return OrderedDict([
+        ('event_type', event_type),
+        ('gbtt_timestamp', str(planned_ms - 30000)),
+        ('original_loc_stanox', ''),
+        ('planned_timestamp', str(planned_ms)),
+        ('timetable_variation', str(abs(variation))),
+        ('original_loc_timestamp', ''),
+        ('current_train_id', ''),
+        ('delay_monitoring_point', 'true'),
+        ('next_report_run_time', '1'),
+        ('reporting_stanox', stanox),
+        ('actual_timestamp', str(actual_ms)),
+        ('correction_ind', 'false'),
+        ('event_source', 'AUTOMATIC'),
+        ('train_file_address', None),
+        ('platform', ' 1'),
+        ('division_code', toc_id),
+        ('train_terminated', 'false'),
+        ('train_id', train_id),
+        ('offroute_ind', 'true' if status == 'OFF ROUTE' else 'false'),
+        ('variation_status', status),
+        ('train_service_code', '24745000'),
+        ('toc_id', toc_id),
+        ('loc_stanox', stanox),
+        ('auto_expected', 'true'),
+        ('direction_ind', 'UP'),
+        ('route', '2'),
+        ('planned_event_type', event_type),
+        ('next_report_stanox', stanox),
+        ('line_ind', 'F'),
+    ])
+
+
+class FakeMessage(object):
+    def __init__(self, queue, body, message_id):
+        self.queue = queue
+        self.body = body
+        self.message_id = message_id
+        self.receipt_handle = 'receipt-{}'.format(message_id)
+
+    def delete(self):
+        self.queue.deleted.append(self.receipt_handle)
+
+
+class FakeQueue(object):
+    """
+    Stands in for a boto3 SQS `Queue`, serving `bodies` in order. Deleted
+    receipt handles are collected in `deleted`.
+    """
+
+    url = 'https://queue.amazonaws.com/123456789012/fake-queue'
+
+    def __init__(self, bodies, raise_when_empty=True):
+        self.raise_when_empty = raise_when_empty
+        self.deleted = []
+        self.visibility_changes = []
+        self._bodies = iter(bodies)
+        self._ids = itertools.count()
+        self.received_count = 0
+
+    @property
+    def attributes(self):
+        return {
+            'ApproximateNumberOfMessages': '0',
+            'ApproximateNumberOfMessagesNotVisible': '0',
+        }
+
+    def receive_messages(self, MaxNumberOfMessages=1, **params):
+        messages = [
+            FakeMessage(self, body, next(self._ids))
+            for body in itertools.islice(self._bodies, MaxNumberOfMessages)
+        ]
+
+        if not messages and self.raise_when_empty:
+            raise QueueExhausted()
+
+        self.received_count += len(messages)
+        return messages
+
+    def delete_messages(self, Entries):
+        self.deleted.extend(entry['ReceiptHandle'] for entry in Entries)
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+    def change_message_visibility_batch(self, Entries):
+        self.visibility_changes.extend(Entries)
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+
+def replay(bodies):
+    """
+    Process each body in turn, returning a list of per-message latencies in
+    seconds.
+    """
+    latencies = []
+
+    for body in bodies:
+        started = time.perf_counter()
+        handle.handle_message_body(body)
+        latencies.append(time.perf_counter() - started)
+
+    return latencies
+
+
+def replay_through_queue(bodies):
+    """
+    Run `handle_queue` over a `FakeQueue` serving `bodies`, returning the
+    number of messages received and the number acked.
+    """
+    queue = FakeQueue(bodies)
+    acks = AckBatcher(queue)
+
+    try:
+        handle.handle_queue(queue, acks)
+    except QueueExhausted:
+        pass
+    finally:
+        acks.close()
+
+    return queue.received_count, len(queue.deleted)
+
+
+def replay_through_stub_sqs(bodies, use_resource=False):
+    """
+    Run `handle_queue` against a local stub SQS endpoint serving `bodies`,
+    returning the number of messages received, the number deleted and the
+    number of HTTP requests made.
+    """
+    server = StubSqsServer(bodies)
+    server.start()
+
+    credentials = {
+        'region_name': 'eu-west-1',
+        'endpoint_url': server.endpoint_url,
+        'aws_access_key_id': 'stub',
+        'aws_secret_access_key': 'stub',
+    }
+
+    if use_resource:
+        queue = boto3.resource('sqs', **credentials).Queue(server.queue_url)
+    else:
+        queue = transport.SqsQueue(
+            transport.make_client(**credentials), server.queue_url)
+
+    acks = AckBatcher(queue)
+
+    # handle_queue stops receiving once everything's been handed out
+    shutdown = GracefulShutdown(deadline=0)
+    threading.Thread(target=lambda: (server.exhausted.wait(),
+                                     shutdown.request())).start()
+
+    try:
+        handle.handle_queue(queue, acks, shutdown=shutdown)
+    finally:
+        acks.close()
+        server.stop()
+
+    return server.received_count, server.deleted_count, server.request_count
+
+
+def replay_through_stub_stomp(bodies, rate=None):
+    """
+    Run `handle_queue` on messages published by a local stub STOMP broker,
+    returning the broker, which has the publish to ACK latencies.
+    """
+    broker = StubStompBroker(bodies, rate=rate)
+    broker.start()
+
+    source = StompSource(broker.host, broker.port, '/topic/stub').connect()
+    acks = AckBatcher(source)
+
+    shutdown = GracefulShutdown(deadline=0)
+    threading.Thread(target=lambda: (broker.done.wait(),
+                                     shutdown.request())).start()
+
+    try:
+        handle.handle_queue(source, acks, shutdown=shutdown)
+    finally:
+        acks.close()
+        source.close()
+        broker.stop()
+
+    return broker
+
+
+def replay_in_batches(bodies, batch_size):
+    """
+    Decide eligibility `batch_size` bodies at a time with NumPy, returning
+    the number of eligible messages.
+    """
+    import batch  # NumPy is only needed for this
+
+    eligible = 0
+
+    for start in range(0, len(bodies), batch_size):
+        columns = batch.decode_batch(bodies[start:start + batch_size])
+        eligible += int(batch.eligible_mask(columns).sum())
+
+    return eligible
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def peak_rss_megabytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run(args):
+    handle.prepare_reference_data()
+    handle.open_catch_up()  # if CATCH_UP_MODE is set
+    bodies = list(read_dump(args.filename))
+
+    started = time.perf_counter()
+
+    if args.through_queue:
+        received, acked = replay_through_queue(bodies)
+        elapsed = time.perf_counter() - started
+
+        print('{} messages received, {} acked'.format(received, acked))
+
+    elif args.stub_sqs:
+        received, deleted, requests = replay_through_stub_sqs(
+            bodies, use_resource=args.resource)
+        elapsed = time.perf_counter() - started
+
+        print('{} messages received, {} deleted, {} requests'.format(
+            received, deleted, requests))
+
+    elif args.stub_stomp:
+        broker = replay_through_stub_stomp(bodies, rate=args.rate)
+        elapsed = time.perf_counter() - started
+        latencies = sorted(broker.latencies)
+
+        print('{} STOMP messages ACKed, p50 {:.1f} ms, p99 {:.1f} ms from '
+              'publish to ACK'.format(
+                  broker.acked_count,
+                  percentile(latencies, 0.5) * 1e3,
+                  percentile(latencies, 0.99) * 1e3))
+
+    elif args.batch:
+        eligible = replay_in_batches(bodies, args.batch)
+        elapsed = time.perf_counter() - started
+
+        print('{} eligible'.format(eligible))
+
+    else:
+        latencies = sorted(replay(bodies))
+        elapsed = time.perf_counter() - started
+
+        print('p50 {:.1f} us, p99 {:.1f} us per message'.format(
+            percentile(latencies, 0.5) * 1e6,
+            percentile(latencies, 0.99) * 1e6))
+
+    print('{} messages in {:.2f}s: {:.0f} msgs/sec, peak RSS {:.1f} MB'.format(
+        len(bodies), elapsed, len(bodies) / elapsed, peak_rss_megabytes()))
+
+    if handle.CATCH_UP is not None:
+        print('{} messages shed while catching up'.format(
+            handle.CATCH_UP.shed_count))
+        handle.close_outputs()
+
+
+def generate(args):
+    count = write_dump(args.filename, generate_bodies(args.count, args.seed))
+    print('Wrote {} messages to {}'.format(count, args.filename))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay recorded SQS message bodies offline.')
+    parser.add_argument('--quiet', action='store_true',
+                        help="don't log anything below WARNING")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser('run', help='replay a dump')
+    run_parser.add_argument('filename')
+    run_parser.add_argument('--through-queue', action='store_true',
+                            help='go through handle_queue and a FakeQueue')
+    run_parser.add_argument('--stub-sqs', action='store_true',
+                            help='go through handle_queue and a local stub '
+                                 'SQS endpoint')
+    run_parser.add_argument('--resource', action='store_true',
+                            help='with --stub-sqs, use the boto3 resource '
+                                 'Queue rather than transport.SqsQueue')
+    run_parser.add_argument('--stub-stomp', action='store_true',
+                            help='go through handle_queue and a local stub '
+                                 'STOMP broker')
+    run_parser.add_argument('--rate', type=int, metavar='MSGS_PER_SEC',
+                            help='with --stub-stomp, publish at this rate')
+    run_parser.add_argument('--batch', type=int, metavar='SIZE',
+                            help='decide eligibility SIZE messages at a time '
+                                 'with NumPy')
+    run_parser.set_defaults(func=run)
+
+    generate_parser = subparsers.add_parser(
+        'generate', help='write a dump of synthetic messages')
+    generate_parser.add_argument('count', type=int)
+    generate_parser.add_argument('filename')
+    generate_parser.add_argument('--seed', type=int, default=None)
+    generate_parser.set_defaults(func=generate)
+
+    args = parser.parse_args()
+
+    if args.quiet:
+        logging.getLogger('').setLevel(logging.WARNING)
+
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
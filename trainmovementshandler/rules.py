@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+
+"""
+Delay repay eligibility rules, from a config file.
+
+Each rule is one condition a movement must meet to be eligible. The rules
+are JSON (by default eligibility_rules.json, or the file ELIGIBILITY_RULES
+names), eg:
+
+```
+[
+    {"name": "arrival", "field": "event_type", "equals": "ARRIVAL"},
+    {"name": "not_off_route", "field": "offroute_ind", "not_equals": "true"},
+    {"name": "not_excluded_toc", "field": "toc_id", "not_in": ["00", "99"]},
+    {"name": "public_station", "check": "public_station"},
+    {"name": "delay_repay_eligible", "check": "delay_repay_eligible"}
+]
+```
+
+A `field` rule compares a field of the raw message body, with one of
+`equals`, `not_equals`, `in` or `not_in`. A `check` rule is one of `CHECKS`,
+which look things up in the reference data. The `REQUIRED_CHECKS` must be
+there: an eligible arrival is written out with its location and operating
+company, so it has to have both. Field rules are cheap and checks aren't, so
+each has a `cost` (which can be overridden in the file), and the rules are
+compiled into a `RulePipeline` which runs the field rules first, then the
+checks, each cheapest first, and stops at the first one that rejects the
+message. So checks only see messages that pass the field rules (eg. only
+arrivals), and don't look up the location of every departure.
+
+The pipeline counts how often each rule rejects a message, in each thread
+separately so they don't contend for a lock. Every `reorder_every` messages
+(in any one thread) it adds them up and reorders the field rules, and the
+checks, by cost divided by the fraction of messages each one rejects, so
+that, cost for cost, the rules that rule out the most messages run first.
+Checks still never run before field rules.
+
+The header prefilter and catch-up shedding (see prefilter.py, catchup.py)
+only let through the values the field rules allow (see `allowed_values`), so
+they follow changes to the rules.
+
+Like the other reference data, the rules are reloaded when the file changes
+(see reference_data.py), which starts the counts again.
+"""
+
+import json
+import logging
+import os
+import threading
+
+from os.path import dirname, join as pjoin
+
+import reference_data
+
+LOG = logging.getLogger(__name__)
+
+RULES_FILENAME = os.environ.get(
+    'ELIGIBILITY_RULES', pjoin(dirname(__file__), 'eligibility_rules.json'))
+
+FIELD_COST = 1  # a dict lookup and a comparison
+
+
+def _is_public_station(message):
+    return (message.location is not None and
+            message.location.is_public_station)
+
+
+def _is_delay_repay_eligible(message):
+    return (message.operating_company is not None and
+            message.minutes_late is not None and
+            message.operating_company.is_delay_repay_eligible(
+                message.minutes_late))
+
+
+# name -> (cost, predicate), predicates take a TrainMovementsMessage
+CHECKS = {
+    'public_station': (10, _is_public_station),
+    'delay_repay_eligible': (20, _is_delay_repay_eligible),
+}
+
+# process_message uses the location and operating company of every eligible
+# arrival, which these make sure it has
+REQUIRED_CHECKS = ('public_station', 'delay_repay_eligible')
+
+_FIELD_OPERATORS = {
+    'equals': lambda value: lambda actual: actual == value,
+    'not_equals': lambda value: lambda actual: actual != value,
+    'in': lambda values: (
+        lambda actual, values=frozenset(values): actual in values),
+    'not_in': lambda values: (
+        lambda actual, values=frozenset(values): actual not in values),
+}
+
+
+# A rule never runs before the rules of a lower tier
+FIELD_TIER = 0
+CHECK_TIER = 1
+
+
+class Rule(object):
+    __slots__ = ('name', 'cost', 'predicate', 'tier', 'field', 'allowed',
+                 'evaluated', 'rejected')
+
+    def __init__(self, name, cost, predicate, tier=FIELD_TIER, field=None,
+                 allowed=None):
+        """
+        `field` is the message field a field rule tests, and `allowed` the
+        values it accepts, if it only accepts certain values.
+        """
+        self.name = name
+        self.cost = cost
+        self.predicate = predicate
+        self.tier = tier
+        self.field = field
+        self.allowed = allowed
+        self.evaluated = 0
+        self.rejected = 0
+
+    def __repr__(self):
+        return '<Rule {}>'.format(self.name)
+
+    @property
+    def rejection_rate(self):
+        return self.rejected / float(self.evaluated) if self.evaluated else 0.0
+
+    @property
+    def rank(self):
+        """
+        Lower runs first. Within its tier, a rule that hasn't rejected
+        anything yet goes by cost alone, after any that have.
+        """
+        if self.rejected == 0:
+            return (self.tier, 1, self.cost)
+
+        return (self.tier, 0, self.cost / self.rejection_rate)
+
+
+class _Counts(object):
+    """
+    One thread's counts, only ever updated by that thread.
+    """
+    def __init__(self, rules):
+        self.messages = 0
+
+        # Every rule's in there from the start, so these never change size
+        # while another thread is adding them up
+        self.evaluated = dict.fromkeys(rules, 0)
+        self.rejected = dict.fromkeys(rules, 0)
+
+
+class RulePipeline(object):
+    def __init__(self, rules, reorder_every=10000):
+        self.reorder_every = reorder_every
+
+        # Replaced, never modified, so it can be read without the lock
+        self._rules = sorted(rules, key=lambda rule: (rule.tier, rule.cost))
+        self._lock = threading.Lock()
+
+        self._local = threading.local()
+        self._all_counts = []  # every thread's _Counts
+
+    def __len__(self):
+        return len(self._rules)
+
+    @property
+    def rules(self):
+        return list(self._rules)
+
+    def accepts(self, message):
+        """
+        Returns True if `message` meets every rule.
+        """
+        rules = self._rules
+
+        for i, rule in enumerate(rules):
+            if not rule.predicate(message):
+                self._record(rules, i, rule)
+                return False
+
+        self._record(rules, len(rules), None)
+        return True
+
+    @property
+    def count(self):
+        return sum(counts.messages for counts in self._all_counts)
+
+    def allowed_values(self, field):
+        """
+        The only values of `field` that can be accepted, or None if any
+        could be.
+        """
+        allowed = None
+
+        for rule in self._rules:
+            if rule.field == field and rule.allowed is not None:
+                allowed = (rule.allowed if allowed is None
+                           else allowed & rule.allowed)
+
+        return allowed
+
+    def reorder(self):
+        with self._lock:
+            self._add_up()
+            rules = sorted(self._rules, key=lambda rule: rule.rank)
+            changed = rules != self._rules
+            self._rules = rules
+
+        if changed:
+            LOG.info('Reordered eligibility rules: {}'.format(self.summary()))
+
+    def summary(self):
+        with self._lock:
+            self._add_up()
+
+        return ', '.join(
+            '{} rejected {} of {}'.format(
+                rule.name, rule.rejected, rule.evaluated)
+            for rule in self._rules)
+
+    def _record(self, rules, evaluated, rejected_by):
+        counts = self._counts()
+
+        for rule in rules[:evaluated]:
+            counts.evaluated[rule] += 1
+
+        if rejected_by is not None:
+            counts.evaluated[rejected_by] += 1
+            counts.rejected[rejected_by] += 1
+
+        counts.messages += 1
+        if counts.messages % self.reorder_every == 0:
+            self.reorder()
+
+    def _counts(self):
+        counts = getattr(self._local, 'counts', None)
+
+        if counts is None:
+            counts = self._local.counts = _Counts(self._rules)
+            with self._lock:
+                self._all_counts.append(counts)
+
+        return counts
+
+    def _add_up(self):
+        """
+        Set each rule's totals from every thread's counts. Call with the lock
+        held. A thread can be counting meanwhile, which only means the totals
+        are a message or so behind.
+        """
+        for rule in self._rules:
+            rule.evaluated = sum(
+                counts.evaluated[rule] for counts in self._all_counts)
+            rule.rejected = sum(
+                counts.rejected[rule] for counts in self._all_counts)
+
+
+def compile_rules(config, reorder_every=10000):
+    """
+    Turn a list of rule definitions (see above) into a `RulePipeline`.
+    """
+    rules = []
+
+    for definition in config:
+        name = definition.get('name')
+        if not name:
+            raise ValueError('Rule without a name: {}'.format(definition))
+
+        field = allowed = None
+
+        if 'check' in definition:
+            try:
+                cost, predicate = CHECKS[definition['check']]
+            except KeyError:
+                raise ValueError('Rule `{}`: unknown check `{}`'.format(
+                    name, definition['check']))
+            tier = CHECK_TIER
+
+        elif 'field' in definition:
+            cost = FIELD_COST
+            predicate = _compile_field_rule(name, definition)
+            tier = FIELD_TIER
+            field = definition['field']
+
+            if 'equals' in definition:
+                allowed = frozenset([definition['equals']])
+            elif 'in' in definition:
+                allowed = frozenset(definition['in'])
+
+        else:
+            raise ValueError(
+                'Rule `{}` needs a `field` or a `check`'.format(name))
+
+        rules.append(Rule(name, definition.get('cost', cost), predicate,
+                          tier, field, allowed))
+
+    checks = set(definition.get('check') for definition in config)
+    missing = [check for check in REQUIRED_CHECKS if check not in checks]
+    if missing:
+        raise ValueError('The rules need the {} check(s)'.format(
+            ', '.join('`{}`'.format(check) for check in missing)))
+
+    return RulePipeline(rules, reorder_every=reorder_every)
+
+
+def _compile_field_rule(name, definition):
+    operators = [op for op in _FIELD_OPERATORS if op in definition]
+
+    if len(operators) != 1:
+        raise ValueError('Rule `{}` needs exactly one of {}'.format(
+            name, ', '.join(sorted(_FIELD_OPERATORS))))
+
+    field = definition['field']
+    test = _FIELD_OPERATORS[operators[0]](definition[operators[0]])
+
+    return lambda message: test(message.raw.get(field))
+
+
+def load_rules(filename=RULES_FILENAME):
+    with open(filename, 'r') as f:
+        return compile_rules(json.load(f))
+
+
+ELIGIBILITY_RULES = reference_data.register(
+    'eligibility_rules', load_rules, source_filenames=[RULES_FILENAME])
@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+
+"""
+Multi-process message processing, sharded by train.
+
+The receiving process only talks to SQS: it long-polls for messages and hands
+the raw bodies to a fixed set of worker processes, which do all the CPU work
+(JSON decoding, eligibility checks, logging). Workers send back an ack/no-ack
+decision for each message and the receiver deletes the acked ones.
+
+If a worker process dies (eg. its initializer fails), the pool stops
+receiving and `run()` raises `WorkerDied`, rather than waiting forever for it
+to empty its inbox.
+
+Along with their decisions, workers send back what's changed in their
+metrics, which the receiving process adds to its own (see metrics.py).
+Workers don't write logs themselves either: their log records are sent to
+the receiving process and go through its handlers, so only one process ever
+writes (and rotates) each log file.
+
+Messages are sharded on `train_id`, so all movements for one train go to the
+same worker and are processed in the order they were received. The train ID
+is pulled out of the raw body with a regular expression rather than decoding
+the whole message in the receiver. Messages without one (ie. anything other
+than movements) are spread round-robin.
+"""
+
+import itertools
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import re
+import signal
+import threading
+import time
+import zlib
+
+import metrics
+
+LOG = logging.getLogger(__name__)
+
+TRAIN_ID_PATTERN = re.compile(r'"train_id"\s*:\s*"([^"]*)"')
+
+# A worker takes up to this many messages that are already waiting, processes
+# them, then calls `sync` once before replying for all of them.
+WORKER_BATCH_SIZE = 10
+
+# How long to wait on a full inbox before checking its worker is still alive
+INBOX_PUT_TIMEOUT = 1.0
+
+_STOP = None
+
+# Sent instead of a token, with a worker's metric changes
+_METRICS = 'metrics'
+
+
+class WorkerDied(Exception):
+    pass
+
+
+def shard_for_body(body, num_shards, round_robin):
+    match = TRAIN_ID_PATTERN.search(body)
+
+    if match is None:
+        return next(round_robin) % num_shards
+
+    # zlib.crc32 rather than hash() so it's stable across processes
+    return zlib.crc32(match.group(1).encode('ascii')) % num_shards
+
+
+class ShardedProcessPool(object):
+    def __init__(self, sqs_queue, acks, process_body, receive_params,
+                 num_shards=multiprocessing.cpu_count(),
+                 max_pending_per_shard=100, initializer=None, sync=None,
+                 finalizer=None, heartbeat=None, controller=None):
+        """
+        `process_body` is called in a worker process with the raw message
+        body and returns True if the message should be acked.
+        `initializer` is called once in each worker before it starts, eg. to
+        load reference data.
+        `sync` is called in the worker before replying with a batch of
+        decisions, and if it returns False, none of them are acked.
+        `finalizer` is called in each worker once it's been told to stop.
+        `heartbeat` (see visibility.py) keeps messages invisible until their
+        decision comes back.
+        `controller` (see polling.py), if given, supplies the receive
+        parameters.
+        """
+        self.sqs_queue = sqs_queue
+        self.acks = acks
+        self.process_body = process_body
+        self.receive_params = receive_params
+        self.num_shards = num_shards
+        self.initializer = initializer
+        self.sync = sync
+        self.finalizer = finalizer
+        self.heartbeat = heartbeat
+        self.controller = controller
+
+        self._inboxes = [multiprocessing.Queue(maxsize=max_pending_per_shard)
+                         for _ in range(num_shards)]
+        self._outbox = multiprocessing.Queue()
+        self._log_records = multiprocessing.Queue()
+        self._log_listener = logging.handlers.QueueListener(
+            self._log_records, _LogRelay())
+        self._workers = []
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        self._tokens = itertools.count()
+        self._round_robin = itertools.count()
+        self._results_thread = None
+        self._abandoned = threading.Event()
+
+    def run(self, shutdown=None):
+        """
+        Receive until `shutdown` (see shutdown.py) is requested, then let the
+        workers finish what they've been given within its deadline. Raises
+        `WorkerDied` if a worker process exits before being told to.
+        """
+        self.start()
+        timeout = 0  # if something goes wrong, don't wait for the workers
+
+        try:
+            while shutdown is None or not shutdown.requested.is_set():
+                self.receive_batch()
+
+            timeout = shutdown.time_left()
+        finally:
+            self.stop(timeout)
+
+    def start(self):
+        self._log_listener.start()
+
+        for shard, inbox in enumerate(self._inboxes):
+            worker = multiprocessing.Process(
+                target=_worker_main,
+                args=(self.process_body, self.initializer, self.sync,
+                      self.finalizer, inbox, self._outbox,
+                      self._log_records),
+                name='shard-{}'.format(shard))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+        self._results_thread = threading.Thread(
+            target=self._handle_results, name='shard-results')
+        self._results_thread.daemon = True
+        self._results_thread.start()
+
+    def receive_batch(self):
+        self._check_workers()
+
+        params = (self.receive_params if self.controller is None
+                  else self.controller.receive_params())
+
+        with metrics.RECEIVE_SECONDS.time():
+            sqs_messages = self.sqs_queue.receive_messages(**params)
+
+        received_at = time.monotonic()
+        metrics.MESSAGES_RECEIVED.inc(len(sqs_messages))
+        if self.heartbeat is not None:
+            self.heartbeat.track(
+                sqs_messages, timeout=params['VisibilityTimeout'])
+
+        if self.controller is not None:
+            self.controller.observe_receive(
+                len(sqs_messages), params['MaxNumberOfMessages'])
+
+        for sqs_message in sqs_messages:
+            self._dispatch(sqs_message, received_at)
+
+    def stop(self, timeout=None):
+        """
+        Let the workers finish what they've been given, then wait for their
+        decisions to be acked. If that takes more than `timeout` seconds,
+        decisions still to come are ignored and their messages are left in
+        flight. Returns True if every worker finished.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def time_left():
+            return (None if deadline is None else
+                    max(0, deadline - time.monotonic()))
+
+        busy = []
+
+        try:
+            stopping = []
+
+            for inbox, worker in zip(self._inboxes, self._workers):
+                if not worker.is_alive():
+                    continue
+
+                try:
+                    inbox.put(_STOP, timeout=time_left())
+                    stopping.append(worker)
+                except queue.Full:
+                    busy.append(worker.name)  # it won't get there in time
+
+            for worker in stopping:
+                worker.join(time_left())
+
+                if worker.is_alive():
+                    busy.append(worker.name)
+
+        except KeyboardInterrupt:
+            # Asked again to quit, so don't wait for any of them
+            busy = [worker.name for worker in self._workers
+                    if worker.is_alive()]
+            self._abandon(busy)
+            raise
+
+        finally:
+            # Anything still buffered in an inbox is never going to be read,
+            # by a worker we've given up on or one that died, so don't wait
+            # at exit to write it
+            for inbox in self._inboxes:
+                inbox.cancel_join_thread()
+
+        if busy:
+            self._abandon(busy)
+        else:
+            self._outbox.put(_STOP)
+
+        self._results_thread.join()
+
+        if not busy:
+            self._log_listener.stop()  # after writing what's left
+
+        return not busy
+
+    def _abandon(self, busy):
+        # They're daemons, so they're killed when we exit. Not before, as a
+        # worker killed while writing to the outbox can leave it locked.
+        LOG.warning('{} still busy, leaving their messages in '
+                    'flight'.format(', '.join(busy)))
+        self._abandoned.set()
+
+    def send_signal(self, signum):
+        """
+        Send a signal to every worker still running, eg. to forward SIGHUP.
+        """
+        for worker in self._workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signum)
+
+    def _dispatch(self, sqs_message, received_at):
+        token = next(self._tokens)
+
+        with self._in_flight_lock:
+            self._in_flight[token] = (received_at, sqs_message)
+
+        shard = shard_for_body(
+            sqs_message.body, self.num_shards, self._round_robin)
+
+        # Blocks when the worker is behind, which stops us receiving more.
+        while True:
+            try:
+                self._inboxes[shard].put((token, sqs_message.body),
+                                         timeout=INBOX_PUT_TIMEOUT)
+                return
+            except queue.Full:
+                self._check_workers()
+
+    def _check_workers(self):
+        for worker in self._workers:
+            if not worker.is_alive():
+                raise WorkerDied('{} exited with code {}'.format(
+                    worker.name, worker.exitcode))
+
+    def _handle_results(self):
+        while not self._abandoned.is_set():
+            try:
+                result = self._outbox.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            if result is _STOP:
+                return
+
+            token, should_ack = result
+
+            if token == _METRICS:
+                metrics.merge(should_ack)
+                continue
+
+            with self._in_flight_lock:
+                received_at, sqs_message = self._in_flight.pop(token)
+
+            if should_ack:
+                self.acks.add(sqs_message)
+            else:
+                LOG.info("Not sending ACK for this one")
+
+            if self.heartbeat is not None:
+                self.heartbeat.untrack(sqs_message)
+
+            if self.controller is not None:
+                self.controller.observe_handled(
+                    1, time.monotonic() - received_at)
+
+
+class _LogRelay(logging.Handler):
+    """
+    Passes a worker's log records to our logger of the same name.
+    """
+
+    def emit(self, record):
+        logging.getLogger(record.name).handle(record)
+
+
+def _worker_main(process_body, initializer, sync, finalizer, inbox, outbox,
+                 log_records):
+    # Send our log records to the receiving process to be written, rather
+    # than writing (and rotating) the same files
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(logging.handlers.QueueHandler(log_records))
+
+    # Shutdown is up to the receiving process, which tells us to stop once
+    # we're done (and sends SIGTERM if we take too long).
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    # The receiving process forwards SIGHUP (see `send_signal`). Ignore it
+    # unless the initializer installs a handler, eg. to reload data.
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    # Counts from the receiving process are copied when we're forked, so
+    # only send what's changed since
+    tracker = metrics.ChangeTracker()
+
+    if initializer is not None:
+        initializer()
+
+    while True:
+        items = _take_batch(inbox)
+        stopping = items[-1] is _STOP
+        if stopping:
+            items.pop()
+
+        results = [(token, _process_guarded(process_body, body))
+                   for token, body in items]
+
+        if results and sync is not None and not sync():
+            results = [(token, False) for token, _ in results]
+
+        for result in results:
+            outbox.put(result)
+
+        _send_metric_changes(tracker, outbox)
+
+        if stopping:
+            if finalizer is not None:
+                finalizer()
+                _send_metric_changes(tracker, outbox)
+
+            # Worker processes exit without running atexit handlers, so
+            # make sure buffered log records are written.
+            logging.shutdown()
+            return
+
+
+def _send_metric_changes(tracker, outbox):
+    changes = tracker.changes()
+    if changes:
+        outbox.put((_METRICS, changes))
+
+
+def _take_batch(inbox):
+    """
+    Wait for an item, then take any more that are already waiting, up to
+    WORKER_BATCH_SIZE or a _STOP.
+    """
+    items = [inbox.get()]
+
+    while len(items) < WORKER_BATCH_SIZE and items[-1] is not _STOP:
+        try:
+            items.append(inbox.get_nowait())
+        except queue.Empty:
+            break
+
+    return items
+
+
+def _process_guarded(process_body, body):
+    try:
+        return process_body(body)
+    except Exception:
+        LOG.exception('Failed to process message, leaving it on the '
+                      'queue: {}'.format(body))
+        return False
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""
+Graceful shutdown on SIGTERM (what the orchestrator sends on a deploy) or
+SIGINT.
+
+The first signal only asks to stop: consumers stop receiving, finish the
+messages they already have within `deadline` seconds, and anything they
+didn't get to is made visible on the queue again straight away rather than
+waiting out its visibility timeout. A second signal raises
+`KeyboardInterrupt`, to give up on draining.
+
+```
+shutdown = GracefulShutdown(deadline=20)
+shutdown.install()
+
+while not shutdown.requested.is_set():
+    ...
+
+shutdown.time_left()
+```
+"""
+
+import logging
+import signal
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+
+class GracefulShutdown(object):
+    def __init__(self, deadline, signals=(signal.SIGTERM, signal.SIGINT),
+                 count_in_flight=None):
+        """
+        `count_in_flight`, if given, is called when shutdown is requested to
+        record how many messages were in flight, for reporting.
+        """
+        self.deadline = deadline
+        self.signals = signals
+        self.count_in_flight = count_in_flight
+        self.requested = threading.Event()
+        self.requested_at = None
+        self.in_flight_when_requested = None
+
+    def install(self):
+        """
+        Install the signal handlers. Must be called from the main thread.
+        """
+        for signum in self.signals:
+            signal.signal(signum, self._handle_signal)
+
+    def request(self):
+        if not self.requested.is_set():
+            self.requested_at = time.monotonic()
+            if self.count_in_flight is not None:
+                self.in_flight_when_requested = self.count_in_flight()
+            self.requested.set()
+
+    def time_left(self):
+        """
+        Seconds left to drain in, or None if shutdown hasn't been requested.
+        """
+        if self.requested_at is None:
+            return None
+
+        return max(0.0, self.requested_at + self.deadline - time.monotonic())
+
+    def elapsed(self):
+        if self.requested_at is None:
+            return None
+
+        return time.monotonic() - self.requested_at
+
+    def _handle_signal(self, signum, frame):
+        if self.requested.is_set():
+            raise KeyboardInterrupt()
+
+        self.request()
+        LOG.info('Got {}, draining for up to {}s (again to quit now)'.format(
+            signal.Signals(signum).name, self.deadline))
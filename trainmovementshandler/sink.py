@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+"""
+Durable store for eligible late arrivals.
+
+Eligible arrivals are written to an SQLite database in batches: writers queue
+records and a background thread commits them together ("group commit"),
+either once `max_batch` records are waiting or after `max_delay` seconds.
+
+A message must only be acked once its record is on disk, so after processing
+a message call `sync()`, which blocks until everything the calling thread has
+written is committed (and raises `SinkError` if the commit failed). Anyone
+waiting in `sync()` makes the pending batch commit straight away; records
+written while that commit is in progress make up the next batch.
+
+Rows are keyed on the train, location and actual time of the arrival, so a
+redelivered message doesn't create a duplicate.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+
+from collections import namedtuple
+
+LOG = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS eligible_arrivals (
+    train_id TEXT NOT NULL,
+    loc_stanox TEXT NOT NULL,
+    actual_timestamp INTEGER NOT NULL,  -- milliseconds since the epoch
+    planned_timestamp INTEGER NOT NULL,
+    toc_id INTEGER NOT NULL,
+    minutes_late INTEGER NOT NULL,
+    PRIMARY KEY (train_id, loc_stanox, actual_timestamp)
+) WITHOUT ROWID
+'''
+
+INSERT = '''
+INSERT OR IGNORE INTO eligible_arrivals (
+    train_id, loc_stanox, actual_timestamp, planned_timestamp, toc_id,
+    minutes_late
+) VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+
+EligibleArrival = namedtuple('EligibleArrival', [
+    'train_id',
+    'loc_stanox',
+    'actual_timestamp',
+    'planned_timestamp',
+    'toc_id',
+    'minutes_late',
+])
+
+
+class SinkError(Exception):
+    pass
+
+
+class EligibleArrivalSink(object):
+    def __init__(self, filename, max_batch=100, max_delay=0.2):
+        self.filename = filename
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+
+        self._pending = []
+        self._oldest_pending_at = None
+        self._written_seq = 0  # sequence number of the last write()
+        self._done_seq = 0  # last sequence number committed (or failed)
+        self._failed_ranges = []  # (first seq, last seq) of failed commits
+
+        # thread ID -> the first sequence number it's written since it last
+        # called sync()
+        self._unsynced = {}
+
+        self._flush_requested = False
+        self._closing = False
+        self._changed = threading.Condition()
+        self._local = threading.local()
+
+        # Open the database here, so a bad filename fails straight away
+        self._connection = self._connect()
+
+        self._thread = threading.Thread(target=self._commit_loop,
+                                        name='eligible-arrival-sink')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, arrival):
+        """
+        Queue an `EligibleArrival` to be committed.
+        """
+        with self._changed:
+            if not self._pending:
+                self._oldest_pending_at = time.monotonic()
+                self._changed.notify_all()  # start the max_delay timer
+
+            self._written_seq += 1
+            self._pending.append(arrival)
+            self._unsynced.setdefault(
+                threading.get_ident(), self._written_seq)
+            self._local.last_seq = self._written_seq
+
+            if len(self._pending) >= self.max_batch:
+                self._changed.notify_all()
+
+    def sync(self):
+        """
+        Block until everything written by this thread since it last called
+        `sync()` has been committed. Raises `SinkError` if any of it wasn't.
+        """
+        seq = getattr(self._local, 'last_seq', 0)
+
+        with self._changed:
+            if self._done_seq < seq:
+                self._flush_requested = True
+                self._changed.notify_all()
+
+            while self._done_seq < seq:
+                self._changed.wait()
+
+            first_seq = self._unsynced.pop(threading.get_ident(), None)
+            if first_seq is None:
+                return  # nothing written since last time
+
+            failed = any(start <= seq and first_seq <= end
+                         for start, end in self._failed_ranges)
+            self._forget_failures()
+
+        if failed:
+            raise SinkError('Failed to store eligible arrival')
+
+    def flush(self):
+        """
+        Commit everything written so far, by any thread, without waiting for
+        a batch to fill up.
+        """
+        with self._changed:
+            seq = self._written_seq
+            self._flush_requested = True
+            self._changed.notify_all()
+
+            while self._done_seq < seq:
+                self._changed.wait()
+
+    def close(self):
+        self.flush()
+
+        with self._changed:
+            self._closing = True
+            self._changed.notify_all()
+
+        self._thread.join()
+
+    def _forget_failures(self):
+        """
+        Drop failed ranges that no thread can still be waiting to sync.
+        """
+        oldest = min(self._unsynced.values(), default=self._written_seq + 1)
+        self._failed_ranges = [(start, end)
+                               for start, end in self._failed_ranges
+                               if end >= oldest]
+
+    def _connect(self):
+        connection = sqlite3.connect(
+            self.filename, timeout=30, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=FULL')
+        connection.execute(SCHEMA)
+        connection.commit()
+        return connection
+
+    def _commit_loop(self):
+        while True:
+            with self._changed:
+                while not (self._closing or self._flush_requested or
+                           len(self._pending) >= self.max_batch):
+                    if not self._pending:
+                        self._changed.wait()
+                        continue
+
+                    remaining = (self._oldest_pending_at + self.max_delay -
+                                 time.monotonic())
+                    if remaining <= 0:
+                        break
+                    self._changed.wait(remaining)
+
+                if self._closing and not self._pending:
+                    self._connection.close()
+                    return
+
+                batch, self._pending = self._pending, []
+                self._flush_requested = False
+                end_seq = self._written_seq
+
+            if batch:
+                self._commit(batch, end_seq)
+
+    def _commit(self, batch, end_seq):
+        start_seq = end_seq - len(batch) + 1
+
+        try:
+            with self._connection:  # commits, or rolls back on error
+                self._connection.executemany(INSERT, batch)
+        except sqlite3.Error:
+            LOG.exception('Failed to store {} eligible arrivals, they '
+                          "won't be acked".format(len(batch)))
+            failed = (start_seq, end_seq)
+        else:
+            failed = None
+
+        with self._changed:
+            if failed:
+                self._failed_ranges.append(failed)
+            self._done_seq = end_seq
+            self._changed.notify_all()
@@ -0,0 +1,525 @@
+#!/usr/bin/env python
+
+"""
+Where messages come from, other than SQS.
+
+Everything that consumes messages (`handle_queue`, the concurrent consumer,
+the sharded pool, `AckBatcher` and `VisibilityHeartbeat`) talks to a message
+source through the interface of `transport.SqsQueue`:
+
+- `receive_messages(MaxNumberOfMessages=..., WaitTimeSeconds=..., ...)`
+  returns a list of messages with `body` and `receipt_handle`,
+- `delete_messages(Entries=[{'Id', 'ReceiptHandle'}, ...])` acknowledges
+  them, and returns `{'Successful': [...], 'Failed': [...]}` like SQS,
+- `change_message_visibility_batch(Entries=...)` keeps them from being
+  redelivered, or with a `VisibilityTimeout` of 0 hands them back,
+- `attributes['ApproximateNumberOfMessages']` is how many are waiting,
+- `close()`.
+
+So `process_message`'s ack/no-ack decision works the same whatever the
+source. Apart from SQS, there are:
+
+`StompSource` subscribes straight to a STOMP topic, eg. Network Rail's
+TRAIN_MVT_ALL_TOC, saving the hop through the forwarder and SQS. Each STOMP
+message is a JSON array of TRUST messages, which are received one at a time.
+The STOMP message is ACKed once all of them have been acked, and acks are
+sent in batches by the `AckBatcher` as usual. One that isn't acked holds its
+STOMP message unacknowledged, and the broker redelivers it when we next
+connect (the dedup cache skips the parts already handled), so at most
+`prefetch` can be held. Handing messages back (`VisibilityTimeout` 0) NACKs
+them, and extending their visibility does nothing: the broker doesn't
+redeliver to anyone else while we're connected.
+
+If the connection drops, or the broker's heart-beats stop arriving, it
+reconnects and subscribes again, waiting twice as long after each failed
+attempt (up to `max_reconnect_delay`). Whatever wasn't ACKed is redelivered
+on the new connection, so messages from the old one that haven't been
+received yet are dropped, and acks of the rest fail.
+
+`FileSource` reads message bodies, one per line, from a file (optionally
+gzipped, as written by replay.py) or stdin. Acking just counts.
+
+```
+source = StompSource('datafeeds.networkrail.co.uk', 61618,
+                     '/topic/TRAIN_MVT_ALL_TOC', username, password)
+source.connect()
+```
+"""
+
+import gzip
+import itertools
+import json
+import logging
+import queue
+import socket
+import sys
+import threading
+import time
+
+from transport import SqsMessage
+
+LOG = logging.getLogger(__name__)
+
+STOMP_VERSION = '1.2'
+
+# Header escapes from the STOMP 1.2 spec
+_ESCAPES = [('\\', '\\\\'), ('\r', '\\r'), ('\n', '\\n'), (':', '\\c')]
+
+
+class StompError(Exception):
+    pass
+
+
+def encode_frame(command, headers, body=''):
+    """
+    Returns the bytes of a STOMP frame.
+    """
+    body = body.encode('utf-8')
+    lines = [command]
+
+    for name, value in headers.items():
+        lines.append('{}:{}'.format(_escape(name), _escape(str(value))))
+
+    if body:
+        lines.append('content-length:{}'.format(len(body)))
+
+    return ('\n'.join(lines) + '\n\n').encode('utf-8') + body + b'\x00'
+
+
+def read_frame(rfile):
+    """
+    Reads the next STOMP frame from a binary file object. Returns
+    (command, headers, body), or None at end of file.
+    """
+    line = b'\n'
+    while line in (b'\n', b'\r\n'):  # heart-beats
+        line = rfile.readline()
+        if not line:
+            return None
+
+    command = line.decode('utf-8').rstrip('\r\n')
+    headers = {}
+
+    for line in iter(rfile.readline, b''):
+        line = line.decode('utf-8').rstrip('\r\n')
+        if not line:
+            break
+
+        name, _, value = line.partition(':')
+        headers.setdefault(_unescape(name), _unescape(value))
+
+    if 'content-length' in headers:
+        body = rfile.read(int(headers['content-length']))
+        rfile.read(1)  # the NULL
+    else:
+        chunks = []
+        while True:
+            byte = rfile.read(1)
+            if byte in (b'\x00', b''):
+                break
+            chunks.append(byte)
+        body = b''.join(chunks)
+
+    return command, headers, body.decode('utf-8')
+
+
+def _escape(string):
+    for raw, escaped in _ESCAPES:
+        string = string.replace(raw, escaped)
+    return string
+
+
+def _unescape(string):
+    if '\\' not in string:
+        return string
+
+    result = []
+    chars = iter(string)
+    for char in chars:
+        if char == '\\':
+            char = {'\\': '\\', 'r': '\r', 'n': '\n', 'c': ':'}[next(chars)]
+        result.append(char)
+    return ''.join(result)
+
+
+class StompSource(object):
+    def __init__(self, host, port, destination, username=None, password=None,
+                 client_id=None, prefetch=100, connect_timeout=10,
+                 heart_beat=(10000, 10000), reconnect_delay=1,
+                 max_reconnect_delay=60):
+        """
+        With a `client_id`, the subscription is durable: the broker keeps
+        messages published while we're disconnected.
+
+        `heart_beat` is (how often we can send one, how often we'd like one)
+        in milliseconds, as in the STOMP `heart-beat` header.
+        """
+        self.host = host
+        self.port = port
+        self.destination = destination
+        self.username = username
+        self.password = password
+        self.client_id = client_id
+        self.prefetch = prefetch
+        self.connect_timeout = connect_timeout
+        self.heart_beat = heart_beat
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+
+        self._socket = None
+        self._rfile = None
+        self._received = queue.Queue()
+        self._connection = 0  # starts each receipt handle, see `_settle`
+        self._parts_left = {}  # STOMP ack ID -> indexes of unacked parts
+        self._parts_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._send_every = None  # seconds between heart-beats we send
+        self._reader = None
+        self._heart_beats = None
+        self._closing = False
+        self._closed = threading.Event()
+
+    def __repr__(self):
+        return 'StompSource("{}:{}{}")'.format(
+            self.host, self.port, self.destination)
+
+    def connect(self):
+        self._connect()
+
+        self._reader = threading.Thread(target=self._receive,
+                                        name='stomp-reader')
+        self._reader.daemon = True
+        self._reader.start()
+
+        self._heart_beats = threading.Thread(target=self._send_heart_beats,
+                                             name='stomp-heart-beats')
+        self._heart_beats.daemon = True
+        self._heart_beats.start()
+
+        return self
+
+    def close(self):
+        self._closing = True
+        self._closed.set()
+
+        try:
+            self._send(encode_frame('DISCONNECT', {}))
+            self._socket.shutdown(socket.SHUT_RDWR)  # wakes the reader up
+        except OSError:
+            pass  # already disconnected
+
+        self._reader.join()
+        self._heart_beats.join()
+        self._rfile.close()
+        self._socket.close()
+
+    @property
+    def attributes(self):
+        return {'ApproximateNumberOfMessages': str(self._received.qsize())}
+
+    def receive_messages(self, MaxNumberOfMessages=1, WaitTimeSeconds=0,
+                         **params):
+        messages = []
+
+        try:
+            messages.append(self._received.get(timeout=WaitTimeSeconds))
+
+            while len(messages) < MaxNumberOfMessages:
+                messages.append(self._received.get_nowait())
+        except queue.Empty:
+            pass
+
+        return messages
+
+    def delete_messages(self, Entries):
+        return self._settle(Entries, self._ack_part)
+
+    def change_message_visibility_batch(self, Entries):
+        return self._settle(Entries, self._change_part_visibility)
+
+    def _settle(self, entries, settle_part):
+        """
+        Applies `settle_part(entry, ack_id, index)` to each entry's message,
+        which returns a frame to send or None, and sends them all at once.
+
+        Receipt handles are "connection/ack ID/index". Ack IDs are only good
+        on the connection they came from, so messages from an earlier one
+        can't be settled: the broker has already taken them back.
+        """
+        frames = []
+        successful = []
+        failed = []
+
+        with self._parts_lock:
+            for entry in entries:
+                connection, _, handle = entry['ReceiptHandle'].partition('/')
+                ack_id, _, index = handle.rpartition('/')
+
+                if (connection != str(self._connection) or
+                        index not in self._parts_left.get(ack_id, ())):
+                    failed.append({'Id': entry['Id'], 'SenderFault': True,
+                                   'Code': 'ReceiptHandleIsInvalid',
+                                   'Message': 'Not waiting for an ack'})
+                    continue
+
+                frame = settle_part(entry, ack_id, index)
+                if frame is not None:
+                    frames.append(frame)
+                successful.append({'Id': entry['Id']})
+
+        if frames:
+            self._send(b''.join(frames))
+
+        return {'Successful': successful, 'Failed': failed}
+
+    def _ack_part(self, entry, ack_id, index):
+        parts_left = self._parts_left[ack_id]
+        parts_left.discard(index)
+
+        if parts_left:
+            return None
+
+        del self._parts_left[ack_id]
+        return encode_frame('ACK', {'id': ack_id})
+
+    def _change_part_visibility(self, entry, ack_id, index):
+        if entry['VisibilityTimeout'] != 0:
+            return None  # nobody else gets it while we're connected
+
+        # The whole STOMP message comes back, so its other parts can't be
+        # acked (or handed back) any more
+        del self._parts_left[ack_id]
+        return encode_frame('NACK', {'id': ack_id})
+
+    def _send(self, data):
+        with self._send_lock:
+            self._socket.sendall(data)
+
+    def _connect(self):
+        self._socket = socket.create_connection(
+            (self.host, self.port), timeout=self.connect_timeout)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._rfile = self._socket.makefile('rb')
+
+        headers = {'accept-version': STOMP_VERSION, 'host': self.host,
+                   'heart-beat': '{},{}'.format(*self.heart_beat)}
+        if self.username is not None:
+            headers.update(login=self.username, passcode=self.password)
+        if self.client_id is not None:
+            headers['client-id'] = self.client_id
+
+        self._send(encode_frame('CONNECT', headers))
+
+        frame = read_frame(self._rfile)
+        if frame is None or frame[0] != 'CONNECTED':
+            raise StompError("Couldn't connect to {}: {}".format(
+                self, frame and frame[1].get('message')))
+
+        self._negotiate_heart_beats(frame[1].get('heart-beat', '0,0'))
+
+        subscription = {'id': 0, 'destination': self.destination,
+                        'ack': 'client-individual',
+                        'activemq.prefetchSize': self.prefetch}
+        if self.client_id is not None:
+            subscription['activemq.subscriptionName'] = self.client_id
+
+        self._send(encode_frame('SUBSCRIBE', subscription))
+
+        LOG.info('Subscribed to {}'.format(self))
+
+    def _negotiate_heart_beats(self, server_heart_beat):
+        """
+        From the STOMP spec: each side sends heart-beats at the slower of the
+        rate it offered and the rate the other side asked for, or not at all
+        if either is 0.
+        """
+        can_send, would_like = self.heart_beat
+        server_can_send, server_would_like = (
+            int(value) for value in server_heart_beat.split(','))
+
+        self._send_every = (max(can_send, server_would_like) / 1000.0
+                            if can_send and server_would_like else None)
+
+        # Allow for some lateness before giving up on the connection
+        if would_like and server_can_send:
+            self._socket.settimeout(
+                2 * max(would_like, server_can_send) / 1000.0)
+        else:
+            self._socket.settimeout(None)
+
+    def _send_heart_beats(self):
+        while not self._closed.wait(self._send_every or 1):
+            if self._send_every is None:
+                continue
+
+            try:
+                self._send(b'\n')
+            except OSError:
+                pass  # the reader finds out too, and reconnects
+
+    def _receive(self):
+        while True:
+            try:
+                self._read_frames()
+            except (OSError, ValueError, StompError) as e:
+                if self._closing:
+                    return
+
+                LOG.error('Stopped receiving from {}: {}'.format(self, e))
+
+            if not self._reconnect():
+                return
+
+    def _reconnect(self):
+        """
+        Reconnect, waiting longer after each failed attempt. Returns False if
+        we're closed meanwhile.
+        """
+        self._forget_connection()
+        delay = self.reconnect_delay
+
+        while not self._closed.wait(delay):
+            try:
+                self._connect()
+            except (OSError, ValueError, StompError) as e:
+                LOG.warning("Couldn't reconnect to {}, trying again in {}s: "
+                            "{}".format(self, delay, e))
+                delay = min(self.max_reconnect_delay, delay * 2)
+                continue
+
+            if self._closing:
+                # close() may have shut down the old socket instead
+                self._socket.shutdown(socket.SHUT_RDWR)
+                return False
+
+            return True
+
+        return False
+
+    def _forget_connection(self):
+        """
+        The broker takes back everything we hadn't ACKed and redelivers it
+        when we reconnect, so drop any of it we haven't handed out, and stop
+        waiting for acks of the rest.
+        """
+        with self._parts_lock:
+            self._connection += 1
+            self._parts_left.clear()
+
+        try:
+            while True:
+                self._received.get_nowait()
+        except queue.Empty:
+            pass
+
+        self._rfile.close()
+        self._socket.close()
+
+    def _read_frames(self):
+        while True:
+            frame = read_frame(self._rfile)
+            if frame is None:
+                raise StompError('{} closed the connection'.format(self))
+
+            command, headers, body = frame
+
+            if command == 'MESSAGE':
+                try:
+                    self._split_message(headers, body)
+                except ValueError as e:
+                    # It'd only be redelivered
+                    LOG.error('Dropping unreadable message {}: {}'.format(
+                        headers.get('message-id'), e))
+                    self._send(encode_frame('ACK', {'id': headers['ack']}))
+            elif command == 'ERROR':
+                raise StompError('{}: {} {}'.format(
+                    self, headers.get('message'), body))
+
+    def _split_message(self, headers, body):
+        ack_id = headers['ack']
+        parts = json.loads(body)
+        if not isinstance(parts, list):
+            parts = [parts]
+
+        with self._parts_lock:
+            connection = self._connection
+            self._parts_left[ack_id] = set(
+                str(index) for index in range(len(parts)))
+
+        for index, part in enumerate(parts):
+            self._received.put(SqsMessage(
+                '{}/{}'.format(headers.get('message-id'), index),
+                '{}/{}/{}'.format(connection, ack_id, index),
+                json.dumps(part)))
+
+
+class FileSource(object):
+    def __init__(self, lines, name='-'):
+        """
+        `lines` is an iterable of message bodies, eg. an open file.
+        """
+        self.name = name
+        self.acked_count = 0
+
+        # Set once there's nothing left to read
+        self.exhausted = threading.Event()
+
+        self._lines = iter(lines)
+        self._line_numbers = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, filename):
+        """
+        "-" is stdin. Files ending ".gz" are gunzipped.
+        """
+        if filename == '-':
+            return cls(sys.stdin, filename)
+        elif filename.endswith('.gz'):
+            return cls(gzip.open(filename, 'rt', encoding='utf-8'), filename)
+        return cls(open(filename, encoding='utf-8'), filename)
+
+    def __repr__(self):
+        return 'FileSource("{}")'.format(self.name)
+
+    def close(self):
+        close = getattr(self._lines, 'close', None)
+        if close is not None and self.name != '-':
+            close()
+
+    @property
+    def attributes(self):
+        return {'ApproximateNumberOfMessages': '0'}  # can't tell
+
+    def receive_messages(self, MaxNumberOfMessages=1, **params):
+        messages = []
+
+        with self._lock:
+            for line in self._lines:
+                line_number = next(self._line_numbers)
+                line = line.strip()
+                if not line:
+                    continue
+
+                messages.append(SqsMessage(
+                    str(line_number), str(line_number), line))
+
+                if len(messages) >= MaxNumberOfMessages:
+                    break
+
+        if not messages:
+            self.exhausted.set()
+            time.sleep(0.1)  # don't spin until the consumer notices
+
+        return messages
+
+    def delete_messages(self, Entries):
+        with self._lock:
+            self.acked_count += len(Entries)
+
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries],
+                'Failed': []}
+
+    def change_message_visibility_batch(self, Entries):
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries],
+                'Failed': []}
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+
+"""
+A local stand-in for the SQS API, for measuring our request/response overhead
+offline (see `replay.py run --stub-sqs`).
+
+It serves a fixed list of message bodies over HTTP, in order, and supports
+just the calls we make: ReceiveMessage, DeleteMessageBatch,
+ChangeMessageVisibilityBatch and GetQueueAttributes. Both the JSON protocol
+(current botocore) and the older query/XML protocol are understood.
+
+Visibility timeouts aren't simulated: a received message stays in flight
+until it's deleted, or released with a visibility timeout of 0, which puts it
+back at the front of the queue.
+
+```
+server = StubSqsServer(bodies)
+server.start()
+client = transport.make_client('eu-west-1', endpoint_url=server.endpoint_url,
+                               aws_access_key_id='stub',
+                               aws_secret_access_key='stub')
+queue = transport.SqsQueue(client, server.queue_url)
+...
+server.stop()
+```
+"""
+
+import hashlib
+import http.server
+import itertools
+import json
+import re
+import threading
+import urllib.parse
+
+from collections import OrderedDict, deque
+from xml.sax.saxutils import escape
+
+QUEUE_PATH = '/123456789012/stub-queue'
+
+XML_NAMESPACE = 'http://queue.amazonaws.com/doc/2012-11-05/'
+
+# eg. "DeleteMessageBatchRequestEntry.3.ReceiptHandle"
+QUERY_ENTRY_PATTERN = re.compile(r'^\w+Entry\.(\d+)\.(\w+)$')
+
+
+class StubSqsServer(object):
+    def __init__(self, bodies, host='127.0.0.1', port=0):
+        self._waiting = deque(bodies)
+        self._in_flight = OrderedDict()  # receipt handle -> (id, body)
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+        self.received_count = 0
+        self.deleted_count = 0
+        self.released_count = 0
+        self.request_count = 0
+
+        # Set once a receive has found nothing left to hand out
+        self.exhausted = threading.Event()
+
+        self._server = http.server.ThreadingHTTPServer(
+            (host, port), _StubSqsHandler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = None
+
+    @property
+    def endpoint_url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    @property
+    def queue_url(self):
+        return self.endpoint_url + QUEUE_PATH
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='stub-sqs')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def receive(self, max_messages):
+        with self._lock:
+            messages = []
+
+            while self._waiting and len(messages) < max_messages:
+                message_id = 'stub-{}'.format(next(self._ids))
+                receipt_handle = 'receipt-{}'.format(message_id)
+                body = self._waiting.popleft()
+                self._in_flight[receipt_handle] = (message_id, body)
+                messages.append((message_id, receipt_handle, body))
+
+            self.received_count += len(messages)
+
+            if not messages:
+                self.exhausted.set()
+
+            return messages
+
+    def delete(self, receipt_handle):
+        with self._lock:
+            if self._in_flight.pop(receipt_handle, None) is None:
+                return False
+
+            self.deleted_count += 1
+            return True
+
+    def change_visibility(self, receipt_handle, visibility_timeout):
+        with self._lock:
+            if receipt_handle not in self._in_flight:
+                return False
+
+            if visibility_timeout == 0:
+                _, body = self._in_flight.pop(receipt_handle)
+                self._waiting.appendleft(body)
+                self.released_count += 1
+                self.exhausted.clear()
+
+            return True
+
+    def attributes(self):
+        with self._lock:
+            return OrderedDict([
+                ('ApproximateNumberOfMessages', str(len(self._waiting))),
+                ('ApproximateNumberOfMessagesNotVisible',
+                 str(len(self._in_flight))),
+            ])
+
+
+class _StubSqsHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real thing
+
+    # Headers and body go out in separate writes, which Nagle's algorithm
+    # would hold up waiting for an ACK on every kept-alive request
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        stub = self.server.stub
+        length = int(self.headers.get('Content-Length', 0))
+        payload = self.rfile.read(length)
+
+        with stub._lock:
+            stub.request_count += 1
+
+        target = self.headers.get('X-Amz-Target')
+
+        if target is not None:
+            action = target.split('.', 1)[1]
+            result = _ACTIONS[action](stub, json.loads(payload or b'{}'))
+            self._reply(json.dumps(result).encode('utf-8'),
+                        'application/x-amz-json-1.0')
+        else:
+            params = dict(urllib.parse.parse_qsl(payload.decode('utf-8')))
+            action = params.pop('Action')
+            request = _from_query(params)
+            result = _ACTIONS[action](stub, request)
+            self._reply(_to_xml(action, result), 'text/xml')
+
+    def _reply(self, content, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass  # one line per request would swamp the benchmark
+
+
+def _receive_message(stub, request):
+    messages = stub.receive(int(request.get('MaxNumberOfMessages', 1)))
+
+    return {'Messages': [
+        OrderedDict([
+            ('MessageId', message_id),
+            ('ReceiptHandle', receipt_handle),
+            ('MD5OfBody', hashlib.md5(body.encode('utf-8')).hexdigest()),
+            ('Body', body),
+        ])
+        for message_id, receipt_handle, body in messages
+    ]}
+
+
+def _batch(stub, request, apply):
+    successful, failed = [], []
+
+    for entry in request.get('Entries', []):
+        if apply(entry):
+            successful.append({'Id': entry['Id']})
+        else:
+            failed.append({'Id': entry['Id'], 'SenderFault': True,
+                           'Code': 'ReceiptHandleIsInvalid',
+                           'Message': 'Not in flight'})
+
+    return {'Successful': successful, 'Failed': failed}
+
+
+def _delete_message_batch(stub, request):
+    return _batch(stub, request,
+                  lambda entry: stub.delete(entry['ReceiptHandle']))
+
+
+def _change_message_visibility_batch(stub, request):
+    return _batch(stub, request, lambda entry: stub.change_visibility(
+        entry['ReceiptHandle'], int(entry['VisibilityTimeout'])))
+
+
+def _get_queue_attributes(stub, request):
+    return {'Attributes': stub.attributes()}
+
+
+_ACTIONS = {
+    'ReceiveMessage': _receive_message,
+    'DeleteMessageBatch': _delete_message_batch,
+    'ChangeMessageVisibilityBatch': _change_message_visibility_batch,
+    'GetQueueAttributes': _get_queue_attributes,
+}
+
+
+def _from_query(params):
+    """
+    Turn query protocol parameters into the JSON protocol's request shape.
+    Only batch entries need it, the other parameters we use are scalars.
+    """
+    request = {}
+    entries = {}
+
+    for key, value in params.items():
+        match = QUERY_ENTRY_PATTERN.match(key)
+        if match is None:
+            request[key] = value
+        else:
+            index, field = match.groups()
+            entries.setdefault(int(index), {})[field] = value
+
+    if entries:
+        request['Entries'] = [entries[index] for index in sorted(entries)]
+
+    return request
+
+
+def _to_xml(action, result):
+    if action == 'ReceiveMessage':
+        inner = ''.join(
+            '<Message>{}</Message>'.format(_xml_fields(message))
+            for message in result['Messages'])
+
+    elif action == 'GetQueueAttributes':
+        inner = ''.join(
+            '<Attribute><Name>{}</Name><Value>{}</Value></Attribute>'.format(
+                escape(name), escape(value))
+            for name, value in result['Attributes'].items())
+
+    else:
+        inner = ''.join(
+            '<{0}ResultEntry>{1}</{0}ResultEntry>'.format(
+                action, _xml_fields(entry))
+            for entry in result['Successful'])
+        inner += ''.join(
+            '<BatchResultErrorEntry>{}</BatchResultErrorEntry>'.format(
+                _xml_fields(entry))
+            for entry in result['Failed'])
+
+    return (
+        '<?xml version="1.0"?>'
+        '<{0}Response xmlns="{1}"><{0}Result>{2}</{0}Result>'
+        '<ResponseMetadata><RequestId>stub</RequestId></ResponseMetadata>'
+        '</{0}Response>'.format(action, XML_NAMESPACE, inner)
+    ).encode('utf-8')
+
+
+def _xml_fields(fields):
+    return ''.join(
+        '<{0}>{1}</{0}>'.format(
+            name, escape(str(value).lower() if isinstance(value, bool)
+                         else str(value)))
+        for name, value in fields.items())
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+"""
+A local stand-in for a STOMP broker like Network Rail's, for measuring
+latency from the feed to our acks end to end, offline (see
+`replay.py run --stub-stomp`).
+
+It publishes a fixed list of message bodies to whoever subscribes, grouped
+into JSON arrays of `messages_per_frame` like the real feed, either as fast
+as the subscription's prefetch allows or at `rate` messages per second. It
+records how long each STOMP message took from being published to being
+ACKed. Like a real broker, NACKed messages and any still unacknowledged when
+the subscriber disconnects are published again.
+
+```
+broker = StubStompBroker(bodies, rate=500)
+broker.start()
+source = StompSource(broker.host, broker.port, '/topic/TRAIN_MVT_ALL_TOC')
+...
+broker.done.wait()
+broker.stop()
+```
+"""
+
+import itertools
+import socket
+import threading
+import time
+
+from collections import deque
+
+from sources import encode_frame, read_frame
+
+
+class StubStompBroker(object):
+    def __init__(self, bodies, messages_per_frame=32, rate=None,
+                 host='127.0.0.1', port=0):
+        bodies = list(bodies)
+        self._waiting = deque(
+            '[{}]'.format(','.join(bodies[i:i + messages_per_frame]))
+            for i in range(0, len(bodies), messages_per_frame))
+        self._frame_count = len(self._waiting)
+        self.rate = rate
+        self.messages_per_frame = messages_per_frame
+
+        self._unacked = {}  # ack ID -> (body, published at)
+        self._ids = itertools.count()
+        self._changed = threading.Condition()
+
+        self.latencies = []  # seconds from publish to ACK, per STOMP message
+        self.acked_count = 0
+        self.nacked_count = 0
+
+        # Set once every STOMP message has been ACKed
+        self.done = threading.Event()
+
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((host, port))
+        self._listener.listen(1)
+        self._stopping = False
+
+    @property
+    def host(self):
+        return self._listener.getsockname()[0]
+
+    @property
+    def port(self):
+        return self._listener.getsockname()[1]
+
+    def start(self):
+        thread = threading.Thread(target=self._accept, name='stub-stomp')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stopping = True
+        with self._changed:
+            self._changed.notify_all()
+        self._listener.close()
+
+    def _accept(self):
+        while not self._stopping:
+            try:
+                connection, _ = self._listener.accept()
+            except OSError:
+                return  # stopped
+
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            thread = threading.Thread(target=self._serve,
+                                      args=(connection,),
+                                      name='stub-stomp-connection')
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, connection):
+        rfile = connection.makefile('rb')
+        send_lock = threading.Lock()
+        connected = threading.Event()
+        connected.set()
+
+        def send(data):
+            with send_lock:
+                connection.sendall(data)
+
+        try:
+            for command, headers, body in iter(
+                    lambda: read_frame(rfile), None):
+
+                if command in ('CONNECT', 'STOMP'):
+                    send(encode_frame('CONNECTED', {'version': '1.2'}))
+
+                elif command == 'SUBSCRIBE':
+                    thread = threading.Thread(
+                        target=self._publish,
+                        args=(send, connected, headers),
+                        name='stub-stomp-publisher')
+                    thread.daemon = True
+                    thread.start()
+
+                elif command == 'ACK':
+                    self._ack(headers['id'])
+
+                elif command == 'NACK':
+                    self._requeue([headers['id']])
+                    self.nacked_count += 1
+
+                elif command == 'DISCONNECT':
+                    break
+
+        except OSError:
+            pass  # the subscriber went away
+
+        finally:
+            connected.clear()
+            connection.close()
+
+            # Redelivered to the next subscriber
+            with self._changed:
+                self._requeue(list(self._unacked))
+                self._changed.notify_all()
+
+    def _publish(self, send, connected, subscription):
+        prefetch = int(subscription.get('activemq.prefetchSize', 1000))
+        next_at = time.monotonic()
+
+        while connected.is_set():
+            with self._changed:
+                while connected.is_set() and not self._stopping and (
+                        not self._waiting or len(self._unacked) >= prefetch):
+                    self._changed.wait()
+
+                if not connected.is_set() or self._stopping:
+                    return
+
+                body = self._waiting.popleft()
+                ack_id = str(next(self._ids))
+                self._unacked[ack_id] = (body, time.monotonic())
+
+            try:
+                send(encode_frame('MESSAGE', {
+                    'subscription': subscription['id'],
+                    'message-id': 'stub-{}'.format(ack_id),
+                    'destination': subscription['destination'],
+                    'ack': ack_id,
+                }, body))
+            except OSError:
+                return
+
+            if self.rate is not None:
+                next_at += self.messages_per_frame / float(self.rate)
+                time.sleep(max(0, next_at - time.monotonic()))
+
+    def _ack(self, ack_id):
+        with self._changed:
+            body, published_at = self._unacked.pop(ack_id)
+            self.latencies.append(time.monotonic() - published_at)
+            self.acked_count += 1
+
+            if self.acked_count == self._frame_count:
+                self.done.set()
+
+            self._changed.notify_all()
+
+    def _requeue(self, ack_ids):
+        with self._changed:
+            for ack_id in ack_ids:
+                body, _ = self._unacked.pop(ack_id)
+                self._waiting.appendleft(body)
+
+            self._changed.notify_all()
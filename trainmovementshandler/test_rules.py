@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+import unittest
+
+import rules
+
+
+class FakeMessage(object):
+    """
+    Enough of a TrainMovementsMessage for the rules. Looking up the location
+    of anything but an arrival fails the test.
+    """
+    def __init__(self, event_type, is_public_station=True, minutes_late=60):
+        self.raw = {'event_type': event_type}
+        self._is_public_station = is_public_station
+        self.minutes_late = minutes_late
+        self.operating_company = None
+
+    @property
+    def location(self):
+        assert self.raw['event_type'] == 'ARRIVAL', 'looked up a departure'
+        return self if self._is_public_station else None
+
+    @property
+    def is_public_station(self):
+        return self._is_public_station
+
+
+class TestRulePipeline(unittest.TestCase):
+    def test_checks_stay_after_field_rules_when_reordered(self):
+        # A cheap check that rejects nearly everything would rank ahead of a
+        # field rule that rejects little
+        pipeline = rules.compile_rules([
+            {'name': 'arrival', 'field': 'event_type', 'equals': 'ARRIVAL'},
+            {'name': 'public_station', 'check': 'public_station',
+             'cost': 0.1},
+            {'name': 'delay_repay_eligible', 'check': 'delay_repay_eligible'},
+        ], reorder_every=10)
+
+        for i in range(100):
+            if i % 10 == 0:
+                pipeline.accepts(FakeMessage('DEPARTURE'))
+            else:
+                pipeline.accepts(FakeMessage('ARRIVAL', False))
+
+        self.assertEqual(
+            ['arrival', 'public_station', 'delay_repay_eligible'],
+            [rule.name for rule in pipeline.rules])
+
+        self.assertFalse(pipeline.accepts(FakeMessage('DEPARTURE')))
+
+    def test_unplanned_arrival_isnt_delay_repay_eligible(self):
+        message = FakeMessage('ARRIVAL', minutes_late=None)
+        message.operating_company = self  # never asked
+
+        self.assertFalse(rules._is_delay_repay_eligible(message))
+
+    def test_allowed_values_come_from_field_rules(self):
+        pipeline = rules.compile_rules([
+            {'name': 'arrival', 'field': 'event_type',
+             'in': ['ARRIVAL', 'DESTINATION']},
+            {'name': 'not_destination', 'field': 'event_type',
+             'not_equals': 'DESTINATION'},
+            {'name': 'late', 'field': 'variation_status', 'equals': 'LATE'},
+            {'name': 'public_station', 'check': 'public_station'},
+            {'name': 'delay_repay_eligible', 'check': 'delay_repay_eligible'},
+        ])
+
+        # not_equals can't narrow it down to a set of values
+        self.assertEqual({'ARRIVAL', 'DESTINATION'},
+                         pipeline.allowed_values('event_type'))
+        self.assertEqual({'LATE'}, pipeline.allowed_values('variation_status'))
+        self.assertIsNone(pipeline.allowed_values('toc_id'))
+
+    def test_rules_without_required_checks_are_rejected(self):
+        with self.assertRaises(ValueError):
+            rules.compile_rules([
+                {'name': 'arrival', 'field': 'event_type',
+                 'equals': 'ARRIVAL'},
+                {'name': 'public_station', 'check': 'public_station'},
+            ])
+
+
+if __name__ == '__main__':
+    unittest.main()
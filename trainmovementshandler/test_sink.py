@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from sink import EligibleArrival, EligibleArrivalSink, SinkError
+
+
+class FlakyConnection(object):
+    """
+    Wraps an SQLite connection so that the first `failures` commits fail.
+    """
+    def __init__(self, connection, failures=1):
+        self.connection = connection
+        self.failures = failures
+
+    def __enter__(self):
+        return self.connection.__enter__()
+
+    def __exit__(self, *exc_info):
+        return self.connection.__exit__(*exc_info)
+
+    def executemany(self, sql, rows):
+        if self.failures > 0:
+            self.failures -= 1
+            raise sqlite3.OperationalError('database is locked')
+
+        return self.connection.executemany(sql, rows)
+
+    def close(self):
+        self.connection.close()
+
+
+def _arrival(train_id):
+    return EligibleArrival(train_id=train_id, loc_stanox='87701',
+                           actual_timestamp=1455887070000,
+                           planned_timestamp=1455883470000, toc_id=88,
+                           minutes_late=60)
+
+
+class TestEligibleArrivalSink(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'arrivals.sqlite')
+        self.sink = EligibleArrivalSink(self.filename)
+        self.sink._connection = FlakyConnection(self.sink._connection)
+
+    def tearDown(self):
+        self.sink.close()
+        shutil.rmtree(self.directory)
+
+    def stored_train_ids(self):
+        with sqlite3.connect(self.filename) as connection:
+            return sorted(row[0] for row in connection.execute(
+                'SELECT train_id FROM eligible_arrivals'))
+
+    def test_failed_batch_followed_by_successful_one(self):
+        self.sink.write(_arrival('1'))
+        self.sink.flush()  # fails, in a batch of its own
+        self.sink.write(_arrival('2'))
+
+        with self.assertRaises(SinkError):
+            self.sink.sync()
+
+        self.assertEqual(['2'], self.stored_train_ids())
+
+    def test_failures_are_forgotten_once_synced(self):
+        self.sink.write(_arrival('1'))
+
+        with self.assertRaises(SinkError):
+            self.sink.sync()
+
+        self.assertEqual([], self.sink._failed_ranges)
+
+        self.sink.write(_arrival('3'))
+        self.sink.sync()
+
+        self.assertEqual(['3'], self.stored_train_ids())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+SQS access through the low-level boto3 client.
+
+`SqsQueue` has the parts of the boto3 resource `Queue` interface we use
+(`receive_messages`, `delete_messages`, `change_message_visibility_batch`,
+`attributes`), so it's a drop-in replacement, but:
+
+- received messages are plain `SqsMessage` records rather than resource
+  objects, which are slow to build;
+- `attributes` are cached for `attributes_ttl` seconds rather than fetched
+  with `GetQueueAttributes` on every access;
+- one client, with an HTTP connection pool big enough for every thread that
+  talks to SQS, is shared by everything that uses the queue. Clients are
+  thread-safe, so pollers, the ack batcher and the visibility heartbeat each
+  reuse a kept-alive connection rather than opening their own.
+
+```
+client = make_client('eu-west-1', max_pool_connections=10)
+queue = SqsQueue(client, queue_url)
+```
+"""
+
+import threading
+import time
+
+import boto3
+
+from botocore.config import Config
+
+
+def make_client(region_name, max_pool_connections=10, endpoint_url=None,
+                **kwargs):
+    """
+    `endpoint_url` points the client somewhere other than AWS, eg. at
+    stub_sqs.py. Other keyword arguments are passed to `boto3.client`.
+    """
+    return boto3.client(
+        'sqs',
+        region_name=region_name,
+        endpoint_url=endpoint_url,
+        config=Config(max_pool_connections=max_pool_connections),
+        **kwargs)
+
+
+class SqsMessage(object):
+    __slots__ = ('message_id', 'receipt_handle', 'body')
+
+    def __init__(self, message_id, receipt_handle, body):
+        self.message_id = message_id
+        self.receipt_handle = receipt_handle
+        self.body = body
+
+    def __repr__(self):
+        return '<SqsMessage {}>'.format(self.message_id)
+
+
+class SqsQueue(object):
+    def __init__(self, client, url, attributes_ttl=30):
+        self.client = client
+        self.url = url
+        self.attributes_ttl = attributes_ttl
+
+        self._attributes = None
+        self._attributes_fetched_at = None
+        self._attributes_lock = threading.Lock()
+
+    def __repr__(self):
+        return 'SqsQueue("{}")'.format(self.url)
+
+    @property
+    def attributes(self):
+        """
+        Queue attributes, eg. "ApproximateNumberOfMessages", at most
+        `attributes_ttl` seconds old.
+        """
+        with self._attributes_lock:
+            now = time.monotonic()
+
+            if (self._attributes is None or
+                    now - self._attributes_fetched_at >= self.attributes_ttl):
+                self._attributes = self.client.get_queue_attributes(
+                    QueueUrl=self.url,
+                    AttributeNames=['All'])['Attributes']
+                self._attributes_fetched_at = now
+
+            return self._attributes
+
+    def close(self):
+        pass  # the client's pooled connections last as long as we do
+
+    def receive_messages(self, **params):
+        response = self.client.receive_message(QueueUrl=self.url, **params)
+
+        return [
+            SqsMessage(message['MessageId'], message['ReceiptHandle'],
+                       message['Body'])
+            for message in response.get('Messages', [])
+        ]
+
+    def delete_messages(self, Entries):
+        return self.client.delete_message_batch(
+            QueueUrl=self.url, Entries=Entries)
+
+    def change_message_visibility_batch(self, Entries):
+        return self.client.change_message_visibility_batch(
+            QueueUrl=self.url, Entries=Entries)
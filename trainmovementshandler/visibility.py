@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+"""
+Keeps received messages invisible while we're still working on them.
+
+Messages are received with a short `VisibilityTimeout`, so a message whose
+consumer died comes back quickly. A stall (a slow log flush, reloading
+reference data, GC) shouldn't make a whole batch reappear to other
+consumers though, so a background thread extends the visibility of every
+message that's still in flight when it gets within `margin` seconds of
+expiring, by another `timeout` seconds, with `ChangeMessageVisibilityBatch`
+(at most 10 per call).
+
+```
+heartbeat = VisibilityHeartbeat(queue, timeout=10)
+heartbeat.start()
+
+messages = queue.receive_messages(VisibilityTimeout=10, ...)
+heartbeat.track(messages)
+...
+acks.add(message)
+heartbeat.untrack(message)
+```
+
+When shutting down, `release_all()` makes anything still in flight visible
+again straight away, so another consumer can have it.
+
+A message that's been in flight for over `max_age` seconds isn't extended
+any more, so one that's stuck can be picked up elsewhere.
+"""
+
+import logging
+import threading
+import time
+
+import metrics
+
+LOG = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = 10  # imposed by SQS
+
+
+class _InFlight(object):
+    __slots__ = ('receipt_handle', 'received_at', 'expires_at')
+
+    def __init__(self, receipt_handle, received_at, expires_at):
+        self.receipt_handle = receipt_handle
+        self.received_at = received_at
+        self.expires_at = expires_at
+
+
+class VisibilityHeartbeat(object):
+    def __init__(self, sqs_queue, timeout, margin=None, max_age=15 * 60):
+        """
+        `timeout` must match the `VisibilityTimeout` messages are usually
+        received with, and is also how much longer each extension makes them
+        invisible for. `margin` defaults to a third of it.
+        """
+        self.sqs_queue = sqs_queue
+        self.timeout = timeout
+        self.margin = timeout / 3.0 if margin is None else margin
+        self.max_age = max_age
+
+        self._in_flight = {}  # receipt handle -> _InFlight
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._in_flight)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._extend_periodically,
+                                        name='visibility-heartbeat')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def track(self, sqs_messages, timeout=None):
+        """
+        Start extending the visibility of messages that were just received.
+        `timeout` is the `VisibilityTimeout` they were received with, if it
+        wasn't the usual one (see polling.py).
+        """
+        now = time.monotonic()
+        expires_at = now + (self.timeout if timeout is None else timeout)
+
+        with self._lock:
+            for sqs_message in sqs_messages:
+                self._in_flight[sqs_message.receipt_handle] = _InFlight(
+                    sqs_message.receipt_handle, now, expires_at)
+
+    def untrack(self, sqs_message):
+        """
+        Stop extending a message's visibility, once it's been acked (or we've
+        decided not to).
+        """
+        with self._lock:
+            self._in_flight.pop(sqs_message.receipt_handle, None)
+
+    def release_all(self):
+        """
+        Stop tracking every message still in flight and make them visible on
+        the queue again now. Returns how many were released.
+        """
+        with self._lock:
+            in_flight = list(self._in_flight.values())
+            self._in_flight.clear()
+
+        released = 0
+
+        for start in range(0, len(in_flight), MAX_BATCH_SIZE):
+            batch = in_flight[start:start + MAX_BATCH_SIZE]
+            entries = [{'Id': str(i),
+                        'ReceiptHandle': message.receipt_handle,
+                        'VisibilityTimeout': 0}
+                       for i, message in enumerate(batch)]
+
+            try:
+                response = self.sqs_queue.change_message_visibility_batch(
+                    Entries=entries)
+            except Exception as e:
+                LOG.warning('Failed to release {} messages, they will '
+                            'reappear when their visibility times out: '
+                            '{}'.format(len(entries), repr(e)))
+                continue
+
+            released += len(entries) - len(response.get('Failed', []))
+
+        return released
+
+    def _extend_periodically(self):
+        while not self._stopping.wait(self.margin / 2):
+            for batch in self._take_due():
+                self._extend(batch)
+
+    def _take_due(self):
+        """
+        Returns batches of in-flight messages that are about to expire, and
+        stops tracking any that have been held too long.
+        """
+        now = time.monotonic()
+        due = []
+
+        with self._lock:
+            for receipt_handle, in_flight in list(self._in_flight.items()):
+                if in_flight.expires_at - now > self.margin:
+                    continue
+
+                if now - in_flight.received_at >= self.max_age:
+                    del self._in_flight[receipt_handle]
+                    LOG.warning('Message in flight for over {}s, letting its '
+                                'visibility expire: {}'.format(
+                                    self.max_age, receipt_handle))
+                    continue
+
+                # Only moved on once SQS confirms it, see _extend
+                due.append(in_flight)
+
+        return [due[i:i + MAX_BATCH_SIZE]
+                for i in range(0, len(due), MAX_BATCH_SIZE)]
+
+    def _extend(self, batch):
+        entries = [{'Id': str(i),
+                    'ReceiptHandle': in_flight.receipt_handle,
+                    'VisibilityTimeout': self.timeout}
+                   for i, in_flight in enumerate(batch)]
+        requested_at = time.monotonic()
+
+        try:
+            response = self.sqs_queue.change_message_visibility_batch(
+                Entries=entries)
+        except Exception as e:
+            metrics.VISIBILITY_EXTENSION_FAILURES.inc(len(entries))
+            LOG.warning('ChangeMessageVisibilityBatch failed, will retry: '
+                        '{}'.format(repr(e)))
+            return
+
+        failures = {failure['Id']: failure
+                    for failure in response.get('Failed', [])}
+
+        metrics.VISIBILITY_EXTENSIONS.inc(len(entries) - len(failures))
+        metrics.VISIBILITY_EXTENSION_FAILURES.inc(len(failures))
+
+        with self._lock:
+            for i, in_flight in enumerate(batch):
+                failure = failures.get(str(i))
+
+                if failure is None:
+                    in_flight.expires_at = requested_at + self.timeout
+                    continue
+
+                LOG.warning('Failed to extend visibility of {}: {} {}'.format(
+                    in_flight.receipt_handle, failure.get('Code'),
+                    failure.get('Message')))
+
+                # Our fault is usually an expired receipt handle: someone else
+                # can have the message by now, so stop trying. Anything else
+                # is retried next time round.
+                if failure.get('SenderFault'):
+                    self._in_flight.pop(in_flight.receipt_handle, None)